@@ -0,0 +1,4 @@
+-- 每位使用者每天只有一筆心情紀錄，背景寫入以 INSERT ... ON DUPLICATE KEY UPDATE 依此鍵去重
+-- 若資料表已有重複資料，需先清理後再執行
+ALTER TABLE `mood_entries`
+ADD UNIQUE KEY `unique_user_entry_date` (`user_id`, `entry_date`);
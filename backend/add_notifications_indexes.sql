@@ -0,0 +1,9 @@
+-- 通知查詢改用複合索引
+-- 未讀數量 / 未讀列表：(user_id, is_read) 即可直接算出，不必回表
+-- 通知列表與 keyset 分頁：ORDER BY created_at DESC, id DESC 直接走索引
+-- 斷線補送 (user_id, id > last_id)：由 idx_user_id 加上主鍵涵蓋，保留
+ALTER TABLE `notifications`
+ADD KEY `idx_user_read_created` (`user_id`, `is_read`, `created_at`),
+ADD KEY `idx_user_created_id` (`user_id`, `created_at`, `id`),
+DROP KEY `idx_is_read`,
+DROP KEY `idx_created_at`;
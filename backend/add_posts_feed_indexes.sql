@@ -0,0 +1,7 @@
+-- 社群動態牆 keyset 分頁：ORDER BY created_at DESC, id DESC 直接走索引
+ALTER TABLE `posts`
+ADD KEY `idx_created_at_id` (`created_at`, `id`);
+
+-- 批次取出每篇貼文最早的幾則留言
+ALTER TABLE `post_comments`
+ADD KEY `idx_post_created_at` (`post_id`, `created_at`, `id`);
@@ -0,0 +1,443 @@
+"""
+離線 RAG 檢索基準測試
+以 data/ 建立暫存的向量資料庫，再以 rag.RagComponents 開啟（與伺服器相同的 k、融合、門檻與 context 篩選），
+用 Q: 問句與其改寫當作已標註的查詢，量測
+- 檢索品質：向量、關鍵字、融合三種檢索的 recall@k 與 MRR，以及最後放進 context 的命中率
+- 效能：檢索與完整 chain（本地假 LLM）的 p50/p95 延遲、建立索引的時間與記憶體
+
+品質指標與機器無關，--save-baseline 會寫到 bench_baseline.json，產生後應提交到版本庫讓 CI 比較
+（目前版本庫中還沒有這個檔案，需在能下載 embedding 模型的環境執行一次）；
+延遲與記憶體只對同一台機器有意義，另存在 bench_baseline.local.json（不提交）
+--check 找不到基準檔時只顯示警告並略過該部分的比較
+
+    python bench_retrieval.py                     # 只顯示結果
+    python bench_retrieval.py --save-baseline     # 寫入兩個基準檔
+    python bench_retrieval.py --check             # 與基準比較，退步時 exit code 為 1（給 CI 用）
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import hashlib
+import argparse
+import tempfile
+
+# 一律使用本地假模型，不需要網路與 API 金鑰
+os.environ["RAG_LLM"] = "stub"
+os.environ.setdefault("LLM_STUB_DELAY", "0")
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from langchain_community.vectorstores import Chroma
+
+from build_database import DATA_PATH, DEFAULT_BATCH_SIZE, load_and_split
+from embeddings import SentenceEmbeddings, EMBEDDING_MODEL, EMBEDDING_BACKEND
+from faq import normalize_question
+from rag import RagComponents, format_docs
+from rag_cache import bump_index_version, new_index_version
+from retrieval import RAG_MAX_K, RAG_LEXICAL_K
+from vector_snapshot import export_snapshot
+
+BASELINE_PATH = "bench_baseline.json"
+PERF_BASELINE_PATH = "bench_baseline.local.json"
+# 伺服器的向量與關鍵字檢索各取 RAG_MAX_K / RAG_LEXICAL_K 筆，recall@k 的 k 不超過這個數才有意義
+DEFAULT_KS = (1, 3, 5, 8)
+# 品質指標允許的絕對下降量；時間與記憶體允許的相對增加量（另有最小絕對容許值，避免微小數值的雜訊）
+QUALITY_TOLERANCE = 0.01
+PERF_TOLERANCE = 0.25
+PERF_SLACK = {"_ms": 1.0, "_seconds": 0.5, "_mb": 50.0}
+
+_QUESTION_RE = re.compile(r"^\s*Q[:：]\s*(.*?)\s*A[:：]", re.S)
+# 產生「關鍵字」改寫時去掉的口語詞
+FILLER_WORDS = ("我想要", "有哪些", "有什麼", "請問", "我想", "想要", "了解", "如何", "怎麼", "哪些", "什麼", "需要",
+                "可以", "是否", "嗎", "呢")
+
+
+def question_of(text):
+    match = _QUESTION_RE.match(text)
+    return match.group(1).strip() if match else None
+
+
+def paraphrases(question):
+    """
+    由 Q: 問句產生固定的查詢變化：原句、加上口語開頭、只留關鍵字
+    回傳 [(variant, query)]
+    """
+    stripped = question.rstrip("？?！!。 ")
+    keywords = stripped
+    for word in FILLER_WORDS:
+        keywords = keywords.replace(word, " ")
+    keywords = " ".join(keywords.replace("，", " ").replace(",", " ").split())
+
+    variants = [("exact", question), ("polite", f"想請教一下，{stripped}呢？")]
+    if len(keywords) >= 2 and keywords != stripped:
+        variants.append(("keywords", keywords))
+    return variants
+
+
+def load_queries(docs, queries_path=None):
+    """
+    回傳 [{"query", "variant", "target"}]，target 為正確區塊的正規化問句
+    queries_path 可另外提供人工撰寫的查詢：[{"query": "...", "question": "對應的 Q: 問句"}]
+    """
+    queries = []
+    seen = set()
+    for doc in docs:
+        question = question_of(doc.page_content)
+        if question is None:
+            continue
+        target = normalize_question(question)
+        if not target or target in seen:
+            continue
+        seen.add(target)
+        queries.extend({"query": query, "variant": variant, "target": target}
+                       for variant, query in paraphrases(question))
+
+    if queries_path:
+        with open(queries_path, encoding="utf-8") as f:
+            for item in json.load(f):
+                queries.append({"query": item["query"], "variant": item.get("variant", "labeled"),
+                                "target": normalize_question(item["question"])})
+    return queries
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 單位為 KB，macOS 為 bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def directory_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return round(total / 1024 / 1024, 2)
+
+
+def dataset_fingerprint(docs):
+    digest = hashlib.sha256()
+    for doc in docs:
+        digest.update(doc.page_content.encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class RankStats:
+    """累積一種檢索方式的 recall@k、MRR 與延遲"""
+
+    def __init__(self, ks):
+        self.ks = ks
+        self.hits = {k: 0 for k in ks}
+        self.reciprocal_ranks = 0.0
+        self.count = 0
+        self.latencies = []
+
+    def add(self, results, target):
+        rank = None
+        for i, (doc, _) in enumerate(results):
+            question = question_of(doc.page_content)
+            if question is not None and normalize_question(question) == target:
+                rank = i + 1
+                break
+        self.count += 1
+        if rank is not None:
+            self.reciprocal_ranks += 1 / rank
+            for k in self.ks:
+                if rank <= k:
+                    self.hits[k] += 1
+
+    def summary(self):
+        count = self.count or 1
+        result = {f"recall@{k}": round(self.hits[k] / count, 4) for k in self.ks}
+        result["mrr"] = round(self.reciprocal_ranks / count, 4)
+        if self.latencies:
+            result["p50_ms"] = round(percentile(self.latencies, 50), 3)
+            result["p95_ms"] = round(percentile(self.latencies, 95), 3)
+        return result
+
+
+def build_index(workdir, embeddings, store, snapshot_dtype):
+    """
+    以 build_database 的切分方式把 data/ 建成暫存索引（需要時一併匯出快照），
+    回傳 (docs, 索引路徑, 建立統計)
+    """
+    filepaths = [os.path.join(DATA_PATH, name) for name in sorted(os.listdir(DATA_PATH))
+                 if name.endswith((".pdf", ".txt"))]
+    start = time.perf_counter()
+    chunks = {}
+    for filepath in filepaths:
+        _, file_chunks = load_and_split(filepath)
+        for doc_id, doc in file_chunks:
+            chunks.setdefault(doc_id, doc)
+    split_seconds = time.perf_counter() - start
+
+    db_path = os.path.join(workdir, "chroma")
+    start = time.perf_counter()
+    db = Chroma(persist_directory=db_path, embedding_function=embeddings)
+    items = list(chunks.items())
+    for i in range(0, len(items), DEFAULT_BATCH_SIZE):
+        batch = items[i:i + DEFAULT_BATCH_SIZE]
+        db.add_documents([doc for _, doc in batch], ids=[doc_id for doc_id, _ in batch])
+    embed_seconds = time.perf_counter() - start
+
+    stats = {
+        "chunks": len(items),
+        "split_seconds": round(split_seconds, 3),
+        "embed_seconds": round(embed_seconds, 3),
+        "index_disk_mb": directory_mb(db_path),
+    }
+
+    version = new_index_version()
+    if store == "snapshot":
+        start = time.perf_counter()
+        data = db.get(include=["embeddings", "documents", "metadatas"])
+        path = export_snapshot(db_path, data["ids"], data["embeddings"], data["documents"], data["metadatas"],
+                               dtype=snapshot_dtype, info={"index_version": version})
+        stats["snapshot_seconds"] = round(time.perf_counter() - start, 3)
+        stats["snapshot_disk_mb"] = directory_mb(path)
+    # 與 build_database 相同：快照寫好後才更新版本，RagComponents 才會採用快照
+    bump_index_version(db_path, version)
+
+    return [doc for _, doc in items], db_path, stats
+
+
+def run_benchmark(ks=DEFAULT_KS, repeat=3, store="chroma", snapshot_dtype="float16", queries_path=None):
+    embeddings = SentenceEmbeddings(cache_size=0)  # 關掉查詢向量 LRU，重複的查詢也要重新計算
+    memory = {"rss_after_model_mb": peak_rss_mb()}
+
+    with tempfile.TemporaryDirectory(prefix="bench_rag_") as workdir:
+        docs, db_path, build_stats = build_index(workdir, embeddings, store, snapshot_dtype)
+        start = time.perf_counter()
+        components = RagComponents(db_path, vector_store=store, embeddings=embeddings)
+        build_stats["open_seconds"] = round(time.perf_counter() - start, 3)
+        memory["peak_rss_mb"] = peak_rss_mb()
+        queries = load_queries(docs, queries_path)
+        if not queries:
+            raise SystemExit(f"在 '{DATA_PATH}' 中找不到任何 Q: 問句，無法產生查詢。")
+
+        # 暖機：模型與各索引的第一次呼叫較慢，不列入統計
+        for item in queries[:5]:
+            components.hybrid_search(item["query"])
+
+        stats = {name: RankStats(ks) for name in ("vector", "lexical", "hybrid")}
+        by_variant = {}
+        context_hits = 0
+        context_tokens = 0
+        context_docs = 0
+        context_chars = 0
+        chain_latencies = []
+
+        for round_index in range(repeat):
+            for item in queries:
+                query, target = item["query"], item["target"]
+
+                # 各階段分開計時；品質只需要算一次，之後幾輪只收集延遲
+                started = time.perf_counter()
+                components.vector_search(query, RAG_MAX_K)
+                stats["vector"].latencies.append((time.perf_counter() - started) * 1000)
+
+                started = time.perf_counter()
+                components.lexical_index.search(query, k=RAG_LEXICAL_K)
+                stats["lexical"].latencies.append((time.perf_counter() - started) * 1000)
+
+                started = time.perf_counter()
+                vector_results, lexical_results, fused = components.hybrid_search(query)
+                stats["hybrid"].latencies.append((time.perf_counter() - started) * 1000)
+
+                # 完整 chain：與伺服器相同的 get_enhanced_context -> qa_prompt -> LLM（假模型）
+                started = time.perf_counter()
+                components.rag_chain.invoke({"question": query, "chat_history": ""})
+                chain_latencies.append((time.perf_counter() - started) * 1000)
+
+                if round_index == 0:
+                    stats["vector"].add(vector_results, target)
+                    stats["lexical"].add(lexical_results, target)
+                    stats["hybrid"].add(fused, target)
+                    by_variant.setdefault(item["variant"], RankStats(ks)).add(fused, target)
+
+                    selected, tokens = components.enhanced_retrieval(query)
+                    context_tokens += tokens
+                    context_docs += len(selected)
+                    context_chars += len(format_docs(selected))
+                    if any(normalize_question(question_of(doc.page_content) or "") == target for doc in selected):
+                        context_hits += 1
+
+        count = len(queries)
+        retrieval = {name: stat.summary() for name, stat in stats.items()}
+        retrieval["context"] = {
+            "hit_rate": round(context_hits / count, 4),
+            "avg_docs": round(context_docs / count, 2),
+            "avg_tokens": round(context_tokens / count, 1),
+            "avg_chars": round(context_chars / count, 1),
+        }
+        retrieval["chain"] = {
+            "p50_ms": round(percentile(chain_latencies, 50), 3),
+            "p95_ms": round(percentile(chain_latencies, 95), 3),
+        }
+
+        return {
+            "config": {
+                "model": EMBEDDING_MODEL,
+                "backend": EMBEDDING_BACKEND,
+                "store": store if store == "chroma" else f"snapshot-{snapshot_dtype}",
+                "ks": list(ks),
+                "vector_k": RAG_MAX_K,
+                "lexical_k": RAG_LEXICAL_K,
+                "queries": count,
+                "repeat": repeat,
+                "dataset": dataset_fingerprint(docs),
+            },
+            "build": {**build_stats, **memory},
+            "retrieval": retrieval,
+            "by_variant": {variant: stat.summary() for variant, stat in sorted(by_variant.items())},
+        }
+
+
+def flatten(results):
+    """{"retrieval.hybrid.recall@5": 0.9, ...}，只包含要和基準比較的數字"""
+    flat = {}
+    for section in ("build", "retrieval", "by_variant"):
+        for name, value in results.get(section, {}).items():
+            if isinstance(value, dict):
+                for metric, number in value.items():
+                    flat[f"{section}.{name}.{metric}"] = number
+            elif isinstance(value, (int, float)):
+                flat[f"{section}.{name}"] = value
+    return flat
+
+
+def is_quality_metric(name):
+    metric = name.rsplit(".", 1)[-1]
+    return metric.startswith("recall@") or metric in ("mrr", "hit_rate")
+
+
+def perf_slack(name):
+    return next((value for suffix, value in PERF_SLACK.items() if name.endswith(suffix)), None)
+
+
+def split_baseline(results):
+    """拆成 (品質基準, 效能基準)：{"config": ..., "metrics": {名稱: 數值}}"""
+    flat = flatten(results)
+    quality = {name: value for name, value in flat.items() if is_quality_metric(name)}
+    perf = {name: value for name, value in flat.items() if perf_slack(name) is not None}
+    return ({"config": results["config"], "metrics": quality},
+            {"config": results["config"], "metrics": perf})
+
+
+def load_baseline(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def compare(results, baseline, quality_tolerance=QUALITY_TOLERANCE, perf_tolerance=PERF_TOLERANCE):
+    """回傳退步的指標 [(名稱, 基準值, 目前值)]；品質越高越好，時間與記憶體越低越好"""
+    current = flatten(results)
+    regressions = []
+    for name, expected in baseline["metrics"].items():
+        actual = current.get(name)
+        if actual is None or expected is None:
+            continue
+        if is_quality_metric(name):
+            if actual < expected - quality_tolerance:
+                regressions.append((name, expected, actual))
+            continue
+        slack = perf_slack(name)
+        if slack is not None and actual > max(expected * (1 + perf_tolerance), expected + slack):
+            regressions.append((name, expected, actual))
+    return regressions
+
+
+def print_report(results):
+    config = results["config"]
+    print(f"模型: {config['model']} ({config['backend']})，向量索引: {config['store']}，"
+          f"查詢: {config['queries']} 筆 x {config['repeat']} 輪")
+    build = results["build"]
+    print(f"建立索引: {build['chunks']} 個區塊，切分 {build['split_seconds']} 秒，嵌入與寫入 {build['embed_seconds']} 秒，"
+          f"開啟 RAG 元件 {build['open_seconds']} 秒，磁碟 {build['index_disk_mb']} MB，峰值記憶體 {build['peak_rss_mb']} MB")
+
+    ks = config["ks"]
+    header = f"{'':10}" + "".join(f"{'R@' + str(k):>8}" for k in ks) + f"{'MRR':>8}{'p50 ms':>10}{'p95 ms':>10}"
+    print(header)
+    for name in ("vector", "lexical", "hybrid"):
+        row = results["retrieval"][name]
+        print(f"{name:10}" + "".join(f"{row[f'recall@{k}']:>8.3f}" for k in ks)
+              + f"{row['mrr']:>8.3f}{row.get('p50_ms', 0):>10.2f}{row.get('p95_ms', 0):>10.2f}")
+    for variant, row in results["by_variant"].items():
+        print(f"  {variant:8}" + "".join(f"{row[f'recall@{k}']:>8.3f}" for k in ks) + f"{row['mrr']:>8.3f}")
+
+    context, chain = results["retrieval"]["context"], results["retrieval"]["chain"]
+    print(f"context 命中率 {context['hit_rate']:.3f}，平均 {context['avg_docs']} 個區塊 / {context['avg_tokens']} tokens"
+          f" / {context['avg_chars']} 字；"
+          f"完整 chain（假 LLM）p50 {chain['p50_ms']:.2f} ms，p95 {chain['p95_ms']:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="離線 RAG 檢索基準測試")
+    parser.add_argument("--ks", default=",".join(map(str, DEFAULT_KS)), help="要計算 recall@k 的 k，以逗號分隔")
+    parser.add_argument("--repeat", type=int, default=3, help="量測延遲時重複整組查詢的輪數")
+    parser.add_argument("--store", choices=("chroma", "snapshot"), default="chroma", help="向量檢索使用的索引")
+    parser.add_argument("--snapshot-dtype", choices=("float16", "float32"), default="float16")
+    parser.add_argument("--queries", help="另外加入的人工標註查詢 (JSON)")
+    parser.add_argument("--output", help="把完整結果寫成 JSON")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="品質基準檔路徑（提交到版本庫）")
+    parser.add_argument("--perf-baseline", default=PERF_BASELINE_PATH, help="本機延遲與記憶體基準檔路徑（不提交）")
+    parser.add_argument("--save-baseline", action="store_true", help="把這次的結果存成基準")
+    parser.add_argument("--check", action="store_true", help="與基準比較，有指標退步時 exit code 為 1")
+    parser.add_argument("--quality-tolerance", type=float, default=QUALITY_TOLERANCE)
+    parser.add_argument("--perf-tolerance", type=float, default=PERF_TOLERANCE)
+    args = parser.parse_args()
+
+    results = run_benchmark(ks=tuple(sorted(int(k) for k in args.ks.split(","))), repeat=max(args.repeat, 1),
+                            store=args.store, snapshot_dtype=args.snapshot_dtype, queries_path=args.queries)
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        for path, baseline in zip((args.baseline, args.perf_baseline), split_baseline(results)):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(baseline, f, ensure_ascii=False, indent=2)
+            print(f"已寫入基準: '{path}'")
+
+    if args.check:
+        baselines = []
+        quality = load_baseline(args.baseline)
+        if quality is None:
+            print(f"警告：找不到品質基準 '{args.baseline}'，略過品質比較；"
+                  f"請以 --save-baseline 產生後提交到版本庫")
+        else:
+            baselines.append(quality)
+            for key in ("model", "backend", "store", "dataset", "ks", "vector_k", "lexical_k"):
+                if quality["config"].get(key) != results["config"].get(key):
+                    print(f"注意：基準的 {key} 為 {quality['config'].get(key)}，這次為 {results['config'].get(key)}")
+        perf = load_baseline(args.perf_baseline)
+        if perf is None:
+            print(f"沒有本機效能基準 '{args.perf_baseline}'，略過延遲與記憶體比較")
+        else:
+            baselines.append(perf)
+        regressions = [item for baseline in baselines
+                       for item in compare(results, baseline, args.quality_tolerance, args.perf_tolerance)]
+        for name, expected, actual in regressions:
+            print(f"退步: {name} {expected} -> {actual}")
+        if regressions:
+            sys.exit(1)
+        if baselines:
+            print("與基準相比沒有退步。")
@@ -1,70 +1,354 @@
 import os
 import re
+import json
+import hashlib
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
 from langchain_community.document_loaders import PyPDFLoader, TextLoader
 from langchain.schema import Document
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
+from rag_cache import bump_index_version, new_index_version, read_index_version
+from vector_snapshot import export_snapshot
+from embeddings import SentenceEmbeddings, EMBEDDING_MODEL, EMBEDDING_BACKEND
 
 load_dotenv()
 
 DATA_PATH = "data"
 DB_PATH = "chroma_db"
+# 每個已嵌入 Q&A 區塊的內容雜湊，用來判斷哪些需要重新嵌入或刪除
+MANIFEST_PATH = os.path.join(DB_PATH, "manifest.json")
+DEFAULT_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+DEFAULT_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+SNAPSHOT_DTYPES = ("float16", "float32")
+
+# Q: / A: 標記（支援中英文冒號）
+_QA_MARKER_RE = re.compile(r"[QA][:：]")
+
 
 def qa_splitter(documents):
     """
-    將文件依照 Q: / A: 的格式切分成問答對
+    將文件依照 Q: / A: 的格式切分成問答對，逐頁讀取並逐一產出
+    - 每個問答對從 Q: 開始，經過第一個 A:，到下一個 Q: 或文件結尾為止
+    - 跨頁的問答對會接續到下一頁；同一份文件 (source) 的頁面需依序傳入
+    - metadata 記錄問答對開始的頁面資訊與 Q: 在該頁的字元位置 (offset)，跨頁時另記 end_page
+    只掃描一次、只保留目前這一組問答對，時間與文件長度成正比
     """
-    qa_docs = []
+    mode = None  # None：尚未遇到 Q:；"q"：問題；"a"：答案
+    q_parts, a_parts = [], []
+    metadata = None
+    source = None
+    page_metadata = None
+
+    def finish():
+        doc_metadata = dict(metadata)
+        if page_metadata.get("page") != doc_metadata.get("page"):
+            doc_metadata["end_page"] = page_metadata.get("page")
+        content = "".join(q_parts).strip() + "\n" + "".join(a_parts).strip()
+        return Document(page_content=content, metadata=doc_metadata)
+
     for doc in documents:
+        if doc.metadata.get("source") != source:
+            # 換了一份文件，上一份最後一組問答對到此結束
+            if mode == "a":
+                yield finish()
+            mode = None
+            source = doc.metadata.get("source")
+        elif mode is not None:
+            # 頁與頁之間補一個換行，避免前後文字黏在一起
+            (q_parts if mode == "q" else a_parts).append("\n")
+
+        page_metadata = doc.metadata
         text = doc.page_content
-        # 找出所有 Q&A pair (支援中英文冒號)
-        pairs = re.findall(r"(Q[:：].*?)(A[:：].*?)(?=Q[:：]|$)", text, re.S)
-        for q, a in pairs:
-            content = q.strip() + "\n" + a.strip()
-            qa_docs.append(Document(page_content=content, metadata=doc.metadata))
-    return qa_docs
+        last = 0
+        for match in _QA_MARKER_RE.finditer(text):
+            pos = match.start()
+            if text[pos] == "Q":
+                if mode == "a":
+                    a_parts.append(text[last:pos])
+                    yield finish()
+                    mode = None
+                if mode is None:
+                    # 問題開始；問題中再出現 Q: 時視為問題的一部分
+                    mode = "q"
+                    q_parts, a_parts = [], []
+                    metadata = {**doc.metadata, "offset": pos}
+                    last = pos
+            elif mode == "q":
+                q_parts.append(text[last:pos])
+                mode = "a"
+                last = pos
+        if mode == "q":
+            q_parts.append(text[last:])
+        elif mode == "a":
+            a_parts.append(text[last:])
+
+    # 沒有 A: 的問題不成為問答對
+    if mode == "a":
+        yield finish()
+
+
+def chunk_id(doc):
+    """以來源檔案與 Q&A 內容計算穩定的 ID，內容不變 ID 就不變"""
+    source = doc.metadata.get("source", "")
+    return hashlib.sha256(f"{source}\n{doc.page_content}".encode("utf-8")).hexdigest()
+
+
+def metadata_hash(metadata):
+    """頁碼與 offset 不在 chunk_id 中，另外以雜湊記在 manifest，內容不變但位置變了時只更新 metadata"""
+    raw = json.dumps(metadata, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def load_manifest():
+    """回傳 (區塊雜湊, 建立時使用的 embedding 設定)；沒有 manifest 時為 (None, None)"""
+    try:
+        with open(MANIFEST_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+    return data.get("chunks", {}), data.get("embedding")
+
+
+def save_manifest(chunks):
+    os.makedirs(DB_PATH, exist_ok=True)
+    tmp_path = MANIFEST_PATH + ".tmp"
+    embedding = {"model": EMBEDDING_MODEL, "backend": EMBEDDING_BACKEND}
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": 1, "embedding": embedding, "chunks": chunks}, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def load_and_split(filepath):
+    """
+    載入單一檔案並切分成 Q&A 區塊（在子行程中執行）
+    回傳 (頁數, [(chunk_id, Document), ...])
+    """
+    if filepath.endswith('.pdf'):
+        loader = PyPDFLoader(filepath)
+    else:
+        loader = TextLoader(filepath, encoding='utf-8')
+    page_count = 0
+
+    def counted(documents):
+        # 逐頁載入，不必先把整份 PDF 的文字放在記憶體
+        nonlocal page_count
+        for doc in documents:
+            page_count += 1
+            yield doc
+
+    chunks = [(chunk_id(doc), doc) for doc in qa_splitter(counted(loader.lazy_load()))]
+    return page_count, chunks
+
+
+def iter_loaded_files(filepaths, workers):
+    """依完成順序產出 (檔名, 頁數, 區塊)；workers > 1 時用多個行程平行載入與切分"""
+    if workers <= 1:
+        for filepath in filepaths:
+            yield (filepath, *load_and_split(filepath))
+        return
 
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(load_and_split, path): path for path in filepaths}
+        for future in as_completed(futures):
+            # 取出後就丟掉 future，已處理完的區塊不會一直留在記憶體
+            yield (futures.pop(future), *future.result())
 
-def build_database():
+
+class ChromaBatchWriter:
+    """
+    累積到 batch_size 個區塊就嵌入並寫入 Chroma，不必把整個語料的向量放在記憶體
+    Embedding 模型與資料庫在第一次寫入時才初始化，沒有新區塊時完全不用載入模型
+    manifest 記錄資料庫中實際存在的區塊，每寫入或刪除一批就存一次，中途失敗時下次仍能正確增量更新
+    """
+
+    def __init__(self, batch_size, rebuild, manifest):
+        self.batch_size = batch_size
+        self.rebuild = rebuild
+        self.manifest = dict(manifest)
+        self.written = 0
+        self.relocated = 0
+        self.seconds = 0.0
+        self._pending = []
+        self._pending_metadata = []
+        self._db = None
+
+    def add(self, doc_id, doc, entry):
+        self._pending.append((doc_id, doc, entry))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        start = time.perf_counter()
+        ids = [doc_id for doc_id, _, _ in self._pending]
+        docs = [doc for _, doc, _ in self._pending]
+        self._get_db().add_documents(docs, ids=ids)
+        self.written += len(ids)
+        self.manifest.update((doc_id, entry) for doc_id, _, entry in self._pending)
+        save_manifest(self.manifest)
+        self._pending = []
+        self.seconds += time.perf_counter() - start
+        print(f"已寫入 {self.written} 個區塊 ({self.written / self.seconds:.1f} chunks/s)")
+
+    def update_metadata(self, doc_id, metadata, entry):
+        """區塊內容沒變、只有頁碼或 offset 改變：直接更新 metadata，不必重新嵌入"""
+        self._pending_metadata.append((doc_id, metadata, entry))
+        if len(self._pending_metadata) >= self.batch_size:
+            self.flush_metadata()
+
+    def flush_metadata(self):
+        if not self._pending_metadata:
+            return
+        db = self._db or Chroma(persist_directory=DB_PATH)
+        db._collection.update(ids=[doc_id for doc_id, _, _ in self._pending_metadata],
+                              metadatas=[metadata for _, metadata, _ in self._pending_metadata])
+        self.relocated += len(self._pending_metadata)
+        self.manifest.update((doc_id, entry) for doc_id, _, entry in self._pending_metadata)
+        self._pending_metadata = []
+        save_manifest(self.manifest)
+
+    def delete(self, ids):
+        db = self._db or Chroma(persist_directory=DB_PATH)
+        db.delete(ids=ids)
+        for doc_id in ids:
+            self.manifest.pop(doc_id, None)
+        save_manifest(self.manifest)
+
+    def clear(self):
+        # 先清空 manifest 再刪資料，中途失敗時下次不會把已刪掉的區塊當成未變動
+        self.manifest = {}
+        save_manifest(self.manifest)
+        Chroma(persist_directory=DB_PATH).delete_collection()
+        self._db = None
+
+    def _get_db(self):
+        if self._db is None:
+            print(f"正在初始化 Embedding Model ({EMBEDDING_BACKEND})...")
+            embeddings = SentenceEmbeddings(batch_size=self.batch_size)
+            print("模型初始化成功。")
+            if self.rebuild:
+                # 沒有 manifest（舊版建立的資料庫沒有穩定 ID）或指定 --full：清空後重建
+                print("正在清空既有資料庫並完整重建...")
+                self.clear()
+                self.rebuild = False
+            self._db = Chroma(persist_directory=DB_PATH, embedding_function=embeddings)
+        return self._db
+
+
+def export_vector_snapshot(dtype, index_version):
+    """把 Chroma 中的所有向量與文件匯出成伺服器可 mmap 的唯讀快照"""
+    start = time.perf_counter()
+    data = Chroma(persist_directory=DB_PATH).get(include=["embeddings", "documents", "metadatas"])
+    path = export_snapshot(
+        DB_PATH, data["ids"], data["embeddings"], data["documents"], data["metadatas"], dtype=dtype,
+        info={"index_version": index_version, "model": EMBEDDING_MODEL, "backend": EMBEDDING_BACKEND},
+    )
+    size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    print(f"已匯出向量快照: {len(data['ids'])} 個區塊 ({dtype}, {size / 1024 / 1024:.1f} MB, "
+          f"{time.perf_counter() - start:.2f} 秒) -> '{path}'")
+
+
+def build_database(full=False, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, snapshot_dtype=None):
     """
     建立以 Q&A 問答對為單位的向量資料庫
+    預設只嵌入新增或修改過的問答對並刪除已不存在的問答對；full=True 時整個重建
+    檔案以 workers 個行程平行載入與切分，新區塊每 batch_size 個一批嵌入並寫入
+    指定 snapshot_dtype 時另外匯出 mmap 快照給伺服器使用
     """
     print("開始建立向量資料庫...")
 
-    documents = []
-    for filename in os.listdir(DATA_PATH):
-        filepath = os.path.join(DATA_PATH, filename)
-        if filename.endswith('.pdf'):
-            loader = PyPDFLoader(filepath)
-            documents.extend(loader.load())
-        elif filename.endswith('.txt'):
-            loader = TextLoader(filepath, encoding='utf-8')
-            documents.extend(loader.load())
-        if documents:
-            print(f"已成功載入文件: {filename}")
-
-    if not documents:
+    filepaths = [
+        os.path.join(DATA_PATH, filename)
+        for filename in sorted(os.listdir(DATA_PATH))
+        if filename.endswith(('.pdf', '.txt'))
+    ]
+    if not filepaths:
         print(f"在 '{DATA_PATH}' 資料夾中找不到任何可讀取的文件。")
         return
 
-    # 用自製的 Q&A Splitter
-    chunked_documents = qa_splitter(documents)
-    print(f"文件已成功切分為 {len(chunked_documents)} 個 Q&A 區塊。")
+    manifest, embedding = (None, None) if full else load_manifest()
+    if manifest is not None and embedding is not None and embedding.get("model") != EMBEDDING_MODEL:
+        # 換了模型，舊向量無法和新查詢比較，只能整個重建
+        print(f"既有資料庫以 {embedding.get('model')} 建立，與目前的 {EMBEDDING_MODEL} 不同，改為完整重建。")
+        manifest = None
+    elif embedding is not None and embedding.get("backend", "torch") != EMBEDDING_BACKEND:
+        # 同一個模型的不同推論後端，向量只有很小的數值差異，可以混用
+        print(f"注意：既有向量以 {embedding.get('backend')} 後端計算，新區塊將以 {EMBEDDING_BACKEND} 計算；"
+              f"若要完全一致請加上 --full。")
+    rebuild = manifest is None
+    if rebuild:
+        manifest = {}
 
-    print("正在初始化 Hugging Face Embedding Model...")
-    model_name = "sentence-transformers/all-MiniLM-L6-v2"
-    embeddings = HuggingFaceEmbeddings(model_name=model_name)
-    print("模型初始化成功。")
+    writer = ChromaBatchWriter(batch_size, rebuild, manifest)
+    current = {}
+    page_count = 0
+    unchanged = 0
+    start = time.perf_counter()
 
-    print("正在生成嵌入向量並建立資料庫...")
-    db = Chroma.from_documents(
-        documents=chunked_documents,
-        embedding=embeddings,
-        persist_directory=DB_PATH
-    )
-    print(f"向量資料庫已成功建立！儲存路徑: '{DB_PATH}'")
+    for filepath, pages, chunks in iter_loaded_files(filepaths, workers):
+        page_count += pages
+        print(f"已成功載入文件: {os.path.basename(filepath)} ({pages} 頁, {len(chunks)} 個 Q&A 區塊)")
+        for doc_id, doc in chunks:
+            # 同樣內容只保留一份
+            if doc_id in current:
+                continue
+            current[doc_id] = {"source": doc.metadata.get("source", ""), "metadata": metadata_hash(doc.metadata)}
+            if doc_id not in manifest:
+                writer.add(doc_id, doc, current[doc_id])
+            elif manifest[doc_id].get("metadata") != current[doc_id]["metadata"]:
+                # 舊版 manifest 沒有 metadata 雜湊，第一次增量更新時會補上所有區塊的頁碼與 offset
+                writer.update_metadata(doc_id, doc.metadata, current[doc_id])
+            else:
+                unchanged += 1
+    writer.flush()
+    writer.flush_metadata()
+
+    load_seconds = max(time.perf_counter() - start - writer.seconds, 1e-9)
+    print(f"載入與切分: {page_count} 頁 ({page_count / load_seconds:.1f} docs/s)，"
+          f"{len(current)} 個 Q&A 區塊 ({len(current) / load_seconds:.1f} chunks/s)")
+
+    if not current:
+        # 不直接結束：既有的區塊仍要從資料庫刪除
+        print(f"注意：在 '{DATA_PATH}' 資料夾中找不到任何 Q&A 區塊。")
+
+    stale_ids = [i for i in manifest if i not in current]
+    print(f"新增/修改: {writer.written} 個，僅更新位置: {writer.relocated} 個，刪除: {len(stale_ids)} 個，"
+          f"未變動: {unchanged} 個")
+    if writer.seconds:
+        print(f"嵌入與寫入: {writer.written} 個區塊 ({writer.written / writer.seconds:.1f} chunks/s)")
+
+    if not writer.written and not writer.relocated and not stale_ids:
+        if writer.rebuild:
+            writer.clear()
+        else:
+            print("向量資料庫已是最新狀態，不需要更新。")
+            if snapshot_dtype:
+                export_vector_snapshot(snapshot_dtype, read_index_version(DB_PATH))
+            return
+
+    if stale_ids:
+        writer.delete(stale_ids)
+
+    save_manifest(current)
+    version = new_index_version()
+    # 快照先寫好再更新版本，伺服器看到新版本時就能直接切換到新快照
+    if snapshot_dtype:
+        export_vector_snapshot(snapshot_dtype, version)
+    # 通知伺服器端的回覆快取失效
+    bump_index_version(DB_PATH, version)
+    print(f"向量資料庫已成功更新！儲存路徑: '{DB_PATH}'")
 
 
 if __name__ == "__main__":
-    build_database()
+    parser = argparse.ArgumentParser(description="建立或增量更新 Q&A 向量資料庫")
+    parser.add_argument("--full", action="store_true", help="忽略 manifest，清空後完整重建")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="平行載入與切分文件的行程數")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="每批嵌入並寫入的區塊數")
+    parser.add_argument("--snapshot", nargs="?", const="float16", choices=SNAPSHOT_DTYPES,
+                        help="另外匯出伺服器可 mmap 的向量快照（預設 float16）")
+    args = parser.parse_args()
+    build_database(full=args.full, workers=args.workers, batch_size=args.batch_size,
+                   snapshot_dtype=args.snapshot)
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from logs import get_logger
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local")  # local 或 redis
+CACHE_TTL = float(os.getenv("CACHE_TTL", 30))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 10000))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+log = get_logger("cache")
+
+
+class LocalCache:
+    """行程內的 TTL + LRU 快取"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def size(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    """
+    Redis（或相容服務）後端，多個 worker 共用同一份快取
+    預期 Redis 在本機或同網段，單次操作在毫秒以內，因此直接同步呼叫
+    """
+
+    def __init__(self, url=REDIS_URL, prefix="igrow:"):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        raw = self._client.get(self._prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(self._prefix + key, json.dumps(value, default=str), px=int(ttl * 1000))
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*(self._prefix + key for key in keys))
+
+    def size(self):
+        return None
+
+
+class UserCache:
+    """
+    每位使用者的未讀通知數、最新通知與總積分快取
+    讀取時未命中才查資料庫 (read-through)，寫入端負責呼叫 invalidate_* 讓快取失效
+    後端出錯時視為未命中，不影響 API 本身
+    """
+
+    # 最新通知一律快取前 LATEST_NOTIFICATIONS 筆，不同的 limit 共用同一份
+    LATEST_NOTIFICATIONS = 10
+
+    def __init__(self, backend, ttl=CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def get_or_load(self, key, loader):
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            log.warning("讀取快取失敗", extra={"fields": {"error": str(e)}})
+            value = None
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = await loader()
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            self.errors += 1
+            log.warning("寫入快取失敗", extra={"fields": {"error": str(e)}})
+
+    def delete(self, *keys):
+        try:
+            self.backend.delete(*keys)
+        except Exception as e:
+            self.errors += 1
+            log.warning("清除快取失敗", extra={"fields": {"error": str(e)}})
+
+    @staticmethod
+    def unread_key(user_id):
+        return f"unread:{user_id}"
+
+    @staticmethod
+    def latest_key(user_id):
+        return f"latest_notifications:{user_id}"
+
+    @staticmethod
+    def points_key(user_id):
+        return f"points:{user_id}"
+
+    def invalidate_notifications(self, *user_ids):
+        keys = []
+        for user_id in user_ids:
+            keys += [self.unread_key(user_id), self.latest_key(user_id)]
+        self.delete(*keys)
+
+    def invalidate_points(self, user_id):
+        self.delete(self.points_key(user_id))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "entries": self.backend.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "errors": self.errors,
+            "ttl": self.ttl,
+        }
+
+
+def create_user_cache():
+    if CACHE_BACKEND == "redis":
+        try:
+            return UserCache(RedisCache())
+        except ImportError:
+            log.warning("未安裝 redis 套件，改用行程內快取")
+    return UserCache(LocalCache())
+
+
+user_cache = create_user_cache()
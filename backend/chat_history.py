@@ -0,0 +1,147 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict, deque
+
+from retrieval import count_tokens
+from logs import get_logger
+
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", 800))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", 300))
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", 2000))
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", 6 * 3600))
+
+ROLE_NAMES = {"user": "用戶", "bot": "助理"}
+
+log = get_logger("chat_history")
+
+
+class ChatSession:
+    def __init__(self):
+        self.turns = deque()  # (格式化後的一行, token 數)
+        self.window_tokens = 0
+        self.summary = ""
+        self.overflow = []  # 已滑出視窗、還沒併入摘要的對話
+        self.messages = 0  # 累計的訊息數（含已併入摘要的）
+        self.summarizing = False
+        self.updated_at = time.monotonic()
+
+
+class ChatHistoryManager:
+    """
+    以 (user_id, session_id) 保存對話歷史，客戶端不需要每次重送完整對話
+    - 最近的對話放在 token 上限為 window_tokens 的滑動視窗中
+    - 滑出視窗的對話交給 summarize 壓縮成滾動摘要，之後每輪直接重用摘要
+    - 摘要在背景產生，不會增加回覆延遲；沒有 summarize 時直接捨棄舊對話
+    """
+
+    def __init__(self, summarize=None, window_tokens=CHAT_HISTORY_TOKENS, summary_tokens=CHAT_SUMMARY_TOKENS,
+                 max_sessions=CHAT_MAX_SESSIONS, session_ttl=CHAT_SESSION_TTL):
+        self.summarize = summarize
+        self.window_tokens = window_tokens
+        self.summary_tokens = summary_tokens
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self._sessions = OrderedDict()
+
+    def render(self, user_id, session_id, client_history=None, current_message=None):
+        """
+        組出放進 prompt 的對話歷史
+        伺服器不認得這個 session（例如重新啟動後），或客戶端送來的歷史比伺服器保存的多
+        （多個 worker 時，中間幾輪由其他行程處理）時，以客戶端的歷史重新初始化
+        """
+        key = (user_id, session_id)
+        history = list(client_history or [])
+        # 前端送來的歷史最後一筆通常就是這次的問題
+        if history and current_message is not None and history[-1].sender == "user" \
+                and history[-1].text == current_message:
+            history.pop()
+
+        session = self._sessions.get(key)
+        if session is None or time.monotonic() - session.updated_at > self.session_ttl \
+                or len(history) > session.messages:
+            session = self._new_session(key)
+            for msg in history:
+                self._append(session, msg.sender, msg.text)
+        else:
+            self._sessions.move_to_end(key)
+
+        parts = []
+        if session.summary:
+            parts.append(f"先前對話摘要: {session.summary}\n")
+        parts.extend(line for line, _ in session.turns)
+        return "".join(parts)
+
+    def append_turn(self, user_id, session_id, question, reply):
+        """記錄一輪問答；視窗超過 token 上限時把最舊的對話移去摘要"""
+        key = (user_id, session_id)
+        session = self._sessions.get(key) or self._new_session(key)
+        self._sessions.move_to_end(key)
+        self._append(session, "user", question)
+        if reply:
+            self._append(session, "bot", reply)
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "window_tokens": self.window_tokens,
+            "summary_tokens": self.summary_tokens,
+        }
+
+    def _new_session(self, key):
+        session = ChatSession()
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    def _append(self, session, sender, text):
+        line = f"{ROLE_NAMES.get(sender, '助理')}: {text}\n"
+        tokens = count_tokens(line)
+        session.turns.append((line, tokens))
+        session.window_tokens += tokens
+        session.messages += 1
+        session.updated_at = time.monotonic()
+
+        # 至少保留最新一筆在視窗中
+        while session.window_tokens > self.window_tokens and len(session.turns) > 1:
+            old_line, old_tokens = session.turns.popleft()
+            session.window_tokens -= old_tokens
+            session.overflow.append(old_line)
+
+        if session.overflow:
+            self._schedule_summary(session)
+
+    def _schedule_summary(self, session):
+        if self.summarize is None:
+            session.overflow.clear()
+            return
+        if session.summarizing:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        session.summarizing = True
+        loop.create_task(self._update_summary(session))
+
+    async def _update_summary(self, session):
+        try:
+            while session.overflow:
+                overflow_text = "".join(session.overflow)
+                session.overflow = []
+                try:
+                    summary = await self.summarize(session.summary, overflow_text, self.summary_tokens)
+                except Exception as e:
+                    log.warning("產生對話摘要失敗，捨棄較舊的對話", extra={"fields": {"error": str(e)}})
+                    continue
+                session.summary = self._truncate(summary.strip())
+        finally:
+            session.summarizing = False
+
+    def _truncate(self, summary):
+        # 摘要長度也要有上限，避免每輪成本慢慢變大
+        while summary and count_tokens(summary) > self.summary_tokens:
+            summary = summary[: int(len(summary) * 0.9)]
+        return summary
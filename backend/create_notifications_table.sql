@@ -10,8 +10,8 @@ CREATE TABLE IF NOT EXISTS notifications (
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
 
     INDEX idx_user_id (user_id),
-    INDEX idx_is_read (is_read),
-    INDEX idx_created_at (created_at)
+    INDEX idx_user_read_created (user_id, is_read, created_at),
+    INDEX idx_user_created_id (user_id, created_at, id)
 );
 
 -- 如果需要外鍵約束，可以取消註解以下行
@@ -0,0 +1,224 @@
+import os
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+import mysql.connector
+from dotenv import load_dotenv
+
+from logs import get_logger
+from metrics import db_acquire_seconds, db_query_seconds
+
+load_dotenv()
+log = get_logger("db")
+
+DB_CONFIG = {
+    'host': os.getenv("DB_HOST"),
+    'user': os.getenv("DB_USER"),
+    'password': os.getenv("DB_PASSWORD"),
+    'database': os.getenv("DB_NAME"),
+}
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", 5))
+DB_POOL_PING_INTERVAL = float(os.getenv("DB_POOL_PING_INTERVAL", 30))
+
+
+class PoolTimeout(Exception):
+    """在 acquire_timeout 內拿不到連線"""
+
+
+class DatabaseUnavailable(Exception):
+    """無法建立新的資料庫連線"""
+
+
+class ConnectionPool:
+    """
+    共用的資料庫連線池
+    - 最多同時借出 size 條連線，超過時等待，逾時丟出 PoolTimeout
+    - 閒置超過 ping_interval 秒的連線在借出前先做健康檢查，壞掉就丟棄重建
+    - 記錄借用等待時間與逾時次數，供 /api/health/db 查看
+    """
+
+    def __init__(self, connect, size=DB_POOL_SIZE, acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+                 ping_interval=DB_POOL_PING_INTERVAL):
+        self._connect = connect
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.ping_interval = ping_interval
+        # LIFO：優先借出最近用過的連線，冷的連線自然閒置到被健康檢查淘汰
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._in_use = 0
+        self._stats = {
+            "acquired": 0,
+            "timeouts": 0,
+            "connect_errors": 0,
+            "health_check_failures": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+
+    def acquire(self, timeout=None):
+        """借出一條連線；timeout 為 None 時使用 acquire_timeout"""
+        start = time.perf_counter()
+        timeout = self.acquire_timeout if timeout is None else max(timeout, 0)
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeout(f"等待資料庫連線超過 {round(timeout, 3)} 秒")
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        self._record_wait(time.perf_counter() - start)
+        return conn
+
+    def release(self, conn, broken=False):
+        """歸還連線；broken=True 的連線直接關閉不再重用"""
+        try:
+            if broken:
+                self._discard(conn)
+            else:
+                try:
+                    if getattr(conn, "in_transaction", False):
+                        conn.rollback()
+                    self._idle.put((conn, time.monotonic()))
+                except mysql.connector.Error:
+                    self._discard(conn)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        broken = False
+        try:
+            yield conn
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close(self):
+        """關閉所有閒置連線（應用程式關閉時呼叫）"""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            acquired = self._stats["acquired"]
+            return {
+                "size": self.size,
+                "opened": self._opened,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "acquired": acquired,
+                "timeouts": self._stats["timeouts"],
+                "connect_errors": self._stats["connect_errors"],
+                "health_check_failures": self._stats["health_check_failures"],
+                "wait_ms_avg": round(self._stats["wait_ms_total"] / acquired, 3) if acquired else 0.0,
+                "wait_ms_max": round(self._stats["wait_ms_max"], 3),
+            }
+
+    def _checkout(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open()
+                break
+            if time.monotonic() - last_used < self.ping_interval or self._is_healthy(conn):
+                break
+            with self._lock:
+                self._stats["health_check_failures"] += 1
+            self._discard(conn)
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def _open(self):
+        try:
+            conn = self._connect()
+        except mysql.connector.Error as err:
+            with self._lock:
+                self._stats["connect_errors"] += 1
+            log.error("資料庫連線失敗", extra={"fields": {"error": str(err)}})
+            raise DatabaseUnavailable(str(err)) from err
+        with self._lock:
+            self._opened += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._opened -= 1
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            return conn.is_connected()
+        except Exception:
+            return False
+
+    def _record_wait(self, seconds):
+        wait_ms = seconds * 1000
+        with self._lock:
+            self._stats["acquired"] += 1
+            self._stats["wait_ms_total"] += wait_ms
+            self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+
+
+class AsyncDatabase:
+    """
+    讓 async 路由使用連線池：同步的 cursor 工作丟到有上限的執行緒池，不阻塞 event loop
+    執行緒數量等於連線池大小，排隊等待執行緒的時間也算進 acquire_timeout
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._executor = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="db")
+
+    async def run(self, fn, *args, **kwargs):
+        """在執行緒池中借一條連線執行 fn(conn, *args, **kwargs)"""
+        loop = asyncio.get_running_loop()
+        queued_at = time.perf_counter()
+        return await loop.run_in_executor(
+            self._executor, partial(self._call, queued_at, fn, args, kwargs)
+        )
+
+    def _call(self, queued_at, fn, args, kwargs):
+        # 依工作函式名稱分別記錄借連線與執行的時間，例如 query="get_notifications"
+        name = getattr(fn, "__name__", "unknown").lstrip("_")
+        remaining = self.pool.acquire_timeout - (time.perf_counter() - queued_at)
+        with self.pool.connection(timeout=remaining) as conn:
+            acquired_at = time.perf_counter()
+            db_acquire_seconds.observe(acquired_at - queued_at, query=name)
+            try:
+                return fn(conn, *args, **kwargs)
+            finally:
+                db_query_seconds.observe(time.perf_counter() - acquired_at, query=name)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.pool.close()
+
+
+db_pool = AsyncDatabase(ConnectionPool(lambda: mysql.connector.connect(**DB_CONFIG)))
@@ -0,0 +1,154 @@
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+from logs import get_logger
+from metrics import rag_stage_seconds
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# torch：原本的全精度 PyTorch；onnx：ONNX Runtime；int8：PyTorch 動態量化 (Linear 層 int8)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# onnx 後端要載入的模型檔，例如 onnx/model_qint8_avx2.onnx 為 int8 量化版
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model.onnx")
+EMBED_QUERY_CACHE_SIZE = int(os.getenv("EMBED_QUERY_CACHE_SIZE", 1024))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", 32))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", 2))
+
+log = get_logger("embeddings")
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def load_model(model_name=EMBEDDING_MODEL, backend=EMBEDDING_BACKEND):
+    """每個行程每種 (模型, 後端) 只載入一次"""
+    with _models_lock:
+        model = _models.get((model_name, backend))
+        if model is None:
+            started = time.perf_counter()
+            model = _load_model(model_name, backend)
+            _models[(model_name, backend)] = model
+            log.info("embedding 模型已載入", extra={"fields": {
+                "model": model_name, "backend": backend, "seconds": round(time.perf_counter() - started, 2)
+            }})
+        return model
+
+
+def _load_model(model_name, backend):
+    from sentence_transformers import SentenceTransformer
+
+    if backend == "onnx":
+        # 需要 sentence-transformers>=3.2 與 optimum[onnxruntime]
+        return SentenceTransformer(model_name, device="cpu", backend="onnx",
+                                   model_kwargs={"file_name": EMBEDDING_ONNX_FILE})
+    model = SentenceTransformer(model_name, device="cpu")
+    if backend == "int8":
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend != "torch":
+        raise ValueError(f"未知的 EMBEDDING_BACKEND: {backend}")
+    return model
+
+
+class SentenceEmbeddings(Embeddings):
+    """
+    給 Chroma、回覆快取與 build_database.py 共用的 embedding
+    - 模型每個行程只載入一次，可選 ONNX Runtime 或 int8 量化以降低延遲與記憶體
+    - 多個請求同時計算查詢向量時，由背景執行緒合併成一批 encode
+    - 最近 EMBED_QUERY_CACHE_SIZE 個查詢的向量保留在 LRU 中
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL, backend=EMBEDDING_BACKEND, batch_size=EMBED_MAX_BATCH,
+                 cache_size=EMBED_QUERY_CACHE_SIZE, batch_wait_ms=EMBED_BATCH_WAIT_MS):
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.batch_wait = batch_wait_ms / 1000
+        self.model = load_model(model_name, backend)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._requests = queue.SimpleQueue()
+        self._batcher = None
+        self._batcher_lock = threading.Lock()
+        self.stats = {"queries": 0, "cache_hits": 0, "batches": 0, "batched_queries": 0}
+
+    def embed_documents(self, texts):
+        with rag_stage_seconds.time(stage="embedding_documents"):
+            return self._encode(list(texts))
+
+    def embed_query(self, text):
+        with rag_stage_seconds.time(stage="embedding"):
+            self.stats["queries"] += 1
+            with self._cache_lock:
+                vector = self._cache.get(text)
+                if vector is not None:
+                    self._cache.move_to_end(text)
+                    self.stats["cache_hits"] += 1
+                    return list(vector)
+
+            future = Future()
+            self._ensure_batcher()
+            self._requests.put((text, future))
+            vector = future.result()
+
+            with self._cache_lock:
+                self._cache[text] = vector
+                self._cache.move_to_end(text)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return list(vector)
+
+    def status(self):
+        batches = self.stats["batches"]
+        queries = self.stats["queries"]
+        return {
+            "model": self.model_name,
+            "backend": self.backend,
+            "cached_queries": len(self._cache),
+            "cache_hit_rate": round(self.stats["cache_hits"] / queries, 4) if queries else 0.0,
+            "avg_batch_size": round(self.stats["batched_queries"] / batches, 2) if batches else 0.0,
+            **self.stats,
+        }
+
+    def _encode(self, texts):
+        vectors = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                    show_progress_bar=False)
+        return vectors.tolist()
+
+    def _ensure_batcher(self):
+        if self._batcher is None:
+            with self._batcher_lock:
+                if self._batcher is None:
+                    self._batcher = threading.Thread(target=self._run_batcher, name="embed-batcher", daemon=True)
+                    self._batcher.start()
+
+    def _run_batcher(self):
+        while True:
+            batch = [self._requests.get()]
+            # 稍等一下，讓同時進來的查詢一起算
+            deadline = time.perf_counter() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(self._requests.get(timeout=remaining) if remaining > 0
+                                 else self._requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(texts, self._encode(texts)))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats["batches"] += 1
+            self.stats["batched_queries"] += len(batch)
+            for text, future in batch:
+                future.set_result(tuple(vectors[text]))
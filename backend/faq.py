@@ -0,0 +1,135 @@
+import os
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+from retrieval import normalize_text
+from logs import get_logger
+
+log = get_logger("faq")
+
+# 內建常用字的簡→繁對照表，沒有安裝 opencc / zhconv 時也能折疊常見的簡體問法
+_SIMPLIFIED = (
+    "们这个为么吗说请问题时间后会过还发进开关门对应该里没给让经领导预约议车场饭补贴节"
+    "礼带产丧资务员报销费单据户帐账号码录设认证险积养医疗劳动签离职转试绩奖调岗训练学"
+    "习网络电脑邮线连无启错误显页载传档办统计审级数东买卖钱银税额实际长几样种类别处体"
+    "检书写图历现与于从来见视频话讯语译读总结组织负责将准备换两满惯义权帮协华业专当亲"
+    "属须续缴纳迟记厂区楼层侧厕饮宽机构输创删变态状况阶达标则规范项论谈称简营运价钟头"
+    "点气热灯坏维护钥锁卫纸药伤紧联师课讲宝贝儿爱岁龄轮团队边远递较优质双并够听观虑顾"
+    "虽却尽仅确绝难庆闻选择举参获励惩罚违纪"
+)
+_TRADITIONAL = (
+    "們這個為麼嗎說請問題時間後會過還發進開關門對應該裡沒給讓經領導預約議車場飯補貼節"
+    "禮帶產喪資務員報銷費單據戶帳帳號碼錄設認證險積養醫療勞動簽離職轉試績獎調崗訓練學"
+    "習網絡電腦郵線連無啟錯誤顯頁載傳檔辦統計審級數東買賣錢銀稅額實際長幾樣種類別處體"
+    "檢書寫圖歷現與於從來見視頻話訊語譯讀總結組織負責將準備換兩滿慣義權幫協華業專當親"
+    "屬須續繳納遲記廠區樓層側廁飲寬機構輸創刪變態狀況階達標則規範項論談稱簡營運價鐘頭"
+    "點氣熱燈壞維護鑰鎖衛紙藥傷緊聯師課講寶貝兒愛歲齡輪團隊邊遠遞較優質雙並夠聽觀慮顧"
+    "雖卻盡僅確絕難慶聞選擇舉參獲勵懲罰違紀"
+)
+_S2T_TABLE = str.maketrans(_SIMPLIFIED, _TRADITIONAL)
+
+# 有安裝 opencc 或 zhconv 時改用完整的繁簡轉換
+try:
+    from opencc import OpenCC
+    _to_traditional = OpenCC("s2t").convert
+except ImportError:
+    try:
+        from zhconv import convert as _zhconv_convert
+        _to_traditional = lambda text: _zhconv_convert(text, "zh-hant")
+    except ImportError:
+        _to_traditional = lambda text: text.translate(_S2T_TABLE)
+        log.info("未安裝 opencc 或 zhconv，FAQ 比對改用內建的常用字繁簡對照表")
+
+FAQ_MATCH_THRESHOLD = float(os.getenv("FAQ_MATCH_THRESHOLD", 0.9))
+# 直接回覆 FAQ 答案時套用的樣板，設為 "{answer}" 即原文回覆
+FAQ_REPLY_TEMPLATE = os.getenv("FAQ_REPLY_TEMPLATE", "這題我知道 (๑•̀ㅂ•́)و✧\n\n{answer}")
+
+# 否定詞出現次數不同就不採用近似比對，避免「要不要」「不需要」這類只差一兩個字的反義問題誤中
+_NEGATIONS = "不沒未無別非否勿莫"
+
+_QA_RE = re.compile(r"^\s*Q[:：]\s*(.*?)\s*A[:：]\s*(.*)$", re.S)
+
+
+def normalize_question(text):
+    """全半形、大小寫、繁簡統一，並去掉標點、符號與空白"""
+    text = _to_traditional(normalize_text(text).lower())
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in "PZSC")
+
+
+def _negations(text):
+    return Counter(ch for ch in text if ch in _NEGATIONS)
+
+
+def _bigrams(text):
+    if len(text) < 2:
+        return Counter([text]) if text else Counter()
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+
+class FaqIndex:
+    """
+    Q&A 區塊中 Q: 問句的正規化索引
+    使用者的問題與某個 Q: 幾乎一字不差時，直接回覆對應的 A: 內容，不必呼叫 LLM
+    - 正規化後完全相同：信心 1.0，查 dict 即可
+    - 否則以字元 bigram 的 Dice 係數比對，達到 FAQ_MATCH_THRESHOLD 且否定詞相同才採用
+    """
+
+    def __init__(self, documents, threshold=FAQ_MATCH_THRESHOLD):
+        self.threshold = threshold
+        # 只保留問句索引與文件編號，答案命中時才從 documents 取出（快照時不在每個 worker 複製全文）
+        self.documents = documents
+        self.entries = []  # (正規化問句, bigram 計數, 文件編號)
+        self.exact = {}
+        self.postings = defaultdict(set)  # bigram -> {entry index}
+
+        for position, doc in enumerate(documents):
+            match = _QA_RE.match(doc.page_content)
+            if not match:
+                continue
+            question, answer = match.group(1).strip(), match.group(2).strip()
+            key = normalize_question(question)
+            if not key or not answer or key in self.exact:
+                continue
+            index = len(self.entries)
+            grams = _bigrams(key)
+            self.entries.append((key, grams, position))
+            self.exact[key] = index
+            for gram in grams:
+                self.postings[gram].add(index)
+
+    def match(self, question):
+        """回傳 (答案, 信心分數)；沒有足夠把握時回傳 (None, 最高分數)"""
+        key = normalize_question(question)
+        if not key:
+            return None, 0.0
+        index = self.exact.get(key)
+        if index is not None:
+            return self._answer(index), 1.0
+
+        grams = _bigrams(key)
+        candidates = set()
+        for gram in grams:
+            candidates |= self.postings.get(gram, set())
+
+        best_index, best_score = None, 0.0
+        total = sum(grams.values())
+        negations = _negations(key)
+        for index in candidates:
+            if _negations(self.entries[index][0]) != negations:
+                continue
+            other = self.entries[index][1]
+            shared = sum((grams & other).values())
+            score = 2 * shared / (total + sum(other.values()))
+            if score > best_score:
+                best_index, best_score = index, score
+
+        if best_index is not None and best_score >= self.threshold:
+            return self._answer(best_index), best_score
+        return None, best_score
+
+    def _answer(self, index):
+        return _QA_RE.match(self.documents[self.entries[index][2]].page_content).group(2).strip()
+
+    def format_reply(self, answer):
+        return FAQ_REPLY_TEMPLATE.format(answer=answer)
@@ -0,0 +1,172 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 32))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 10))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", 60))
+
+
+class LLMBusy(Exception):
+    """LLM 呼叫無法在期限內完成；status_code 對應回傳給客戶端的 HTTP 狀態碼"""
+
+    status_code = 503
+    detail = "AI 助理忙碌中，請稍後再試"
+
+    def __init__(self, retry_after=1):
+        super().__init__(self.detail)
+        self.retry_after = retry_after
+
+
+class LLMQueueFull(LLMBusy):
+    """等待佇列已滿，立即拒絕"""
+
+    status_code = 429
+    detail = "目前使用人數過多，請稍後再試"
+
+
+class LLMQueueTimeout(LLMBusy):
+    """排隊超過 queue_timeout 仍未輪到"""
+
+
+class LLMDeadlineExceeded(LLMBusy):
+    """LLM 呼叫超過請求期限"""
+
+    status_code = 504
+    detail = "AI 助理回應逾時，請稍後再試"
+
+
+class LLMSlot:
+    """
+    一個已取得的 LLM 呼叫名額；release() 可重複呼叫
+    串流回應可能在開始前就被丟棄（例如客戶端已斷線），超過期限後自動釋放，名額不會永久遺失
+    """
+
+    RELEASE_GRACE_SECONDS = 1
+
+    def __init__(self, gate, deadline):
+        self._gate = gate
+        self.deadline = deadline
+        self._released = False
+        self._timer = asyncio.get_running_loop().call_at(deadline + self.RELEASE_GRACE_SECONDS, self.release)
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._timer.cancel()
+        self._gate.in_flight -= 1
+        self._gate._semaphore.release()
+
+
+class LLMGate:
+    """
+    限制同時進行的 LLM 呼叫數
+    - 最多 max_concurrency 個呼叫同時進行，其餘排隊
+    - 排隊人數達 max_queue 時直接拒絕 (429)，排隊超過 queue_timeout 秒放棄 (503)
+    - 每個請求從開始排隊算起最多 deadline 秒 (504)
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE,
+                 queue_timeout=LLM_QUEUE_TIMEOUT, deadline=LLM_DEADLINE):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.deadline = deadline
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats = {"admitted": 0, "rejected_queue_full": 0, "rejected_queue_timeout": 0,
+                      "deadline_exceeded": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+    async def acquire(self):
+        """
+        取得一個 LLM 呼叫名額，回傳 LLMSlot；用完務必呼叫 release()
+        串流回應在送出 HTTP 標頭前先取得名額，忙碌時才能直接回 429/503
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self.stats["rejected_queue_full"] += 1
+                raise LLMQueueFull(retry_after=max(1, round(self.queue_timeout)))
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=min(self.queue_timeout, self.deadline))
+            except asyncio.TimeoutError:
+                self.stats["rejected_queue_timeout"] += 1
+                raise LLMQueueTimeout(retry_after=max(1, round(self.queue_timeout)))
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
+        wait_ms = (loop.time() - started) * 1000
+        self.stats["admitted"] += 1
+        self.stats["wait_ms_total"] += wait_ms
+        self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], wait_ms)
+        self.in_flight += 1
+        return LLMSlot(self, started + self.deadline)
+
+    @asynccontextmanager
+    async def slot(self):
+        """取得一個 LLM 呼叫名額；回傳這個請求的截止時間 (loop.time())"""
+        slot = await self.acquire()
+        try:
+            yield slot.deadline
+        finally:
+            slot.release()
+
+    async def call(self, fn, *args):
+        """在名額內執行 await fn(*args)，超過期限時取消並丟出 LLMDeadlineExceeded"""
+        async with self.slot() as deadline:
+            try:
+                return await asyncio.wait_for(fn(*args), timeout=self._remaining(deadline))
+            except asyncio.TimeoutError:
+                self.stats["deadline_exceeded"] += 1
+                raise LLMDeadlineExceeded()
+
+    async def stream(self, aiter, slot=None):
+        """
+        在名額內逐一取出非同步串流的內容，整個串流共用同一個期限
+        slot 為事先以 acquire() 取得的名額，串流結束後由這裡釋放
+        """
+        if slot is None:
+            slot = await self.acquire()
+        iterator = aiter.__aiter__()
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(iterator.__anext__(), timeout=self._remaining(slot.deadline))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    self.stats["deadline_exceeded"] += 1
+                    raise LLMDeadlineExceeded()
+                yield item
+        finally:
+            slot.release()
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    def status(self):
+        admitted = self.stats["admitted"]
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "deadline": self.deadline,
+            "admitted": admitted,
+            "rejected_queue_full": self.stats["rejected_queue_full"],
+            "rejected_queue_timeout": self.stats["rejected_queue_timeout"],
+            "deadline_exceeded": self.stats["deadline_exceeded"],
+            "wait_ms_avg": round(self.stats["wait_ms_total"] / admitted, 2) if admitted else 0.0,
+            "wait_ms_max": round(self.stats["wait_ms_max"], 2),
+        }
+
+    @staticmethod
+    def _remaining(deadline):
+        return max(deadline - asyncio.get_running_loop().time(), 0.001)
@@ -0,0 +1,558 @@
+"""
+後端壓力測試
+1. seed：在本機 MySQL 的獨立資料庫中建立資料表並灌入假的使用者、貼文、點讚、留言與通知
+2. run：以該資料庫與本地假 LLM (RAG_LLM=stub) 啟動伺服器，依流量組合送出請求，
+   回報每個路由的吞吐量與延遲分位數，以及連線池與 LLM 佇列的使用狀況
+
+    python loadtest.py seed --users 2000 --posts 5000
+    python loadtest.py run --profile mixed --concurrency 50 --duration 60 --llm-delay 1.5
+    python loadtest.py run --url http://127.0.0.1:8000 ...    # 對已啟動的伺服器施壓
+
+伺服器指標 (/metrics、/api/health/*) 只反映單一行程，量測時建議以一個 worker 啟動
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import mysql.connector
+
+from db import DB_CONFIG
+from post_counters import reconcile_post_counters
+
+LOADTEST_DB_NAME = os.getenv("LOADTEST_DB_NAME", "igrow_loadtest")
+SEED_CHUNK = 1000
+DEPTS = ("General", "Engineering", "Manufacturing", "HR", "Finance", "IT")
+NOTIFICATION_TYPES = ("info", "success", "warning", "error")
+MOODS = ("Very Sad", "Not So Good", "Okay", "Pretty Good", "Very Happy")
+# 不在 FAQ 中的問題；送出前再加上隨機的情境，讓每一題都不同
+FREE_QUESTIONS = (
+    "最近工作壓力很大，有什麼紓壓的方法嗎？",
+    "我想轉調到其他部門，應該先找誰討論？",
+    "新人第一個月應該把重點放在哪裡？",
+    "和主管溝通意見不合時該怎麼辦？",
+    "有推薦的時間管理技巧嗎？",
+)
+# 加在問題前後的情境，使 FAQ 問句不會直接命中 FAQ、回覆快取也對不上
+QUESTION_PREFIXES = ("想請教一下，", "不好意思打擾，", "我是{dept}部門的新人，", "我在公司第{years}年了，", "")
+QUESTION_SUFFIXES = ("我目前負責的專案編號是 {code}。", "另外我下週要和主管面談，想先準備。",
+                     "我在 {site} 廠區上班。", "（第 {n} 次詢問）")
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS users (
+        id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        email VARCHAR(255) NOT NULL,
+        password_hash VARCHAR(255) NOT NULL,
+        role VARCHAR(50) NOT NULL DEFAULT 'Member',
+        dept VARCHAR(100) NOT NULL DEFAULT 'General',
+        avatar_url VARCHAR(500) DEFAULT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        KEY idx_dept (dept)
+    ) DEFAULT CHARSET=utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS posts (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        author_id INT UNSIGNED NOT NULL,
+        content TEXT NOT NULL,
+        image_url VARCHAR(500) DEFAULT NULL,
+        likes_count INT DEFAULT 0,
+        comments_count INT DEFAULT 0,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        KEY idx_author_id (author_id),
+        KEY idx_created_at_id (created_at, id)
+    ) DEFAULT CHARSET=utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS post_likes (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        post_id INT NOT NULL,
+        user_id INT UNSIGNED NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE KEY unique_user_post_like (post_id, user_id),
+        KEY user_id (user_id)
+    ) DEFAULT CHARSET=utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS post_comments (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        post_id INT NOT NULL,
+        user_id INT UNSIGNED NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        KEY user_id (user_id),
+        KEY idx_post_created_at (post_id, created_at, id)
+    ) DEFAULT CHARSET=utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS notifications (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id INT NOT NULL,
+        title VARCHAR(255) NOT NULL,
+        message TEXT NOT NULL,
+        type ENUM('info', 'success', 'warning', 'error') DEFAULT 'info',
+        is_read BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        INDEX idx_user_id (user_id),
+        INDEX idx_user_read_created (user_id, is_read, created_at),
+        INDEX idx_user_created_id (user_id, created_at, id)
+    ) DEFAULT CHARSET=utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS mood_entries (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id INT NOT NULL,
+        mood_score INT NOT NULL,
+        entry_date DATE NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE KEY unique_user_entry_date (user_id, entry_date)
+    ) DEFAULT CHARSET=utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS user_points (
+        user_id INT NOT NULL PRIMARY KEY,
+        points INT NOT NULL DEFAULT 0
+    ) DEFAULT CHARSET=utf8mb4""",
+)
+SEED_TABLES = ("post_likes", "post_comments", "notifications", "mood_entries", "user_points", "posts", "users")
+
+
+# --- 假資料 ---
+
+def connect(database):
+    return mysql.connector.connect(**{**DB_CONFIG, "database": database})
+
+
+def insert_chunked(conn, query, rows):
+    cursor = conn.cursor()
+    try:
+        for start in range(0, len(rows), SEED_CHUNK):
+            cursor.executemany(query, rows[start:start + SEED_CHUNK])
+            conn.commit()
+    finally:
+        cursor.close()
+
+
+def random_time(rng, days):
+    return datetime.now() - timedelta(seconds=rng.uniform(0, days * 86400))
+
+
+def seed(database, users, posts, likes_per_post, comments_per_post, notifications_per_user, days, reset, seed_value):
+    """建立資料表並灌入假資料；reset=True 時先清空既有資料"""
+    rng = random.Random(seed_value)
+    server = mysql.connector.connect(**{**DB_CONFIG, "database": None})
+    try:
+        cursor = server.cursor()
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{database}` DEFAULT CHARACTER SET utf8mb4")
+        cursor.close()
+    finally:
+        server.close()
+
+    conn = connect(database)
+    try:
+        cursor = conn.cursor()
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        if reset:
+            for table in SEED_TABLES:
+                cursor.execute(f"TRUNCATE TABLE {table}")
+        conn.commit()
+        cursor.close()
+
+        started = time.perf_counter()
+        insert_chunked(conn, "INSERT INTO users (id, name, email, password_hash, dept) VALUES (%s, %s, %s, %s, %s)", [
+            (user_id, f"user{user_id}", f"user{user_id}@loadtest.local", "x", rng.choice(DEPTS))
+            for user_id in range(1, users + 1)
+        ])
+        insert_chunked(conn, "INSERT INTO posts (id, author_id, content, created_at) VALUES (%s, %s, %s, %s)", [
+            (post_id, rng.randint(1, users), f"壓力測試貼文 #{post_id}：" + "今天的學習心得分享。" * rng.randint(1, 5),
+             random_time(rng, days))
+            for post_id in range(1, posts + 1)
+        ])
+
+        likes = []
+        comments = []
+        for post_id in range(1, posts + 1):
+            # 少數貼文特別熱門，接近真實的長尾分布
+            count = min(users, int(rng.expovariate(1 / likes_per_post))) if likes_per_post else 0
+            likes.extend((post_id, user_id, random_time(rng, days)) for user_id in rng.sample(range(1, users + 1), count))
+            count = int(rng.expovariate(1 / comments_per_post)) if comments_per_post else 0
+            comments.extend((post_id, rng.randint(1, users), f"留言 {i + 1}", random_time(rng, days)) for i in range(count))
+        insert_chunked(conn, "INSERT INTO post_likes (post_id, user_id, created_at) VALUES (%s, %s, %s)", likes)
+        insert_chunked(conn, "INSERT INTO post_comments (post_id, user_id, content, created_at) VALUES (%s, %s, %s, %s)",
+                       comments)
+        reconcile_post_counters(conn)
+
+        notifications = [
+            (user_id, f"通知 {i + 1}", "這是壓力測試用的通知。", rng.choice(NOTIFICATION_TYPES), rng.random() < 0.7,
+             random_time(rng, days))
+            for user_id in range(1, users + 1) for i in range(notifications_per_user)
+        ]
+        insert_chunked(conn, "INSERT INTO notifications (user_id, title, message, type, is_read, created_at) "
+                             "VALUES (%s, %s, %s, %s, %s, %s)", notifications)
+
+        print(f"已建立假資料於 '{database}': {users} 位使用者、{posts} 篇貼文、{len(likes)} 個讚、"
+              f"{len(comments)} 則留言、{len(notifications)} 則通知 ({time.perf_counter() - started:.1f} 秒)")
+    finally:
+        conn.close()
+
+
+# --- 流量組合 ---
+
+def load_faq_questions():
+    questions = []
+    data_path = "data"
+    for name in sorted(os.listdir(data_path)):
+        if name.endswith(".txt"):
+            with open(os.path.join(data_path, name), encoding="utf-8") as f:
+                questions += [q.strip() for q in re.findall(r"Q[:：]\s*(.+)", f.read())]
+    return questions
+
+
+class Scenario:
+    """產生一個模擬使用者的請求；每個方法回傳 (路由名稱, method, path, params, json)"""
+
+    def __init__(self, rng, users, posts, faq_questions, faq_ratio):
+        self.rng = rng
+        self.users = users
+        self.posts = posts
+        self.faq_questions = faq_questions
+        self.questions = faq_questions + list(FREE_QUESTIONS)
+        self.faq_ratio = faq_ratio
+        self.user_id = rng.randint(1, users)
+        self.session_id = f"loadtest-{self.user_id}-{rng.getrandbits(32):08x}"
+        self.feed_cursor = None
+
+    def hot_post(self):
+        # 偏向最近的貼文，製造熱點
+        return max(1, self.posts - int(self.rng.expovariate(1 / max(self.posts / 20, 1))))
+
+    def chat_message(self):
+        """faq_ratio 的比例送出原本的 FAQ 問句（走 FAQ 快速路徑），其餘加上隨機情境，一定要經過檢索與 LLM"""
+        if self.faq_questions and self.rng.random() < self.faq_ratio:
+            return self.rng.choice(self.faq_questions)
+        rng = self.rng
+        context = {"dept": rng.choice(DEPTS), "years": rng.randint(1, 15), "code": f"P{rng.randint(1000, 99999)}",
+                   "site": rng.choice(("新竹", "台中", "台南", "高雄")), "n": rng.randint(2, 999)}
+        return (rng.choice(QUESTION_PREFIXES).format(**context) + rng.choice(self.questions)
+                + rng.choice(QUESTION_SUFFIXES).format(**context))
+
+    def chat(self):
+        body = {"message": self.chat_message(), "session_id": self.session_id, "user_id": self.user_id,
+                "mood": self.rng.choice(MOODS) if self.rng.random() < 0.2 else None}
+        return "POST /api/chat", "POST", "/api/chat", None, body
+
+    def feed(self):
+        # 多數人只看第一頁，部分人往下捲
+        if self.feed_cursor is None or self.rng.random() < 0.6:
+            params = {"limit": 20, "user_id": self.user_id}
+        else:
+            params = {"limit": 20, "user_id": self.user_id, "cursor": self.feed_cursor}
+        return "GET /api/posts/feed", "GET", "/api/posts/feed", params, None
+
+    def comments(self):
+        post_id = self.hot_post()
+        return "GET /api/posts/{post_id}/comments", "GET", f"/api/posts/{post_id}/comments", None, None
+
+    def comment(self):
+        post_id = self.hot_post()
+        return ("POST /api/posts/{post_id}/comments", "POST", f"/api/posts/{post_id}/comments",
+                {"user_id": self.user_id}, {"content": "壓力測試留言"})
+
+    def like(self):
+        post_id = self.hot_post()
+        return ("POST /api/posts/{post_id}/like", "POST", f"/api/posts/{post_id}/like",
+                {"user_id": self.user_id}, None)
+
+    def dashboard_notifications(self):
+        return "GET /api/dashboard/notifications", "GET", "/api/dashboard/notifications", {"limit": 3}, None
+
+    def popular_posts(self):
+        return "GET /api/dashboard/popular-posts", "GET", "/api/dashboard/popular-posts", {"limit": 3}, None
+
+    def unread_count(self):
+        return ("GET /api/notifications/unread-count", "GET", "/api/notifications/unread-count",
+                {"user_id": self.user_id}, None)
+
+    def notifications(self):
+        return "GET /api/notifications", "GET", "/api/notifications", {"user_id": self.user_id, "limit": 20}, None
+
+    def points(self):
+        return "GET /api/points", "GET", "/api/points", {"user_id": self.user_id}, None
+
+
+# 每種流量組合中各動作的權重
+PROFILES = {
+    "mixed": {"chat": 10, "feed": 25, "comments": 10, "comment": 3, "like": 12, "dashboard_notifications": 15,
+              "popular_posts": 10, "unread_count": 10, "notifications": 3, "points": 2},
+    "chat": {"chat": 1},
+    "feed": {"feed": 6, "comments": 3, "like": 1},
+    "dashboard": {"dashboard_notifications": 4, "popular_posts": 3, "unread_count": 3, "points": 1},
+    "likes": {"like": 8, "comment": 1, "feed": 1},
+}
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = defaultdict(int)
+
+    def summary(self, duration):
+        ordered = sorted(self.latencies)
+        count = len(ordered)
+        pick = lambda p: round(ordered[min(count - 1, max(0, math.ceil(p / 100 * count) - 1))], 2) if count else 0.0
+        errors = sum(n for status, n in self.statuses.items() if not 200 <= status < 300)
+        return {
+            "requests": count,
+            "rps": round(count / duration, 2),
+            "errors": errors,
+            "statuses": {str(status): n for status, n in sorted(self.statuses.items())},
+            "p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99),
+            "max_ms": round(ordered[-1], 2) if count else 0.0,
+        }
+
+
+def parse_metric_sums(text, name):
+    """從 /metrics 取出某個 histogram 依 query 標籤的 (sum, count)"""
+    sums = defaultdict(lambda: [0.0, 0])
+    pattern = re.compile(rf'^{name}_(sum|count)\{{query="([^"]*)"\}} (\S+)$')
+    for line in text.splitlines():
+        match = pattern.match(line)
+        if match:
+            kind, query, value = match.groups()
+            sums[query][0 if kind == "sum" else 1] += float(value)
+    return sums
+
+
+class ServerSampler:
+    """每 interval 秒讀取一次連線池與 LLM 佇列狀態"""
+
+    def __init__(self, client, interval=0.5):
+        self.client = client
+        self.interval = interval
+        self.samples = []
+
+    async def run(self):
+        while True:
+            try:
+                db, llm = await asyncio.gather(self.client.get("/api/health/db"), self.client.get("/api/health/llm"))
+                self.samples.append((db.json(), llm.json()))
+            except Exception:
+                pass
+            await asyncio.sleep(self.interval)
+
+    def summary(self, before, after):
+        in_use = [db["in_use"] for db, _ in self.samples]
+        in_flight = [llm["in_flight"] for _, llm in self.samples]
+        waiting = [llm["waiting"] for _, llm in self.samples]
+        result = {
+            "db_pool": {
+                "size": after["db"]["size"],
+                "opened": after["db"]["opened"],
+                "in_use_avg": round(sum(in_use) / len(in_use), 2) if in_use else 0.0,
+                "in_use_max": max(in_use, default=0),
+                "acquired": after["db"]["acquired"] - before["db"]["acquired"],
+                "timeouts": after["db"]["timeouts"] - before["db"]["timeouts"],
+                "wait_ms_max": after["db"]["wait_ms_max"],
+            },
+            "llm": {
+                "in_flight_max": max(in_flight, default=0),
+                "waiting_max": max(waiting, default=0),
+                "admitted": after["llm"]["admitted"] - before["llm"]["admitted"],
+                "rejected_queue_full": after["llm"]["rejected_queue_full"] - before["llm"]["rejected_queue_full"],
+                "rejected_queue_timeout": (after["llm"]["rejected_queue_timeout"]
+                                           - before["llm"]["rejected_queue_timeout"]),
+                "deadline_exceeded": after["llm"]["deadline_exceeded"] - before["llm"]["deadline_exceeded"],
+            },
+        }
+        # 每種資料庫工作佔用連線的總秒數（借到連線後到歸還），對應到各路由的內部函式
+        db_time = {}
+        for query, (total, count) in after["db_query"].items():
+            base_total, base_count = before["db_query"].get(query, (0.0, 0))
+            if count > base_count:
+                db_time[query] = {"calls": int(count - base_count), "connection_seconds": round(total - base_total, 3),
+                                  "avg_ms": round((total - base_total) / (count - base_count) * 1000, 2)}
+        result["db_queries"] = dict(sorted(db_time.items(), key=lambda item: -item[1]["connection_seconds"]))
+        return result
+
+
+async def server_snapshot(client):
+    db, llm, metrics_text = await asyncio.gather(
+        client.get("/api/health/db"), client.get("/api/health/llm"), client.get("/metrics"))
+    return {"db": db.json(), "llm": llm.json(),
+            "db_query": dict(parse_metric_sums(metrics_text.text, "db_query_duration_seconds"))}
+
+
+async def drive(url, profile, concurrency, duration, users, posts, think_ms, timeout, seed_value, faq_ratio):
+    import httpx  # 只有壓力測試需要
+
+    weights = PROFILES[profile]
+    actions, action_weights = list(weights), list(weights.values())
+    faq_questions = load_faq_questions()
+    stats = defaultdict(RouteStats)
+    chat_sources = defaultdict(RouteStats)  # 聊天回覆來源 (faq/cache/llm) 各自的延遲
+    master = random.Random(seed_value)
+
+    limits = httpx.Limits(max_connections=concurrency + 4, max_keepalive_connections=concurrency + 4)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        before = await server_snapshot(client)
+        sampler = ServerSampler(client)
+        sampler_task = asyncio.create_task(sampler.run())
+        deadline = time.perf_counter() + duration
+
+        async def user_loop(rng):
+            scenario = Scenario(rng, users, posts, faq_questions, faq_ratio)
+            while time.perf_counter() < deadline:
+                action = rng.choices(actions, action_weights)[0]
+                route, method, path, params, body = getattr(scenario, action)()
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, params=params, json=body,
+                                                    headers={"X-User-ID": str(scenario.user_id)})
+                    status = response.status_code
+                    if action == "feed" and status == 200:
+                        scenario.feed_cursor = response.json().get("next_cursor")
+                    source = response.json().get("source", "error") if action == "chat" and status == 200 else None
+                except httpx.TimeoutException:
+                    status, source = 599, None
+                except httpx.HTTPError:
+                    status, source = 598, None
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                stats[route].latencies.append(elapsed_ms)
+                stats[route].statuses[status] += 1
+                if action == "chat":
+                    source = source or f"http_{status}"
+                    chat_sources[source].latencies.append(elapsed_ms)
+                    chat_sources[source].statuses[status] += 1
+                if think_ms:
+                    await asyncio.sleep(rng.expovariate(1000 / think_ms))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user_loop(random.Random(master.random())) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        sampler_task.cancel()
+        after = await server_snapshot(client)
+
+    total = RouteStats()
+    for route_stats in stats.values():
+        total.latencies += route_stats.latencies
+        for status, n in route_stats.statuses.items():
+            total.statuses[status] += n
+    return {
+        "config": {"url": url, "profile": profile, "concurrency": concurrency, "duration": round(elapsed, 2),
+                   "think_ms": think_ms},
+        "routes": {route: route_stats.summary(elapsed) for route, route_stats in sorted(stats.items())},
+        "total": total.summary(elapsed),
+        "chat_sources": {source: source_stats.summary(elapsed) for source, source_stats in sorted(chat_sources.items())},
+        "server": sampler.summary(before, after),
+    }
+
+
+def start_server(port, database, llm_delay, workers, cache):
+    """以壓力測試資料庫與假 LLM 啟動伺服器；預設關閉回覆快取，讓聊天流量確實經過 LLM"""
+    env = {**os.environ, "DB_NAME": database, "RAG_LLM": "stub", "LLM_STUB_DELAY": str(llm_delay),
+           "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING")}
+    if not cache:
+        env["CHAT_CACHE_SIZE"] = "0"
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+                             "--workers", str(workers), "--no-access-log"], env=env)
+
+
+async def wait_until_ready(url, timeout, need_rag):
+    import httpx
+
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient(base_url=url, timeout=5) as client:
+        while time.perf_counter() < deadline:
+            try:
+                response = await client.get("/api/health/ready")
+                if response.status_code == 200 and (not need_rag or response.json()["rag"]["ready"]):
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise SystemExit(f"伺服器在 {timeout} 秒內沒有就緒")
+
+
+def print_report(results):
+    config = results["config"]
+    print(f"流量組合: {config['profile']}，併發 {config['concurrency']}，{config['duration']} 秒")
+    print(f"{'路由':40}{'請求':>8}{'RPS':>9}{'錯誤':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for route, row in list(results["routes"].items()) + [("總計", results["total"])]:
+        print(f"{route:40}{row['requests']:>8}{row['rps']:>9.1f}{row['errors']:>7}"
+              f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+
+    if results["chat_sources"]:
+        # 聊天回覆的來源比例：faq / cache 不經過 LLM，llm 才會量到檢索與 LLM 佇列
+        print("聊天回覆來源: " + "，".join(
+            f"{source} {row['requests']} 次 (p50 {row['p50_ms']:.1f} ms, p95 {row['p95_ms']:.1f} ms)"
+            for source, row in results["chat_sources"].items()))
+
+    pool, llm = results["server"]["db_pool"], results["server"]["llm"]
+    print(f"連線池: 使用中平均 {pool['in_use_avg']} / 最高 {pool['in_use_max']} / 上限 {pool['size']}，"
+          f"借用 {pool['acquired']} 次，逾時 {pool['timeouts']} 次，最長等待 {pool['wait_ms_max']} ms")
+    print(f"LLM: 進行中最高 {llm['in_flight_max']}，排隊最高 {llm['waiting_max']}，"
+          f"拒絕 {llm['rejected_queue_full'] + llm['rejected_queue_timeout']} 次，逾時 {llm['deadline_exceeded']} 次")
+    for query, row in list(results["server"]["db_queries"].items())[:10]:
+        print(f"  {query:38}{row['calls']:>8} 次{row['connection_seconds']:>10.2f} 連線秒{row['avg_ms']:>10.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="後端壓力測試")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="建立壓力測試資料庫並灌入假資料")
+    seed_parser.add_argument("--database", default=LOADTEST_DB_NAME)
+    seed_parser.add_argument("--users", type=int, default=1000)
+    seed_parser.add_argument("--posts", type=int, default=5000)
+    seed_parser.add_argument("--likes-per-post", type=float, default=8, help="每篇貼文平均的讚數")
+    seed_parser.add_argument("--comments-per-post", type=float, default=3, help="每篇貼文平均的留言數")
+    seed_parser.add_argument("--notifications-per-user", type=int, default=30)
+    seed_parser.add_argument("--days", type=int, default=30, help="資料的時間分布範圍")
+    seed_parser.add_argument("--reset", action="store_true", help="先清空既有資料")
+    seed_parser.add_argument("--seed", type=int, default=42)
+
+    run_parser = commands.add_parser("run", help="送出流量並回報結果")
+    run_parser.add_argument("--url", help="已啟動的伺服器；不指定時自動以假 LLM 啟動一個")
+    run_parser.add_argument("--database", default=LOADTEST_DB_NAME)
+    run_parser.add_argument("--port", type=int, default=8765)
+    run_parser.add_argument("--workers", type=int, default=1)
+    run_parser.add_argument("--llm-delay", type=float, default=1.0, help="假 LLM 每次回覆的延遲（秒）")
+    run_parser.add_argument("--cache", action="store_true", help="保留伺服器的回覆快取（預設關閉）")
+    run_parser.add_argument("--faq-ratio", type=float, default=0.1, help="原封不動送出 FAQ 問句的比例")
+    run_parser.add_argument("--profile", choices=sorted(PROFILES), default="mixed")
+    run_parser.add_argument("--concurrency", type=int, default=20, help="同時模擬的使用者數")
+    run_parser.add_argument("--duration", type=float, default=30)
+    run_parser.add_argument("--think-ms", type=float, default=0, help="每個使用者兩次請求之間的平均間隔")
+    run_parser.add_argument("--users", type=int, default=1000, help="需與 seed 時相同")
+    run_parser.add_argument("--posts", type=int, default=5000, help="需與 seed 時相同")
+    run_parser.add_argument("--timeout", type=float, default=60)
+    run_parser.add_argument("--ready-timeout", type=float, default=300)
+    run_parser.add_argument("--output", help="把完整結果寫成 JSON")
+    run_parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        seed(args.database, args.users, args.posts, args.likes_per_post, args.comments_per_post,
+             args.notifications_per_user, args.days, args.reset, args.seed)
+        sys.exit(0)
+
+    server = None
+    url = args.url
+    if url is None:
+        server = start_server(args.port, args.database, args.llm_delay, args.workers, args.cache)
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        asyncio.run(wait_until_ready(url, args.ready_timeout, need_rag="chat" in PROFILES[args.profile]))
+        results = asyncio.run(drive(url, args.profile, args.concurrency, args.duration, args.users, args.posts,
+                                    args.think_ms, args.timeout, args.seed, args.faq_ratio))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
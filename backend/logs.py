@@ -0,0 +1,89 @@
+import os
+import sys
+import copy
+import json
+import queue
+import random
+import logging
+import logging.handlers
+import atexit
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json 或 text
+# DEBUG 紀錄只保留一部分，開著 DEBUG 也不會讓熱路徑被輸出拖慢
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.1))
+
+
+class JsonFormatter(logging.Formatter):
+    """一行一筆 JSON；extra={"fields": {...}} 的內容會攤平放進去"""
+
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class SampleFilter(logging.Filter):
+    """DEBUG 紀錄依 rate 抽樣，INFO 以上全部保留"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 同一個行程內傳遞，不需要序列化；保留 exc_info 與 fields 交給輸出端格式化
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _configure():
+    root = logging.getLogger("igrow")
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "text":
+        handler.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        handler.setFormatter(JsonFormatter())
+
+    # 實際寫出交給背景執行緒，event loop 只負責把紀錄丟進佇列
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(LOG_DEBUG_SAMPLE_RATE))
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return root
+
+
+_root = _configure()
+
+
+def get_logger(name):
+    return _root.getChild(name)
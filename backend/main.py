@@ -1,24 +1,37 @@
 import os
+import json
+import base64
+import time
+import asyncio
 import uvicorn
 import mysql.connector
-from datetime import date
+from datetime import date, datetime
 from typing import Optional
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 #from langchain_groq import ChatGroq
-from langchain_openai import ChatOpenAI
-from langchain_community.vectorstores import Chroma
-from langchain.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
-from langchain_huggingface import HuggingFaceEmbeddings
 from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+from db import db_pool, PoolTimeout, DatabaseUnavailable
+from mood_writer import MoodWriter
+from post_counters import CounterReconciler
+from trending import TrendingPosts
+from cache import user_cache
+from notify_hub import notification_hub
+from rag import rag_service
+from chat_history import ChatHistoryManager
+from llm_gate import LLMGate, LLMBusy
+from logs import get_logger
+import metrics
 
 # --- 初始化 ---
 load_dotenv()
 app = FastAPI()
+log = get_logger("main")
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,21 +41,65 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-DB_CONFIG = {
-    'host': os.getenv("DB_HOST"),
-    'user': os.getenv("DB_USER"),
-    'password': os.getenv("DB_PASSWORD"),
-    'database': os.getenv("DB_NAME"), # <--- 已修正為 DB_NAME
-}
-
-# 取得資料庫連線
-def get_db_connection():
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """依路由樣板（而不是實際路徑）記錄每個請求的處理時間"""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - started, method=request.method, route=route_template(request), status=status
+        )
+
+def route_template(request):
+    route = request.scope.get("route")
+    if route is None:
+        for candidate in app.router.routes:
+            if candidate.matches(request.scope)[0] == Match.FULL:
+                route = candidate
+                break
+    # 沒有對應路由的請求合併成一類，避免指標數量失控
+    return getattr(route, "path", "unmatched")
+
+# 在共用連線池中執行資料庫工作
+async def run_db(fn, *args):
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        return conn
-    except mysql.connector.Error as err:
-        print(f"資料庫連線失敗: {err}")
-        return None
+        return await db_pool.run(fn, *args)
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="資料庫忙碌中，請稍後再試")
+    except DatabaseUnavailable:
+        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+
+def update_points_cache(totals):
+    # 心情寫入後直接把最新總積分放進快取
+    for user_id, points in totals.items():
+        user_cache.set(user_cache.points_key(user_id), points)
+
+# 心情與積分在背景批次寫入，不佔用聊天請求的時間
+mood_writer = MoodWriter(db_pool, on_written=update_points_cache)
+
+# 定期依點讚/留言資料表校正貼文上的計數
+counter_reconciler = CounterReconciler(db_pool)
+# Dashboard 熱門貼文排行，點讚與留言時增量更新
+trending_posts = TrendingPosts(db_pool)
+
+@app.on_event("startup")
+async def start_mood_writer():
+    mood_writer.start()
+    counter_reconciler.start()
+    trending_posts.start()
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    # 先把還在佇列中的心情紀錄寫完再關閉連線池
+    await counter_reconciler.stop()
+    await trending_posts.stop()
+    await mood_writer.stop()
+    db_pool.close()
 
 # 改進的用戶認證依賴
 from fastapi import Header
@@ -72,6 +129,34 @@ MOOD_TO_SCORE = {
     'Very Happy': 5
 }
 
+# 經過的分鐘數一律由資料庫算：SELECT TIMESTAMPDIFF(MINUTE, created_at, NOW()) AS age_minutes
+# 應用程式與資料庫的時區或時鐘不一致時，標籤才不會出現負數或整段位移
+AGE_MINUTES = "TIMESTAMPDIFF(MINUTE, created_at, NOW()) AS age_minutes"
+
+def format_relative_time(minutes, just_now=False):
+    """把經過的分鐘數轉成「X 分鐘前 / X 小時前 / X 天前」；just_now=True 時不到一分鐘顯示「剛剛」"""
+    minutes = max(int(minutes or 0), 0)
+    if just_now and minutes < 1:
+        return "剛剛"
+    if minutes < 60:
+        return f"{minutes} 分鐘前"
+    if minutes < 24 * 60:
+        return f"{minutes // 60} 小時前"
+    return f"{minutes // (24 * 60)} 天前"
+
+# keyset 分頁游標：(created_at, id) 編成不透明字串
+def encode_cursor(created_at, row_id):
+    raw = json.dumps([created_at.isoformat(), row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="無效的分頁游標")
+
 # --- 資料模型 ---
 class Message(BaseModel):
     sender: str  # "user" or "bot"
@@ -82,103 +167,27 @@ class ChatRequest(BaseModel):
     session_id: str = Field(..., description="追蹤同一個對話的唯一ID")
     user_id: int = Field(..., description="用戶ID")
     mood: Optional[str] = None
-    chat_history: Optional[list[Message]] = Field(default=[], description="當前對話歷史")
+    chat_history: Optional[list[Message]] = Field(default=[], description="當前對話歷史（伺服器已保存該 session 時可省略）")
 
 class LoginRequest(BaseModel):
     email: str
     password: str
 
 # --- RAG 核心元件 ---
-try:
-    print("正在初始化 RAG 鏈...")
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    db = Chroma(persist_directory="chroma_db", embedding_function=embeddings)
-    retriever = db.as_retriever(search_kwargs={"k": 20})
-    llm = ChatOpenAI(temperature=0.7, model_name="gpt-4o")
-    
-
-
-    qa_system_prompt ="""
-    你是一位服務於 iGrow & iCare 系統的專業 AI 助理，名叫小黑 🐾。
-    你的核心人格是一位「善於傾聽且值得信賴的團隊夥伴」，個性積極、溫暖、從不帶有批判色彩。你的主要任務是協助員工處理職涯發展與身心健康相關的問題。
-    **黃金準則：永遠要讓使用者感覺被傾聽、被理解、被支持 (๑•̀ㅂ•́)و✧**
-    
-    **開場互動指南：**
-    你的第一句回應是建立信任的關鍵。當使用者在對話開始時選擇了心情，你的開場白「必須」將對心情的關懷與問候無縫地結合在一起，展現出你真誠的同理心。
-    
-    * 如果心情是 **Very Happy (😀) 或 Pretty Good (🙂)**：用陽光、肯定的語氣分享他們的好心情。
-      * **範例**："哇 (≧▽≦)✨ 看到您今天活力滿滿，真為您開心！希望這份好心情能持續一整天 🌞💪。請問今天有什麼我可以為您服務的嗎？"
-    
-    * 如果心情是 **Okay (😐)**：用平穩、溫和的語氣表示理解，並提供一個開放的空間。
-      * **範例**："了解了 (・ω・) 感覺今天心情平平。如果需要什麼，或只是想找人聊聊，我隨時都在哦 (｡･∀･)ﾉﾞ。請問有什麼我可以協助您的嗎？"
-    
-    * 如果心情是 **Not So Good (🙁) 或 Very Sad (😢)**：用非常溫柔、支持的語氣，優先表達關懷，讓他們感覺這裡是個安全的空間。
-      * **範例**："感覺您今天的心情似乎不太好 (つ﹏⊂)💦 希望您還好。如果您想抒發一下，我會在這裡好好聽您說 ( ´•̥̥̥ω•̥̥̥` )。請問有什麼我可以為您分擔的嗎？"
-    
-    **核心對話準則：**
-    1. **語氣與風格**：在整個對話中，請保持你口語化、親切且直接的夥伴風格 (ฅ´ω`ฅ)。避免使用過於正式或冗長的句子，盡量將每個回答控制在三句話以內。
-    2. 如果問題是你不確定，直接回覆「不知道 (；´･ω･)」，並且建議使用者至社群提問。
-    
-    上下文資訊:
-    {context}
-    """
-    qa_prompt = PromptTemplate(
-        input_variables=["context", "question", "chat_history"],
-        template=qa_system_prompt + "\n\n對話歷史:\n{chat_history}\n\n問題: {question}"
-    )
+# 模型與向量資料庫在背景初始化，非聊天 API 不必等待
+# 限制同時進行的 LLM 呼叫數；尖峰時排隊，排不進去就快速回 429/503
+llm_gate = LLMGate()
 
-    
-    def format_docs(docs):
-        return "\n\n".join(doc.page_content for doc in docs)
-
-    def enhanced_retrieval(query):
-        # # 關鍵詞映射字典
-        # keyword_mapping = {
-        #     "購股": "全球員工購股計畫",
-        #     "股票": "全球員工購股計畫",
-        #     "買股": "全球員工購股計畫",
-        #     "員工購股": "全球員工購股計畫",
-        #     "購股補助": "全球員工購股計畫",
-        #     "15%": "全球員工購股計畫",
-        #     "認購": "全球員工購股計畫",
-        #     # 可以繼續添加其他關鍵詞映射...
-        # }
-
-        enhanced_query = query
-        # for keyword, topic in keyword_mapping.items():
-        #     if keyword in query.lower():
-        #         enhanced_query = f"{query} {topic}"
-        #         break
-
-        docs = retriever.invoke(enhanced_query)
-        return docs
-
-    def get_enhanced_context(input_data):
-        question = input_data["question"]
-        docs = enhanced_retrieval(question)
-        formatted_context = format_docs(docs)
-
-        # 儲存是否使用了 RAG 的資訊
-        rag_used = len(formatted_context.strip()) > 0
-        input_data["_rag_used"] = rag_used
-
-        print(f"DEBUG: 查詢問題: {question}")
-        print(f"DEBUG: 找到文檔數量: {len(docs)}")
-        print(f"DEBUG: 格式化內容長度: {len(formatted_context.strip())}")
-        print(f"DEBUG: 使用RAG: {rag_used}")
-
-        return formatted_context
-
-    rag_chain = (
-        RunnablePassthrough.assign(context=get_enhanced_context)
-        | qa_prompt
-        | llm
-        | StrOutputParser()
-    )
-    print("無狀態 RAG 鏈已成功初始化！")
-except Exception as e:
-    print(f"初始化 RAG 鏈時發生錯誤: {e}")
-    rag_chain = None
+async def summarize_chat(summary, conversation, max_tokens):
+    # 對話摘要也是 LLM 呼叫，與聊天共用同一組名額
+    return await llm_gate.call(rag_service.summarize, summary, conversation, max_tokens)
+
+chat_histories = ChatHistoryManager(summarize_chat)
+
+@app.on_event("startup")
+async def start_rag_warm_up():
+    if os.getenv("RAG_EAGER_INIT", "true").lower() != "false":
+        asyncio.create_task(rag_service.warm_up_in_background())
 
 
 class User(BaseModel):
@@ -191,6 +200,13 @@ class NotificationCreate(BaseModel):
     message: str
     type: str = "info"  # info, success, warning, error
 
+class NotificationBroadcast(BaseModel):
+    title: str
+    message: str
+    type: str = "info"
+    user_ids: Optional[list[int]] = Field(default=None, description="收件人 ID 列表")
+    dept: Optional[str] = Field(default=None, description="發給某部門 (users.dept) 的所有人")
+
 class NotificationUpdate(BaseModel):
     read: bool = True
 
@@ -215,26 +231,24 @@ class CommentCreate(BaseModel):
 
 @app.get("/api/points")
 async def get_total_points(user_id: int = 1): # 暫時寫死 user_id=1
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
-    
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = "SELECT points FROM user_points WHERE user_id = %s"
-        cursor.execute(query, (user_id,))
-        result = cursor.fetchone()
+    def _get_total_points(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = "SELECT points FROM user_points WHERE user_id = %s"
+            cursor.execute(query, (user_id,))
+            result = cursor.fetchone()
         
-        # 如果使用者還沒有任何積分紀錄，就回傳 0
-        total_points = result['points'] if result else 0
-        return {"total_points": total_points}
+            # 如果使用者還沒有任何積分紀錄，就回傳 0
+            return result['points'] if result else 0
         
-    except mysql.connector.Error as err:
-        print(f"查詢積分失敗: {err}")
-        raise HTTPException(status_code=500, detail="查詢積分時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+        except mysql.connector.Error as err:
+            log.error("查詢積分失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢積分時發生錯誤")
+        finally:
+            cursor.close()
+
+    total_points = await user_cache.get_or_load(user_cache.points_key(user_id), lambda: run_db(_get_total_points))
+    return {"total_points": total_points}
 
 
 @app.post("/api/auth/login")
@@ -257,654 +271,1077 @@ async def read_users_me():
     # TODO: 替換為真實的使用者驗證邏輯
     return {"id": 1, "name": "Test User", "email": "test@example.com"}
 
+async def has_recorded_mood(user_id, today):
+    """今天是否已記錄過心情：先看本行程的紀錄（含佇列中尚未寫入的），沒有時再查資料庫"""
+    def _check_mood_today(conn):
+        cursor = conn.cursor(dictionary=True) # 改為 dictionary cursor
+        try:
+            # 使用正確的欄位 entry_date
+            query = "SELECT user_id FROM mood_entries WHERE user_id = %s AND entry_date = %s"
+            cursor.execute(query, (user_id, today))
+            result = cursor.fetchone()
+
+            return result is not None
+
+        except mysql.connector.Error as err:
+            log.error("查詢心情失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢心情時發生錯誤")
+        finally:
+            cursor.close()
+
+    # 已提交但還在背景佇列中尚未寫入的也算
+    if mood_writer.is_recorded(user_id, today):
+        return True
+    # 重啟後或由其他 worker 寫入的紀錄只有資料庫知道
+    has_recorded = await run_db(_check_mood_today)
+    if has_recorded:
+        mood_writer.mark_recorded(user_id, today)
+    return has_recorded
+
 @app.get("/api/mood/check")
 async def check_mood_today(user_id: int):
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    today = date.today()
+    has_recorded = await has_recorded_mood(user_id, today)
 
-    cursor = conn.cursor(dictionary=True) # 改為 dictionary cursor
-    try:
-        today = date.today()
-        # 使用正確的欄位 entry_date
-        query = "SELECT user_id FROM mood_entries WHERE user_id = %s AND entry_date = %s"
-        cursor.execute(query, (user_id, today))
-        result = cursor.fetchone()
-
-        print(f"DEBUG: 檢查用戶 {user_id} 在 {today} 的心情記錄: {'存在' if result else '不存在'}")
+    log.debug("檢查心情記錄", extra={"fields": {"user_id": user_id, "date": today, "recorded": has_recorded}})
 
-        return {"has_recorded": result is not None} # 回傳是否存在紀錄
-
-    except mysql.connector.Error as err:
-        print(f"查詢心情失敗: {err}")
-        raise HTTPException(status_code=500, detail="查詢心情時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+    return {"has_recorded": has_recorded} # 回傳是否存在紀錄
 
-@app.post("/api/chat")
-async def chat(request: ChatRequest):
+async def record_request_mood(request: ChatRequest):
+    """
+    處理聊天請求附帶的心情；回傳 (本次獲得積分, 目前總積分)
+    實際寫入交給背景的 mood_writer，這裡只回傳預估值，總積分未知時為 None
+    預估前先以資料庫確認今天是否已記錄過；查不到資料庫時本次積分也回傳 None（待寫入後才確定）
+    """
     points_earned = 0
     total_points = None
 
     if request.mood:
-        conn = get_db_connection()
-        if not conn:
-            print("資料庫連線失敗，本次心情將不會被記錄。")
-        else:
-            cursor = conn.cursor(dictionary=True)
-            today = date.today()
+        mood_score = MOOD_TO_SCORE.get(request.mood)
+        if mood_score:
             try:
-                user_id = request.user_id
-                mood_score = MOOD_TO_SCORE.get(request.mood)
-
-                if mood_score:
-                    check_query = "SELECT user_id FROM mood_entries WHERE user_id = %s AND entry_date = %s"
-                    cursor.execute(check_query, (user_id, today))
-                    existing_entry = cursor.fetchone()
-
-                    if existing_entry:
-                        update_mood_query = "UPDATE mood_entries SET mood_score = %s, created_at = CURRENT_TIMESTAMP WHERE user_id = %s AND entry_date = %s"
-                        cursor.execute(update_mood_query, (mood_score, user_id, today))
-                        print(f"使用者 {user_id} 今天的心情紀錄已更新，不加分。")
-                    else:
-                        insert_mood_query = "INSERT INTO mood_entries (user_id, mood_score, entry_date) VALUES (%s, %s, %s)"
-                        cursor.execute(insert_mood_query, (user_id, mood_score, today))
-
-                        upsert_points_query = """
-                            INSERT INTO user_points (user_id, points) VALUES (%s, 1)
-                            ON DUPLICATE KEY UPDATE points = points + 1
-                        """
-                        cursor.execute(upsert_points_query, (user_id,))
-
-                        print("DEBUG: 已執行加分 SQL 指令。")
-
-                        points_earned = 1
+                await has_recorded_mood(request.user_id, date.today())
+                known = True
+            except HTTPException:
+                known = False
+            points_earned, total_points = mood_writer.submit(request.user_id, mood_score)
+            if not known:
+                points_earned, total_points = None, None
+
+    return points_earned, total_points
+
+def build_chat_input(request: ChatRequest):
+    """將請求轉成 rag_chain 的輸入資料"""
+    # 對話歷史由伺服器依 session 保存：最近幾輪 + 較早對話的摘要
+    chat_history_text = chat_histories.render(request.user_id, request.session_id, request.chat_history,
+                                              request.message)
+
+    log.debug("對話歷史", extra={"fields": {"session_id": request.session_id, "chars": len(chat_history_text)}})
+
+    return {
+        "question": request.message,
+        "chat_history": chat_history_text
+    }
+
+def is_cacheable(request: ChatRequest, input_data):
+    """
+    回覆快取只以問題為 key，只有與對話脈絡無關的回覆才能共用：
+    有對話歷史（例如「那第二個呢？」）或有心情問候時不查也不存
+    """
+    return not input_data["chat_history"].strip() and not request.mood
 
-                    conn.commit()
+async def lookup_cached_reply(rag, question, cacheable=True):
+    """
+    查詢回覆快取；回傳 (快取內容或 None, 問題向量)，快取出錯時視為未命中
+    cacheable 為 False 時不查詢，回傳的問題向量為 None，remember_reply 也就不會存
+    """
+    if not cacheable:
+        return None, None
+    try:
+        return await run_in_threadpool(rag.response_cache.lookup, question)
+    except Exception as e:
+        log.error("查詢回覆快取失敗", extra={"fields": {"error": str(e)}})
+        return None, None
 
-                    get_total_query = "SELECT points FROM user_points WHERE user_id = %s"
-                    cursor.execute(get_total_query, (user_id,))
-                    result = cursor.fetchone()
+def remember_reply(rag, question, reply, rag_used, query_vector):
+    if query_vector is not None and reply:
+        rag.response_cache.store(question, {"reply": reply, "rag": rag_used}, query_vector)
 
-            except mysql.connector.Error as err:
-                print(f"處理心情與積分時發生錯誤: {err}")
-                conn.rollback()
-            finally:
-                cursor.close()
-                conn.close()
+@app.post("/api/chat")
+async def chat(request: ChatRequest):
+    points_earned, total_points = await record_request_mood(request)
 
     try:
-        # 格式化對話歷史
-        chat_history_text = ""
-        if request.chat_history:
-            for msg in request.chat_history:
-                role = "用戶" if msg.sender == "user" else "助理"
-                chat_history_text += f"{role}: {msg.text}\n"
+        rag = await rag_service.get()
 
         # 準備輸入資料
-        input_data = {
-            "question": request.message,
-            "chat_history": chat_history_text
-        }
-
-        print(f"DEBUG: 對話歷史長度: {len(request.chat_history) if request.chat_history else 0}")
-
-        ai_reply = rag_chain.invoke(input_data)
+        input_data = build_chat_input(request)
+
+        # 幾乎一字不差的 FAQ 問題直接回覆，不呼叫 LLM
+        faq_reply = await run_in_threadpool(rag.match_faq, request.message)
+        if faq_reply:
+            chat_histories.append_turn(request.user_id, request.session_id, request.message, faq_reply)
+            metrics.chat_replies.inc(source="faq")
+            return {
+                "reply": faq_reply,
+                "points_earned": points_earned,
+                "total_points": total_points,
+                "rag": True,
+                "source": "faq"
+            }
+
+        cached, query_vector = await lookup_cached_reply(rag, request.message, is_cacheable(request, input_data))
+        if cached:
+            chat_histories.append_turn(request.user_id, request.session_id, request.message, cached["reply"])
+            metrics.chat_replies.inc(source="cache")
+            return {
+                "reply": cached["reply"],
+                "points_earned": points_earned,
+                "total_points": total_points,
+                "rag": cached["rag"],
+                "cached": True,
+                "source": "cache"
+            }
+
+        ai_reply = await llm_gate.call(rag.rag_chain.ainvoke, input_data)
 
         # 檢查是否使用了 RAG
         rag_used = input_data.get("_rag_used", False)
 
-        print(f"DEBUG: 最終回傳 RAG 狀態: {rag_used}")
+        log.debug("回覆完成", extra={"fields": {"session_id": request.session_id, "rag_used": rag_used}})
+
+        remember_reply(rag, request.message, ai_reply, rag_used, query_vector)
+        chat_histories.append_turn(request.user_id, request.session_id, request.message, ai_reply)
+        metrics.chat_replies.inc(source="llm")
 
         return {
             "reply": ai_reply,
             "points_earned": points_earned,
             "total_points": total_points,
-            "rag": rag_used
+            "rag": rag_used,
+            "source": "llm"
         }
+    except LLMBusy as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
-        import traceback
-        print("--- 執行 RAG 鏈時發生錯誤 ---")
-        traceback.print_exc()
+        log.exception("執行 RAG 鏈時發生錯誤")
         return {"error": f"處理請求時發生錯誤: {str(e)}"}
 
+def ndjson_line(data):
+    return json.dumps(data, ensure_ascii=False, default=str) + "\n"
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    串流版本的 /api/chat，以 NDJSON 逐行回傳：
+    {"type": "token", "content": "..."} 為 AI 回覆片段，
+    最後一行 {"type": "done", "points_earned", "total_points", "rag"}，
+    發生錯誤時最後一行為 {"type": "error", "error": "..."}；
+    LLM 名額在開始回傳前取得，忙碌時直接回 429/503 與 Retry-After，
+    串流中途逾時則在錯誤訊息中帶 status (504) 與 retry_after
+    """
+    points_earned, total_points = await record_request_mood(request)
+    input_data = build_chat_input(request)
+
+    def respond(lines):
+        return StreamingResponse(
+            lines,
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    async def single_reply(reply, **done):
+        yield ndjson_line({"type": "token", "content": reply})
+        yield ndjson_line({"type": "done", "points_earned": points_earned, "total_points": total_points, **done})
+
+    async def error_reply(message):
+        yield ndjson_line({"type": "error", "error": message})
+
+    try:
+        rag = await rag_service.get()
+
+        faq_reply = await run_in_threadpool(rag.match_faq, request.message)
+        if faq_reply:
+            chat_histories.append_turn(request.user_id, request.session_id, request.message, faq_reply)
+            metrics.chat_replies.inc(source="faq")
+            return respond(single_reply(faq_reply, rag=True, source="faq"))
+
+        cached, query_vector = await lookup_cached_reply(rag, request.message, is_cacheable(request, input_data))
+        if cached:
+            chat_histories.append_turn(request.user_id, request.session_id, request.message, cached["reply"])
+            metrics.chat_replies.inc(source="cache")
+            return respond(single_reply(cached["reply"], rag=cached["rag"], cached=True, source="cache"))
+
+        # 送出 HTTP 標頭前先取得 LLM 名額，忙碌時才能回正確的狀態碼
+        slot = await llm_gate.acquire()
+    except LLMBusy as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        log.exception("串流 RAG 鏈時發生錯誤")
+        return respond(error_reply(f"處理請求時發生錯誤: {str(e)}"))
+
+    async def generate():
+        try:
+            reply_parts = []
+            async for token in llm_gate.stream(rag.rag_chain.astream(input_data), slot=slot):
+                if token:
+                    reply_parts.append(token)
+                    yield ndjson_line({"type": "token", "content": token})
+
+            rag_used = input_data.get("_rag_used", False)
+            log.debug("串流回覆完成", extra={"fields": {"session_id": request.session_id, "rag_used": rag_used}})
+
+            ai_reply = "".join(reply_parts)
+            remember_reply(rag, request.message, ai_reply, rag_used, query_vector)
+            chat_histories.append_turn(request.user_id, request.session_id, request.message, ai_reply)
+            metrics.chat_replies.inc(source="llm")
+
+            yield ndjson_line({
+                "type": "done",
+                "points_earned": points_earned,
+                "total_points": total_points,
+                "rag": rag_used,
+                "source": "llm"
+            })
+        except LLMBusy as e:
+            # 回應已經開始，無法再改 HTTP 狀態碼，改在錯誤訊息中帶上
+            yield ndjson_line({"type": "error", "error": e.detail, "status": e.status_code,
+                               "retry_after": e.retry_after})
+        except Exception as e:
+            log.exception("串流 RAG 鏈時發生錯誤")
+            yield ndjson_line({"type": "error", "error": f"處理請求時發生錯誤: {str(e)}"})
+        finally:
+            slot.release()
+
+    return respond(generate())
+
 # --- 通知 API ---
+NOTIFY_HEARTBEAT_SECONDS = float(os.getenv("NOTIFY_HEARTBEAT_SECONDS", 15))
+NOTIFY_REPLAY_LIMIT = int(os.getenv("NOTIFY_REPLAY_LIMIT", 100))
+NOTIFY_RETRY_MS = 3000
+NOTIFY_BULK_CHUNK = int(os.getenv("NOTIFY_BULK_CHUNK", 1000))
+
 @app.get("/api/notifications")
-async def get_notifications(user_id: int = 1):
-    """獲取用戶的所有通知"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+async def get_notifications(user_id: int = 1, cursor: Optional[str] = None, limit: int = 50, unread_only: bool = False):
+    """
+    獲取用戶的通知，依 (created_at, id) keyset 分頁
+    下一頁以回傳的 next_cursor 取得，沒有更多通知時為 null
+    """
+    limit = max(1, min(limit, 200))
+    after = decode_cursor(cursor) if cursor else None
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = """
-            SELECT id, user_id, title, message, type, is_read as 'read',
-                   created_at,
-                   CASE
-                       WHEN TIMESTAMPDIFF(MINUTE, created_at, NOW()) < 60
-                           THEN CONCAT(TIMESTAMPDIFF(MINUTE, created_at, NOW()), ' 分鐘前')
-                       WHEN TIMESTAMPDIFF(HOUR, created_at, NOW()) < 24
-                           THEN CONCAT(TIMESTAMPDIFF(HOUR, created_at, NOW()), ' 小時前')
-                       ELSE CONCAT(TIMESTAMPDIFF(DAY, created_at, NOW()), ' 天前')
-                   END as time
-            FROM notifications
-            WHERE user_id = %s
-            ORDER BY created_at DESC
-        """
-        cursor.execute(query, (user_id,))
-        notifications = cursor.fetchall()
-
-        return {"notifications": notifications}
-
-    except mysql.connector.Error as err:
-        print(f"查詢通知失敗: {err}")
-        raise HTTPException(status_code=500, detail="查詢通知時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+    def _get_notifications(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            conditions = ["user_id = %s"]
+            params = [user_id]
+            if unread_only:
+                conditions.append("is_read = FALSE")
+            if after is not None:
+                conditions.append("(created_at < %s OR (created_at = %s AND id < %s))")
+                params += [after[0], after[0], after[1]]
+            query = f"""
+                SELECT id, user_id, title, message, type, is_read as 'read', created_at, {AGE_MINUTES}
+                FROM notifications
+                WHERE {" AND ".join(conditions)}
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            """
+            cursor.execute(query, (*params, limit + 1))
+            return cursor.fetchall()
+
+        except mysql.connector.Error as err:
+            log.error("查詢通知失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢通知時發生錯誤")
+        finally:
+            cursor.close()
+
+    rows = await run_db(_get_notifications)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if has_more else None
+    return {
+        "notifications": [serialize_notification(row) for row in rows],
+        "next_cursor": next_cursor,
+    }
 
 @app.post("/api/notifications")
 async def create_notification(notification: NotificationCreate, user_id: int = 1):
     """創建新通知"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    def _create_notification(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = """
+                INSERT INTO notifications (user_id, title, message, type, is_read)
+                VALUES (%s, %s, %s, %s, %s)
+            """
+            cursor.execute(query, (user_id, notification.title, notification.message, notification.type, False))
+            notification_id = cursor.lastrowid
+            conn.commit()
+            user_cache.invalidate_notifications(user_id)
+
+            # 推送的內容與查詢、補送時相同：created_at 與經過時間都以資料庫時鐘為準
+            cursor.execute(f"""
+                SELECT id, user_id, title, message, type, is_read as 'read', created_at, {AGE_MINUTES}
+                FROM notifications
+                WHERE id = %s
+            """, (notification_id,))
+            return cursor.fetchone()
+
+        except mysql.connector.Error as err:
+            log.error("創建通知失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="創建通知時發生錯誤")
+        finally:
+            cursor.close()
+
+    row = await run_db(_create_notification)
+    # 推送給正在連線的客戶端
+    notification_hub.publish(user_id, serialize_notification(row))
+    return {"id": row["id"], "message": "通知創建成功"}
+
+@app.post("/api/notifications/bulk")
+async def create_notifications_bulk(broadcast: NotificationBroadcast):
+    """
+    一次發送通知給多位使用者（user_ids 或整個部門）
+    每 NOTIFY_BULK_CHUNK 筆用一次 executemany（多列 INSERT）寫入並提交，
+    每批之間歸還連線，大量發送時不會長時間佔住連線池
+    """
+    if (broadcast.user_ids is None) == (broadcast.dept is None):
+        raise HTTPException(status_code=400, detail="請指定 user_ids 或 dept 其中之一")
+
+    def _get_dept_user_ids(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT id FROM users WHERE dept = %s ORDER BY id", (broadcast.dept,))
+            return [row[0] for row in cursor.fetchall()]
+
+        except mysql.connector.Error as err:
+            log.error("查詢部門使用者失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢部門使用者時發生錯誤")
+        finally:
+            cursor.close()
+
+    def _insert_chunk(conn, user_ids, connected):
+        """寫入一批通知；回傳正在連線的收件人剛收到的通知，用來推送"""
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = """
+                INSERT INTO notifications (user_id, title, message, type, is_read)
+                VALUES (%s, %s, %s, %s, %s)
+            """
+            rows = [(user_id, broadcast.title, broadcast.message, broadcast.type, False) for user_id in user_ids]
+            cursor.executemany(query, rows)
+            # 多列 INSERT 取得連續的 id，first_id 起算 len(rows) 筆就是這一批；其他請求同時寫入的不在範圍內
+            first_id = cursor.lastrowid
+            conn.commit()
+
+            online = [user_id for user_id in user_ids if user_id in connected]
+            if not online or not first_id:
+                return []
+            placeholders = ", ".join(["%s"] * len(online))
+            cursor.execute(f"""
+                SELECT id, user_id, title, message, type, is_read as 'read', created_at, {AGE_MINUTES}
+                FROM notifications
+                WHERE id >= %s AND id < %s AND user_id IN ({placeholders})
+                ORDER BY id
+            """, (first_id, first_id + len(rows), *online))
+            return cursor.fetchall()
+
+        except mysql.connector.Error as err:
+            conn.rollback()
+            log.error("批次創建通知失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="批次創建通知時發生錯誤")
+        finally:
+            cursor.close()
+
+    if broadcast.dept is not None:
+        user_ids = await run_db(_get_dept_user_ids)
+    else:
+        user_ids = list(dict.fromkeys(broadcast.user_ids))
+
+    started = time.perf_counter()
+    inserted = 0
+    for start in range(0, len(user_ids), NOTIFY_BULK_CHUNK):
+        chunk = user_ids[start:start + NOTIFY_BULK_CHUNK]
+        try:
+            created = await run_db(_insert_chunk, chunk, notification_hub.connected_users())
+        except HTTPException as e:
+            # 已提交的批次不會回滾，回報已寫入的筆數讓呼叫端只重送剩下的
+            raise HTTPException(status_code=e.status_code, detail=f"{e.detail}（已寫入 {inserted} 筆）")
+        inserted += len(chunk)
+        user_cache.invalidate_notifications(*chunk)
+        for row in created:
+            notification_hub.publish(row["user_id"], serialize_notification(row))
+
+    elapsed = time.perf_counter() - started
+    rows_per_second = round(inserted / elapsed, 1) if elapsed > 0 else 0.0
+    log.info("批次通知寫入完成", extra={"fields": {"rows": inserted, "seconds": round(elapsed, 3), "rows_per_second": rows_per_second}})
+    return {
+        "message": "通知創建成功",
+        "inserted": inserted,
+        "chunks": -(-inserted // NOTIFY_BULK_CHUNK),
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "rows_per_second": rows_per_second,
+    }
+
+def serialize_notification(row):
+    """把通知資料列（含 age_minutes）轉成推送用的 JSON 格式"""
+    data = {key: value for key, value in row.items() if key != "age_minutes"}
+    return {
+        **data,
+        "read": bool(row["read"]),
+        "created_at": row["created_at"].isoformat(),
+        "time": format_relative_time(row["age_minutes"]),
+    }
+
+def sse_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+@app.get("/api/notifications/stream")
+async def stream_notifications(request: Request, user_id: int = 1, last_id: Optional[int] = None,
+                               last_event_id: Optional[str] = Header(None)):
+    """
+    以 Server-Sent Events 推送新通知，取代輪詢
+    只會即時收到同一個 worker 建立的通知；其他 worker 建立的通知在重連補送時才會收到
+    帶 last_id（或瀏覽器重連時自動帶的 Last-Event-ID）時，先補送 id 較大的通知再開始推送
+    連線閒置時只送心跳，不會查詢資料庫
+    """
+    if last_id is None and last_event_id:
+        try:
+            last_id = int(last_event_id)
+        except ValueError:
+            pass
+
+    def _get_missed_notifications(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = f"""
+                SELECT id, user_id, title, message, type, is_read as 'read', created_at, {AGE_MINUTES}
+                FROM notifications
+                WHERE user_id = %s AND id > %s
+                ORDER BY id
+                LIMIT %s
+            """
+            cursor.execute(query, (user_id, last_id, NOTIFY_REPLAY_LIMIT))
+            return cursor.fetchall()
 
-    cursor = conn.cursor(dictionary=True)
+        except mysql.connector.Error as err:
+            log.error("查詢遺漏通知失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢通知時發生錯誤")
+        finally:
+            cursor.close()
+
+    # 先訂閱再補資料，補送期間新增的通知才不會漏掉
+    queue = notification_hub.subscribe(user_id)
     try:
-        query = """
-            INSERT INTO notifications (user_id, title, message, type, is_read)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        cursor.execute(query, (user_id, notification.title, notification.message, notification.type, False))
-        conn.commit()
-
-        notification_id = cursor.lastrowid
-        return {"id": notification_id, "message": "通知創建成功"}
-
-    except mysql.connector.Error as err:
-        print(f"創建通知失敗: {err}")
-        raise HTTPException(status_code=500, detail="創建通知時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+        missed = await run_db(_get_missed_notifications) if last_id is not None else []
+    except BaseException:
+        notification_hub.unsubscribe(user_id, queue)
+        raise
+
+    async def generate():
+        sent_id = last_id or 0
+        try:
+            yield f"retry: {NOTIFY_RETRY_MS}\n\n"
+            for row in missed:
+                sent_id = row["id"]
+                yield sse_event("notification", serialize_notification(row), sent_id)
+
+            while not await request.is_disconnected():
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=NOTIFY_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if item is None:
+                    # 佇列滿了被中斷，客戶端會帶 Last-Event-ID 重連補資料
+                    break
+                if item["id"] <= sent_id:
+                    continue
+                sent_id = item["id"]
+                yield sse_event("notification", item, sent_id)
+        finally:
+            notification_hub.unsubscribe(user_id, queue)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.put("/api/notifications/{notification_id}")
 async def update_notification(notification_id: int, update: NotificationUpdate):
     """更新通知狀態（標記已讀）"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    def _update_notification(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            # 先取得通知擁有者，才知道要讓誰的快取失效
+            cursor.execute("SELECT user_id FROM notifications WHERE id = %s", (notification_id,))
+            owner = cursor.fetchone()
+            if owner is None:
+                raise HTTPException(status_code=404, detail="通知未找到")
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = "UPDATE notifications SET is_read = %s WHERE id = %s"
-        cursor.execute(query, (update.read, notification_id))
-        conn.commit()
+            query = "UPDATE notifications SET is_read = %s WHERE id = %s"
+            cursor.execute(query, (update.read, notification_id))
+            conn.commit()
+            user_cache.invalidate_notifications(owner['user_id'])
 
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="通知未找到")
+            return {"message": "通知更新成功"}
 
-        return {"message": "通知更新成功"}
+        except mysql.connector.Error as err:
+            log.error("更新通知失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="更新通知時發生錯誤")
+        finally:
+            cursor.close()
 
-    except mysql.connector.Error as err:
-        print(f"更新通知失敗: {err}")
-        raise HTTPException(status_code=500, detail="更新通知時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+    return await run_db(_update_notification)
 
 @app.put("/api/notifications/mark-all-read")
 async def mark_all_notifications_read(user_id: int = 1):
     """標記所有通知為已讀"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    def _mark_all_notifications_read(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = "UPDATE notifications SET is_read = TRUE WHERE user_id = %s AND is_read = FALSE"
+            cursor.execute(query, (user_id,))
+            conn.commit()
+            user_cache.invalidate_notifications(user_id)
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = "UPDATE notifications SET is_read = TRUE WHERE user_id = %s AND is_read = FALSE"
-        cursor.execute(query, (user_id,))
-        conn.commit()
+            return {"message": f"已標記 {cursor.rowcount} 個通知為已讀"}
 
-        return {"message": f"已標記 {cursor.rowcount} 個通知為已讀"}
+        except mysql.connector.Error as err:
+            log.error("更新通知失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="更新通知時發生錯誤")
+        finally:
+            cursor.close()
 
-    except mysql.connector.Error as err:
-        print(f"更新通知失敗: {err}")
-        raise HTTPException(status_code=500, detail="更新通知時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+    return await run_db(_mark_all_notifications_read)
 
 @app.get("/api/notifications/unread-count")
 async def get_unread_count(user_id: int = 1):
     """獲取未讀通知數量"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    def _get_unread_count(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = "SELECT COUNT(*) as count FROM notifications WHERE user_id = %s AND is_read = FALSE"
+            cursor.execute(query, (user_id,))
+            result = cursor.fetchone()
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = "SELECT COUNT(*) as count FROM notifications WHERE user_id = %s AND is_read = FALSE"
-        cursor.execute(query, (user_id,))
-        result = cursor.fetchone()
+            return result['count']
 
-        return {"unread_count": result['count']}
+        except mysql.connector.Error as err:
+            log.error("查詢未讀通知數量失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢未讀通知數量時發生錯誤")
+        finally:
+            cursor.close()
 
-    except mysql.connector.Error as err:
-        print(f"查詢未讀通知數量失敗: {err}")
-        raise HTTPException(status_code=500, detail="查詢未讀通知數量時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+    unread_count = await user_cache.get_or_load(user_cache.unread_key(user_id), lambda: run_db(_get_unread_count))
+    return {"unread_count": unread_count}
 
 @app.delete("/api/notifications/{notification_id}")
 async def delete_notification(notification_id: int):
     """刪除通知"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    def _delete_notification(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("SELECT user_id FROM notifications WHERE id = %s", (notification_id,))
+            owner = cursor.fetchone()
+            if owner is None:
+                raise HTTPException(status_code=404, detail="通知未找到")
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = "DELETE FROM notifications WHERE id = %s"
-        cursor.execute(query, (notification_id,))
-        conn.commit()
+            query = "DELETE FROM notifications WHERE id = %s"
+            cursor.execute(query, (notification_id,))
+            conn.commit()
+            user_cache.invalidate_notifications(owner['user_id'])
 
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="通知未找到")
+            return {"message": "通知刪除成功"}
 
-        return {"message": "通知刪除成功"}
+        except mysql.connector.Error as err:
+            log.error("刪除通知失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="刪除通知時發生錯誤")
+        finally:
+            cursor.close()
 
-    except mysql.connector.Error as err:
-        print(f"刪除通知失敗: {err}")
-        raise HTTPException(status_code=500, detail="刪除通知時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+    return await run_db(_delete_notification)
 
 # --- 社群貼文 API ---
 @app.get("/api/posts")
 async def get_posts():
     """獲取所有貼文"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    def _get_posts(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = """
+                SELECT
+                    p.id,
+                    p.author_id as authorId,
+                    p.content,
+                    p.image_url as imageUrl,
+                    p.created_at as createdAt,
+                    p.likes_count,
+                    p.comments_count,
+                    u.name as authorName,
+                    u.dept as authorDept
+                FROM posts p
+                LEFT JOIN users u ON p.author_id = u.id
+                ORDER BY p.created_at DESC
+            """
+            cursor.execute(query)
+            posts = cursor.fetchall()
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = """
-            SELECT
-                p.id,
-                p.author_id as authorId,
-                p.content,
-                p.image_url as imageUrl,
-                p.created_at as createdAt,
-                p.likes_count,
-                p.comments_count,
-                u.name as authorName,
-                u.dept as authorDept
-            FROM posts p
-            LEFT JOIN users u ON p.author_id = u.id
-            ORDER BY p.created_at DESC
-        """
-        cursor.execute(query)
-        posts = cursor.fetchall()
-
-        # 為每個貼文添加預設值
-        for post in posts:
-            post['likes'] = post['likes_count'] or 0
-            post['comments'] = []
-            post['tag'] = '一般'  # 預設標籤
-
-        return {"posts": posts}
-
-    except mysql.connector.Error as err:
-        print(f"查詢貼文失敗: {err}")
-        raise HTTPException(status_code=500, detail="查詢貼文時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+            # 為每個貼文添加預設值
+            for post in posts:
+                post['likes'] = post['likes_count'] or 0
+                post['comments'] = []
+                post['tag'] = '一般'  # 預設標籤
 
-@app.post("/api/posts")
-async def create_post(post: PostCreate, user_id: int = 1):
-    """創建新貼文"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+            return {"posts": posts}
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = """
-            INSERT INTO posts (author_id, content, image_url)
-            VALUES (%s, %s, %s)
-        """
-        cursor.execute(query, (user_id, post.content, post.imageUrl))
-        conn.commit()
-
-        post_id = cursor.lastrowid
-
-        # 獲取創建的貼文信息
-        get_post_query = """
-            SELECT
-                p.id,
-                p.author_id as authorId,
-                p.content,
-                p.image_url as imageUrl,
-                p.created_at as createdAt,
-                p.likes_count,
-                p.comments_count,
-                u.name as authorName,
-                u.dept as authorDept
-            FROM posts p
-            LEFT JOIN users u ON p.author_id = u.id
-            WHERE p.id = %s
-        """
-        cursor.execute(get_post_query, (post_id,))
-        new_post = cursor.fetchone()
-
-        return {"post": new_post, "message": "貼文創建成功"}
-
-    except mysql.connector.Error as err:
-        print(f"創建貼文失敗: {err}")
-        raise HTTPException(status_code=500, detail="創建貼文時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+        except mysql.connector.Error as err:
+            log.error("查詢貼文失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢貼文時發生錯誤")
+        finally:
+            cursor.close()
 
-@app.post("/api/posts/{post_id}/like")
-async def toggle_like_post(post_id: int, user_id: int = 1):
-    """切換貼文點讚狀態"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    return await run_db(_get_posts)
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        # 檢查是否已經點讚
-        check_query = "SELECT id FROM post_likes WHERE post_id = %s AND user_id = %s"
-        cursor.execute(check_query, (post_id, user_id))
-        existing_like = cursor.fetchone()
-
-        if existing_like:
-            # 取消點讚
-            delete_query = "DELETE FROM post_likes WHERE post_id = %s AND user_id = %s"
-            cursor.execute(delete_query, (post_id, user_id))
-
-            # 更新貼文點讚數
-            update_count_query = "UPDATE posts SET likes_count = likes_count - 1 WHERE id = %s"
-            cursor.execute(update_count_query, (post_id,))
+@app.get("/api/posts/feed")
+async def get_posts_feed(cursor: Optional[str] = None, limit: int = 20, comments: int = 3, user_id: int = 1):
+    """
+    以 (created_at, id) keyset 分頁的貼文動態牆
+    每頁固定三個查詢：貼文、每篇貼文最早的 comments 則留言、目前使用者的點讚狀態
+    下一頁以回傳的 next_cursor 取得，沒有更多貼文時為 null
+    """
+    limit = max(1, min(limit, 50))
+    comments = max(0, min(comments, 20))
+    after = decode_cursor(cursor) if cursor else None
 
-            liked = False
-        else:
-            # 新增點讚
-            insert_query = "INSERT INTO post_likes (post_id, user_id) VALUES (%s, %s)"
-            cursor.execute(insert_query, (post_id, user_id))
+    def _get_posts_feed(conn):
+        cursor_ = conn.cursor(dictionary=True)
+        try:
+            query = """
+                SELECT
+                    p.id,
+                    p.author_id as authorId,
+                    p.content,
+                    p.image_url as imageUrl,
+                    p.created_at as createdAt,
+                    p.likes_count,
+                    p.comments_count,
+                    u.name as authorName,
+                    u.dept as authorDept
+                FROM posts p
+                LEFT JOIN users u ON p.author_id = u.id
+            """
+            params = []
+            if after:
+                query += " WHERE p.created_at < %s OR (p.created_at = %s AND p.id < %s)"
+                params.extend([after[0], after[0], after[1]])
+            query += " ORDER BY p.created_at DESC, p.id DESC LIMIT %s"
+            params.append(limit + 1)
+            cursor_.execute(query, params)
+            posts = cursor_.fetchall()
+
+            has_more = len(posts) > limit
+            posts = posts[:limit]
+            post_ids = [post['id'] for post in posts]
+
+            comments_by_post = {post_id: [] for post_id in post_ids}
+            liked_ids = set()
+            if post_ids:
+                placeholders = ", ".join(["%s"] * len(post_ids))
+
+                if comments:
+                    comments_query = f"""
+                        SELECT id, post_id, content, {AGE_MINUTES}, user
+                        FROM (
+                            SELECT
+                                c.id,
+                                c.post_id,
+                                c.content,
+                                c.created_at,
+                                u.name as user,
+                                ROW_NUMBER() OVER (PARTITION BY c.post_id ORDER BY c.created_at ASC, c.id ASC) as rn
+                            FROM post_comments c
+                            LEFT JOIN users u ON c.user_id = u.id
+                            WHERE c.post_id IN ({placeholders})
+                        ) ranked
+                        WHERE rn <= %s
+                        ORDER BY post_id, rn
+                    """
+                    cursor_.execute(comments_query, (*post_ids, comments))
+                    for comment in cursor_.fetchall():
+                        comments_by_post[comment['post_id']].append({
+                            "id": comment['id'],
+                            "user": comment['user'],
+                            "text": comment['content'],
+                            "time": format_relative_time(comment['age_minutes'], just_now=True)
+                        })
+
+                likes_query = f"SELECT post_id FROM post_likes WHERE user_id = %s AND post_id IN ({placeholders})"
+                cursor_.execute(likes_query, (user_id, *post_ids))
+                liked_ids = {row['post_id'] for row in cursor_.fetchall()}
+
+            for post in posts:
+                post['likes'] = post['likes_count'] or 0
+                post['comments'] = comments_by_post[post['id']]
+                post['liked'] = post['id'] in liked_ids
+                post['tag'] = '一般'  # 預設標籤
+
+            next_cursor = encode_cursor(posts[-1]['createdAt'], posts[-1]['id']) if has_more else None
+            return {"posts": posts, "next_cursor": next_cursor}
+
+        except mysql.connector.Error as err:
+            log.error("查詢動態牆失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢貼文時發生錯誤")
+        finally:
+            cursor_.close()
+
+    return await run_db(_get_posts_feed)
 
-            # 更新貼文點讚數
-            update_count_query = "UPDATE posts SET likes_count = likes_count + 1 WHERE id = %s"
-            cursor.execute(update_count_query, (post_id,))
+@app.post("/api/posts")
+async def create_post(post: PostCreate, user_id: int = 1):
+    """創建新貼文"""
+    def _create_post(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = """
+                INSERT INTO posts (author_id, content, image_url)
+                VALUES (%s, %s, %s)
+            """
+            cursor.execute(query, (user_id, post.content, post.imageUrl))
+            conn.commit()
 
-            liked = True
+            post_id = cursor.lastrowid
 
-        conn.commit()
+            # 獲取創建的貼文信息
+            get_post_query = """
+                SELECT
+                    p.id,
+                    p.author_id as authorId,
+                    p.content,
+                    p.image_url as imageUrl,
+                    p.created_at as createdAt,
+                    p.likes_count,
+                    p.comments_count,
+                    u.name as authorName,
+                    u.dept as authorDept
+                FROM posts p
+                LEFT JOIN users u ON p.author_id = u.id
+                WHERE p.id = %s
+            """
+            cursor.execute(get_post_query, (post_id,))
+            new_post = cursor.fetchone()
 
-        # 獲取更新後的點讚數
-        get_count_query = "SELECT likes_count FROM posts WHERE id = %s"
-        cursor.execute(get_count_query, (post_id,))
-        result = cursor.fetchone()
-        likes_count = result['likes_count'] if result else 0
+            return {"post": new_post, "message": "貼文創建成功"}
 
-        return {
-            "liked": liked,
-            "likes_count": likes_count,
-            "message": "點讚成功" if liked else "取消點讚成功"
-        }
+        except mysql.connector.Error as err:
+            log.error("創建貼文失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="創建貼文時發生錯誤")
+        finally:
+            cursor.close()
 
-    except mysql.connector.Error as err:
-        print(f"處理點讚失敗: {err}")
-        raise HTTPException(status_code=500, detail="處理點讚時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+    return await run_db(_create_post)
+
+@app.post("/api/posts/{post_id}/like")
+async def toggle_like_post(post_id: int, user_id: int = 1):
+    """
+    切換貼文點讚狀態
+    以 unique_user_post_like 判斷：DELETE 刪到一筆代表原本已點讚，否則 INSERT IGNORE 新增
+    只有真的新增/刪除一筆時才調整 likes_count，並發點擊也不會讓計數漂移
+    """
+    def _toggle_like_post(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("DELETE FROM post_likes WHERE post_id = %s AND user_id = %s", (post_id, user_id))
+            if cursor.rowcount == 1:
+                liked, delta = False, -1
+            else:
+                cursor.execute("INSERT IGNORE INTO post_likes (post_id, user_id) VALUES (%s, %s)", (post_id, user_id))
+                # rowcount 為 0：同時有另一個請求已經點讚，狀態一樣是已點讚
+                liked, delta = True, cursor.rowcount
+
+            if delta:
+                # LAST_INSERT_ID(expr) 讓更新後的數字隨 OK 封包帶回，不必再 SELECT 一次
+                update_count_query = """
+                    UPDATE posts SET likes_count = LAST_INSERT_ID(COALESCE(likes_count, 0) + %s)
+                    WHERE id = %s
+                """
+                cursor.execute(update_count_query, (delta, post_id))
+                found = cursor.rowcount == 1
+                likes_count = cursor.lastrowid or 0
+            else:
+                cursor.execute("SELECT likes_count FROM posts WHERE id = %s", (post_id,))
+                result = cursor.fetchone()
+                found = result is not None
+                likes_count = (result['likes_count'] or 0) if found else 0
+
+            if not found:
+                # INSERT IGNORE 會把外鍵錯誤降為警告，貼文不存在時在這裡擋下
+                conn.rollback()
+                raise HTTPException(status_code=404, detail="貼文未找到")
+            conn.commit()
+
+            return delta, {
+                "liked": liked,
+                "likes_count": likes_count,
+                "message": "點讚成功" if liked else "取消點讚成功"
+            }
+
+        except mysql.connector.Error as err:
+            conn.rollback()
+            log.error("處理點讚失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="處理點讚時發生錯誤")
+        finally:
+            cursor.close()
+
+    delta, result = await run_db(_toggle_like_post)
+    if delta:
+        trending_posts.record(post_id, "like" if delta > 0 else "unlike")
+    return result
 
 @app.get("/api/posts/{post_id}/comments")
 async def get_post_comments(post_id: int):
     """獲取貼文留言"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    def _get_post_comments(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = """
+                SELECT
+                    c.id,
+                    c.content,
+                    TIMESTAMPDIFF(MINUTE, c.created_at, NOW()) AS age_minutes,
+                    u.name as user
+                FROM post_comments c
+                LEFT JOIN users u ON c.user_id = u.id
+                WHERE c.post_id = %s
+                ORDER BY c.created_at ASC, c.id ASC
+            """
+            cursor.execute(query, (post_id,))
+            comments = cursor.fetchall()
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = """
-            SELECT
-                c.id,
-                c.content,
-                c.created_at,
-                u.name as user,
-                CASE
-                    WHEN TIMESTAMPDIFF(MINUTE, c.created_at, NOW()) < 1 THEN '剛剛'
-                    WHEN TIMESTAMPDIFF(MINUTE, c.created_at, NOW()) < 60
-                        THEN CONCAT(TIMESTAMPDIFF(MINUTE, c.created_at, NOW()), ' 分鐘前')
-                    WHEN TIMESTAMPDIFF(HOUR, c.created_at, NOW()) < 24
-                        THEN CONCAT(TIMESTAMPDIFF(HOUR, c.created_at, NOW()), ' 小時前')
-                    ELSE CONCAT(TIMESTAMPDIFF(DAY, c.created_at, NOW()), ' 天前')
-                END as time
-            FROM post_comments c
-            LEFT JOIN users u ON c.user_id = u.id
-            WHERE c.post_id = %s
-            ORDER BY c.created_at ASC
-        """
-        cursor.execute(query, (post_id,))
-        comments = cursor.fetchall()
-
-        # 轉換格式以符合前端需求
-        formatted_comments = []
-        for comment in comments:
-            formatted_comments.append({
-                "id": comment['id'],
-                "user": comment['user'],
-                "text": comment['content'],
-                "time": comment['time']
-            })
+            # 轉換格式以符合前端需求
+            formatted_comments = []
+            for comment in comments:
+                formatted_comments.append({
+                    "id": comment['id'],
+                    "user": comment['user'],
+                    "text": comment['content'],
+                    "time": format_relative_time(comment['age_minutes'], just_now=True)
+                })
 
-        return {"comments": formatted_comments}
+            return {"comments": formatted_comments}
 
-    except mysql.connector.Error as err:
-        print(f"查詢留言失敗: {err}")
-        raise HTTPException(status_code=500, detail="查詢留言時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+        except mysql.connector.Error as err:
+            log.error("查詢留言失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢留言時發生錯誤")
+        finally:
+            cursor.close()
+
+    return await run_db(_get_post_comments)
 
 @app.post("/api/posts/{post_id}/comments")
 async def create_comment(post_id: int, comment: CommentCreate, user_id: int = 1):
     """創建貼文留言"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    def _create_comment(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            # 新增留言
+            insert_query = """
+                INSERT INTO post_comments (post_id, user_id, content)
+                VALUES (%s, %s, %s)
+            """
+            cursor.execute(insert_query, (post_id, user_id, comment.content))
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        # 新增留言
-        insert_query = """
-            INSERT INTO post_comments (post_id, user_id, content)
-            VALUES (%s, %s, %s)
-        """
-        cursor.execute(insert_query, (post_id, user_id, comment.content))
-
-        # 更新貼文留言數
-        update_count_query = "UPDATE posts SET comments_count = comments_count + 1 WHERE id = %s"
-        cursor.execute(update_count_query, (post_id,))
-
-        conn.commit()
-
-        comment_id = cursor.lastrowid
-
-        # 獲取新建立的留言信息
-        get_comment_query = """
-            SELECT
-                c.id,
-                c.content,
-                c.created_at,
-                u.name as user
-            FROM post_comments c
-            LEFT JOIN users u ON c.user_id = u.id
-            WHERE c.id = %s
-        """
-        cursor.execute(get_comment_query, (comment_id,))
-        new_comment = cursor.fetchone()
-
-        # 格式化回應
-        formatted_comment = {
-            "id": new_comment['id'],
-            "user": new_comment['user'],
-            "text": new_comment['content'],
-            "time": "剛剛"
-        }
+            # 更新貼文留言數
+            update_count_query = "UPDATE posts SET comments_count = comments_count + 1 WHERE id = %s"
+            cursor.execute(update_count_query, (post_id,))
 
-        return {"comment": formatted_comment, "message": "留言成功"}
+            conn.commit()
 
-    except mysql.connector.Error as err:
-        print(f"創建留言失敗: {err}")
-        raise HTTPException(status_code=500, detail="創建留言時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+            comment_id = cursor.lastrowid
+
+            # 獲取新建立的留言信息
+            get_comment_query = """
+                SELECT
+                    c.id,
+                    c.content,
+                    c.created_at,
+                    u.name as user
+                FROM post_comments c
+                LEFT JOIN users u ON c.user_id = u.id
+                WHERE c.id = %s
+            """
+            cursor.execute(get_comment_query, (comment_id,))
+            new_comment = cursor.fetchone()
+
+            # 格式化回應
+            formatted_comment = {
+                "id": new_comment['id'],
+                "user": new_comment['user'],
+                "text": new_comment['content'],
+                "time": "剛剛"
+            }
+
+            return {"comment": formatted_comment, "message": "留言成功"}
+
+        except mysql.connector.Error as err:
+            log.error("創建留言失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="創建留言時發生錯誤")
+        finally:
+            cursor.close()
+
+    result = await run_db(_create_comment)
+    trending_posts.record(post_id, "comment")
+    return result
 
 @app.get("/api/posts/{post_id}/like-status")
 async def get_like_status(post_id: int, user_id: int = 1):
     """獲取用戶對貼文的點讚狀態"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
+    def _get_like_status(conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = "SELECT id FROM post_likes WHERE post_id = %s AND user_id = %s"
+            cursor.execute(query, (post_id, user_id))
+            result = cursor.fetchone()
 
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = "SELECT id FROM post_likes WHERE post_id = %s AND user_id = %s"
-        cursor.execute(query, (post_id, user_id))
-        result = cursor.fetchone()
+            return {"liked": result is not None}
 
-        return {"liked": result is not None}
+        except mysql.connector.Error as err:
+            log.error("查詢點讚狀態失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢點讚狀態時發生錯誤")
+        finally:
+            cursor.close()
 
-    except mysql.connector.Error as err:
-        print(f"查詢點讚狀態失敗: {err}")
-        raise HTTPException(status_code=500, detail="查詢點讚狀態時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+    return await run_db(_get_like_status)
 
 # --- Dashboard API ---
 @app.get("/api/dashboard/notifications")
 async def get_dashboard_notifications(limit: int = 3, current_user_id: int = Depends(get_current_user_id)):
     """獲取Dashboard顯示的最新通知"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
-
-    cursor = conn.cursor(dictionary=True)
-    try:
-        query = """
-            SELECT id, title,
-                   CASE
-                       WHEN TIMESTAMPDIFF(MINUTE, created_at, NOW()) < 60
-                           THEN CONCAT(TIMESTAMPDIFF(MINUTE, created_at, NOW()), ' 分鐘前')
-                       WHEN TIMESTAMPDIFF(HOUR, created_at, NOW()) < 24
-                           THEN CONCAT(TIMESTAMPDIFF(HOUR, created_at, NOW()), ' 小時前')
-                       ELSE CONCAT(TIMESTAMPDIFF(DAY, created_at, NOW()), ' 天前')
-                   END as time
-            FROM notifications
-            WHERE user_id = %s
-            ORDER BY created_at DESC
-            LIMIT %s
-        """
-        cursor.execute(query, (current_user_id, limit))
-        notifications = cursor.fetchall()
-
-        return {"notifications": notifications}
-
-    except mysql.connector.Error as err:
-        print(f"查詢Dashboard通知失敗: {err}")
-        raise HTTPException(status_code=500, detail="查詢Dashboard通知時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+    def _get_dashboard_notifications(conn, limit):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            query = f"""
+                SELECT id, title, {AGE_MINUTES}
+                FROM notifications
+                WHERE user_id = %s
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            """
+            cursor.execute(query, (current_user_id, limit))
+            # 快取資料庫算好的分鐘數與載入時間，讀取時只加上本機經過的時間，不比較兩邊的時鐘
+            loaded_at = time.time()
+            return [{**row, "loaded_at": loaded_at} for row in cursor.fetchall()]
+
+        except mysql.connector.Error as err:
+            log.error("查詢Dashboard通知失敗", extra={"fields": {"error": str(err)}})
+            raise HTTPException(status_code=500, detail="查詢Dashboard通知時發生錯誤")
+        finally:
+            cursor.close()
+
+    # 快取固定取前 LATEST_NOTIFICATIONS 筆，不同 limit 共用；超過時直接查資料庫
+    if limit > user_cache.LATEST_NOTIFICATIONS:
+        notifications = await run_db(_get_dashboard_notifications, limit)
+    else:
+        notifications = await user_cache.get_or_load(
+            user_cache.latest_key(current_user_id),
+            lambda: run_db(_get_dashboard_notifications, user_cache.LATEST_NOTIFICATIONS)
+        )
+    now = time.time()
+    return {"notifications": [
+        {"id": row['id'], "title": row['title'],
+         "time": format_relative_time(row['age_minutes'] + (now - row['loaded_at']) // 60)}
+        for row in notifications[:limit]
+    ]}
 
 @app.get("/api/dashboard/popular-posts")
 async def get_dashboard_popular_posts(limit: int = 3):
-    """獲取Dashboard顯示的熱門社群貼文（按點讚數排序）"""
-    conn = get_db_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="無法連接到資料庫")
-
-    cursor = conn.cursor(dictionary=True)
+    """獲取Dashboard顯示的熱門社群貼文（依點讚與留言、隨時間衰減的分數排序）"""
+    limit = max(1, min(limit, trending_posts.size))
     try:
-        # 檢查 posts 表是否有 likes_count 欄位
-        check_column_query = "SHOW COLUMNS FROM posts LIKE 'likes_count'"
-        cursor.execute(check_column_query)
-        has_likes_count = cursor.fetchone() is not None
-
-        if has_likes_count:
-            query = """
-                SELECT
-                    p.id,
-                    p.content,
-                    u.name as user
-                FROM posts p
-                LEFT JOIN users u ON p.author_id = u.id
-                WHERE p.likes_count > 0
-                ORDER BY p.likes_count DESC, p.created_at DESC
-                LIMIT %s
-            """
-        else:
-            # 如果沒有 likes_count 欄位，使用 post_likes 表計算
-            query = """
-                SELECT
-                    p.id,
-                    p.content,
-                    u.name as user,
-                    COALESCE(like_counts.like_count, 0) as likes
-                FROM posts p
-                LEFT JOIN users u ON p.author_id = u.id
-                LEFT JOIN (
-                    SELECT post_id, COUNT(*) as like_count
-                    FROM post_likes
-                    GROUP BY post_id
-                ) like_counts ON p.id = like_counts.post_id
-                ORDER BY likes DESC, p.created_at DESC
-                LIMIT %s
-            """
-
-        cursor.execute(query, (limit,))
-        posts = cursor.fetchall()
-
-        return {"posts": posts}
-
-    except mysql.connector.Error as err:
-        print(f"查詢Dashboard熱門貼文失敗: {err}")
-        # 如果查詢失敗，返回最新的貼文
-        try:
-            fallback_query = """
-                SELECT
-                    p.id,
-                    p.content,
-                    u.name as user
-                FROM posts p
-                LEFT JOIN users u ON p.author_id = u.id
-                ORDER BY p.created_at DESC
-                LIMIT %s
-            """
-            cursor.execute(fallback_query, (limit,))
-            posts = cursor.fetchall()
-            return {"posts": posts}
-        except:
-            raise HTTPException(status_code=500, detail="查詢Dashboard熱門貼文時發生錯誤")
-    finally:
-        cursor.close()
-        conn.close()
+        posts = await trending_posts.top(limit)
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="資料庫忙碌中，請稍後再試")
+    except (DatabaseUnavailable, mysql.connector.Error) as err:
+        log.error("查詢Dashboard熱門貼文失敗", extra={"fields": {"error": str(err)}})
+        raise HTTPException(status_code=500, detail="查詢Dashboard熱門貼文時發生錯誤")
+    return {"posts": posts}
+
+@app.get("/api/health/db")
+async def get_db_health():
+    """連線池狀態：使用中/閒置連線數、借用等待時間與逾時次數"""
+    return db_pool.pool.stats()
+
+@app.get("/api/health/mood-writer")
+async def get_mood_writer_health():
+    """背景心情寫入佇列的待寫筆數、批次數與重試次數"""
+    return mood_writer.status()
+
+@app.get("/api/health/post-counters")
+async def get_post_counters_health():
+    """貼文計數校正的執行次數、修正筆數與最近一次耗時"""
+    return counter_reconciler.status()
+
+@app.get("/api/health/trending")
+async def get_trending_health():
+    """熱門貼文排行的追蹤貼文數、增量更新次數與最近一次重算耗時"""
+    return trending_posts.status()
+
+@app.get("/api/health/user-cache")
+async def get_user_cache_health():
+    """通知數、最新通知與積分快取的命中率"""
+    return user_cache.stats()
+
+@app.get("/api/health/chat-cache")
+async def get_chat_cache_health():
+    """回覆快取的命中/未命中次數與目前筆數"""
+    if rag_service.components is None:
+        return {"enabled": False}
+    return {"enabled": True, **rag_service.components.response_cache.stats()}
+
+@app.get("/api/health/notifications")
+async def get_notification_hub_health():
+    """通知推送的連線數、已推送與因跟不上而中斷的次數"""
+    return notification_hub.stats()
+
+@app.get("/api/health/embeddings")
+async def get_embeddings_health():
+    """embedding 後端、查詢向量 LRU 命中率、平均批次大小與使用中的向量索引（快照或 Chroma）"""
+    components = rag_service.components
+    if components is None:
+        return {"enabled": False}
+    return {"enabled": True, **components.embeddings.status(), **components.vector_store_status()}
+
+@app.get("/api/health/llm")
+async def get_llm_health():
+    """LLM 呼叫的進行中數量、排隊人數、等待時間與被拒絕次數"""
+    return llm_gate.status()
+
+@app.get("/api/health/ready")
+async def get_readiness():
+    """服務就緒狀態；非聊天 API 隨時可用，rag.state 為 warm 時聊天才不需要等待模型載入"""
+    return {"status": "ok", "rag": rag_service.status()}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus 格式的指標：各路由延遲、資料庫、RAG 各階段耗時與 token 數"""
+    pool_stats = db_pool.pool.stats()
+    metrics.db_pool_connections.set(pool_stats["in_use"], state="in_use")
+    metrics.db_pool_connections.set(pool_stats["idle"], state="idle")
+    llm_status = llm_gate.status()
+    metrics.llm_requests.set(llm_status["in_flight"], state="in_flight")
+    metrics.llm_requests.set(llm_status["waiting"], state="waiting")
+    metrics.background_queue.set(mood_writer.status()["pending"], queue="mood_writer")
+    metrics.notification_connections.set(notification_hub.stats()["connections"])
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 def read_root():
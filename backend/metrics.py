@@ -0,0 +1,135 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# 預設延遲分桶（秒），涵蓋資料庫查詢到 LLM 回覆
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    inner = ",".join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for name, value in pairs)
+    return "{" + inner + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines += self._render_samples(items)
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in items]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render():
+    """所有指標的 Prometheus text exposition 格式"""
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# --- 共用指標 ---
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "HTTP 請求處理時間（串流回應計到開始回傳為止）",
+    ["method", "route", "status"],
+)
+db_acquire_seconds = Histogram("db_pool_acquire_seconds", "借用資料庫連線（含排隊）的等待時間", ["query"])
+db_query_seconds = Histogram("db_query_duration_seconds", "借到連線後執行資料庫工作的時間", ["query"])
+rag_stage_seconds = Histogram("rag_stage_duration_seconds", "RAG 各階段耗時", ["stage"])
+llm_tokens = Histogram("llm_tokens", "每次 LLM 呼叫的 token 數", ["kind"], buckets=TOKEN_BUCKETS)
+rag_context_tokens = Histogram("rag_context_tokens", "放入 prompt 的檢索內容 token 數", buckets=TOKEN_BUCKETS)
+chat_replies = Counter("chat_replies_total", "聊天回覆次數，依來源 (faq/cache/llm) 區分", ["source"])
+db_pool_connections = Gauge("db_pool_connections", "連線池中的連線數", ["state"])
+llm_requests = Gauge("llm_requests", "LLM 呼叫數，依狀態 (in_flight/waiting) 區分", ["state"])
+background_queue = Gauge("background_queue_items", "背景工作佇列中的項目數", ["queue"])
+notification_connections = Gauge("notification_stream_connections", "通知推送的連線數")
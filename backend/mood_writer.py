@@ -0,0 +1,175 @@
+import os
+import asyncio
+from datetime import date
+
+import mysql.connector
+
+from db import PoolTimeout, DatabaseUnavailable
+from logs import get_logger
+
+MOOD_FLUSH_INTERVAL = float(os.getenv("MOOD_FLUSH_INTERVAL", 0.5))
+MOOD_BATCH_SIZE = int(os.getenv("MOOD_BATCH_SIZE", 200))
+MOOD_MAX_RETRY_DELAY = float(os.getenv("MOOD_MAX_RETRY_DELAY", 30))
+
+log = get_logger("mood_writer")
+
+
+def write_mood_batch(conn, batch):
+    """
+    在一個交易中寫入一批心情紀錄，batch 為 {(user_id, entry_date): mood_score}
+    每個 (使用者, 日期) 只執行一次 INSERT ... ON DUPLICATE KEY UPDATE，重試也不會重複加分：
+    rowcount 為 1 代表當天第一次記錄（新增），才替該使用者加 1 分
+    回傳 (當天第一次記錄的 key, {user_id: 目前總積分})
+    """
+    cursor = conn.cursor(dictionary=True)
+    try:
+        first_entries = []
+        upsert_mood_query = """
+            INSERT INTO mood_entries (user_id, mood_score, entry_date) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE mood_score = VALUES(mood_score), created_at = CURRENT_TIMESTAMP
+        """
+        for (user_id, entry_date), mood_score in batch.items():
+            cursor.execute(upsert_mood_query, (user_id, mood_score, entry_date))
+            if cursor.rowcount == 1:
+                first_entries.append((user_id, entry_date))
+
+        if first_entries:
+            upsert_points_query = """
+                INSERT INTO user_points (user_id, points) VALUES (%s, 1)
+                ON DUPLICATE KEY UPDATE points = points + 1
+            """
+            cursor.executemany(upsert_points_query, [(user_id,) for user_id, _ in first_entries])
+
+        conn.commit()
+
+        user_ids = list({user_id for user_id, _ in batch})
+        placeholders = ", ".join(["%s"] * len(user_ids))
+        cursor.execute(f"SELECT user_id, points FROM user_points WHERE user_id IN ({placeholders})", user_ids)
+        totals = {row['user_id']: row['points'] for row in cursor.fetchall()}
+        return first_entries, totals
+
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+class MoodWriter:
+    """
+    心情與積分的背景寫入佇列，讓 /api/chat 不必等資料庫
+    - 同一使用者同一天的多次提交只保留最後一次的分數
+    - 每 MOOD_FLUSH_INTERVAL 秒或累積 MOOD_BATCH_SIZE 筆時，以一個交易寫入整批
+    - 資料庫暫時無法使用時保留資料並以指數退避重試
+    """
+
+    def __init__(self, db, flush_interval=MOOD_FLUSH_INTERVAL, batch_size=MOOD_BATCH_SIZE,
+                 max_retry_delay=MOOD_MAX_RETRY_DELAY, on_written=None):
+        self.db = db
+        # 每批寫入成功後以 {user_id: 目前總積分} 呼叫，用來更新積分快取
+        self.on_written = on_written
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_retry_delay = max_retry_delay
+        self._pending = {}
+        self._recorded = set()  # 今天已提交過心情的 (user_id, entry_date)
+        self._recorded_day = None
+        self._known_points = {}  # 最近一次寫入後得知的總積分
+        self._wakeup = None
+        self._task = None
+        self.stats = {"submitted": 0, "written": 0, "batches": 0, "retries": 0}
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """停止背景工作並盡量把剩下的資料寫完"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending:
+            try:
+                await self._flush()
+            except Exception as e:
+                log.error("關閉時寫入心情紀錄失敗", extra={"fields": {"unwritten": len(self._pending), "error": str(e)}})
+
+    def submit(self, user_id, mood_score):
+        """
+        排入一筆今天的心情紀錄，立即回傳預估的 (本次獲得積分, 目前總積分)
+        同一天第一次提交預估得 1 分；總積分未知時為 None
+        """
+        today = date.today()
+        key = (user_id, today)
+        self._trim_recorded(today)
+
+        points_earned = 0 if key in self._recorded else 1
+        self._recorded.add(key)
+        self._pending[key] = mood_score
+        self.stats["submitted"] += 1
+
+        if len(self._pending) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+        known = self._known_points.get(user_id)
+        total_points = known + points_earned if known is not None else None
+        return points_earned, total_points
+
+    def is_recorded(self, user_id, entry_date):
+        """今天是否已提交過（可能還在佇列中尚未寫入）"""
+        return (user_id, entry_date) in self._recorded
+
+    def mark_recorded(self, user_id, entry_date):
+        self._trim_recorded(entry_date)
+        self._recorded.add((user_id, entry_date))
+
+    def status(self):
+        return {**self.stats, "pending": len(self._pending), "running": self._task is not None}
+
+    async def _run(self):
+        retry_delay = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            while self._pending:
+                try:
+                    await self._flush()
+                    retry_delay = self.flush_interval
+                except (PoolTimeout, DatabaseUnavailable, mysql.connector.Error) as e:
+                    self.stats["retries"] += 1
+                    log.warning("寫入心情紀錄失敗，稍後重試", extra={"fields": {"retry_in": round(retry_delay, 1), "error": str(e)}})
+                    await asyncio.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, self.max_retry_delay)
+
+    async def _flush(self):
+        keys = list(self._pending)[: self.batch_size]
+        batch = {key: self._pending.pop(key) for key in keys}
+        try:
+            first_entries, totals = await self.db.run(write_mood_batch, batch)
+        except BaseException:
+            # 放回佇列；期間若有同一個 key 的新提交，保留較新的分數
+            for key, mood_score in batch.items():
+                self._pending.setdefault(key, mood_score)
+            raise
+
+        self._known_points.update(totals)
+        if self.on_written is not None:
+            self.on_written(totals)
+        self.stats["written"] += len(batch)
+        self.stats["batches"] += 1
+        log.debug("已寫入心情紀錄", extra={"fields": {"rows": len(batch), "first_entries": len(first_entries)}})
+
+    def _trim_recorded(self, today):
+        # 只需要記住今天的提交
+        if self._recorded_day != today:
+            self._recorded = {key for key in self._recorded if key[1] == today}
+            self._recorded_day = today
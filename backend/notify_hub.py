@@ -0,0 +1,59 @@
+import asyncio
+from collections import defaultdict
+
+NOTIFY_QUEUE_SIZE = 100
+
+
+class NotificationHub:
+    """
+    行程內的通知 pub/sub：每個連線中的客戶端訂閱自己的 user_id
+    只在單一行程內傳遞，沒有跨 worker 的轉送：worker A 建立的通知不會推給連在 worker B 的客戶端，
+    那些客戶端要等斷線重連、以 last_id（Last-Event-ID）補送時才會收到；需要即時送達時請只跑一個 worker
+    publish/subscribe 都必須在 event loop 中呼叫
+    """
+
+    def __init__(self, queue_size=NOTIFY_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)  # user_id -> {asyncio.Queue}
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, user_id):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self._subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[user_id]
+
+    def connected_users(self):
+        """目前有連線的 user_id 快照，可以交給其他執行緒使用"""
+        return frozenset(self._subscribers)
+
+    def publish(self, user_id, notification):
+        for queue in list(self._subscribers.get(user_id, ())):
+            try:
+                queue.put_nowait(notification)
+            except asyncio.QueueFull:
+                # 客戶端跟不上：放一個 None 讓它斷線，重連時再用 last_id 補資料
+                self.dropped += 1
+                self.unsubscribe(user_id, queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+        self.published += 1
+
+    def stats(self):
+        return {
+            "users": len(self._subscribers),
+            "connections": sum(len(queues) for queues in self._subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+notification_hub = NotificationHub()
@@ -0,0 +1,89 @@
+import os
+import time
+import asyncio
+
+import mysql.connector
+
+from db import PoolTimeout, DatabaseUnavailable
+from logs import get_logger
+
+POST_COUNTER_RECONCILE_INTERVAL = float(os.getenv("POST_COUNTER_RECONCILE_INTERVAL", 600))
+
+log = get_logger("post_counters")
+
+
+def reconcile_post_counters(conn):
+    """
+    依 post_likes / post_comments 重新計算所有貼文的 likes_count 與 comments_count
+    只更新數字不一致的貼文，回傳修正的筆數
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE posts p
+            LEFT JOIN (SELECT post_id, COUNT(*) AS cnt FROM post_likes GROUP BY post_id) l ON l.post_id = p.id
+            LEFT JOIN (SELECT post_id, COUNT(*) AS cnt FROM post_comments GROUP BY post_id) c ON c.post_id = p.id
+            SET p.likes_count = COALESCE(l.cnt, 0),
+                p.comments_count = COALESCE(c.cnt, 0)
+            WHERE NOT (p.likes_count <=> COALESCE(l.cnt, 0))
+               OR NOT (p.comments_count <=> COALESCE(c.cnt, 0))
+        """)
+        fixed = cursor.rowcount
+        conn.commit()
+        return fixed
+
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+class CounterReconciler:
+    """
+    定期校正貼文的點讚數與留言數
+    點讚/留言 API 以增減方式維護計數，這裡負責修正任何漂移（例如手動刪資料）
+    interval 為 0 時不啟動
+    """
+
+    def __init__(self, db, interval=POST_COUNTER_RECONCILE_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self._task = None
+        self.stats = {"runs": 0, "fixed": 0, "errors": 0, "last_run": None, "last_duration_ms": None}
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self):
+        started = time.perf_counter()
+        fixed = await self.db.run(reconcile_post_counters)
+        self.stats["runs"] += 1
+        self.stats["fixed"] += fixed
+        self.stats["last_run"] = time.time()
+        self.stats["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        if fixed:
+            log.info("已校正貼文的點讚/留言數", extra={"fields": {"posts": fixed}})
+        return fixed
+
+    def status(self):
+        return {**self.stats, "interval": self.interval, "running": self._task is not None}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except (PoolTimeout, DatabaseUnavailable, mysql.connector.Error) as e:
+                self.stats["errors"] += 1
+                log.warning("校正貼文計數失敗，下次再試", extra={"fields": {"error": str(e)}})
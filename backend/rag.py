@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import asyncio
+
+from langchain.prompts import PromptTemplate
+from langchain_core.runnables import RunnablePassthrough
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.callbacks import BaseCallbackHandler
+
+from rag_cache import SemanticCache, read_index_version
+from faq import FaqIndex
+from retrieval import select_context_docs, reciprocal_rank_fusion, LexicalIndex, RAG_MAX_K, RAG_LEXICAL_K, count_tokens
+from logs import get_logger
+from embeddings import SentenceEmbeddings, EMBEDDING_MODEL
+from vector_snapshot import VectorSnapshot, read_current
+from metrics import rag_stage_seconds, rag_context_tokens, llm_tokens
+
+log = get_logger("rag")
+
+CHROMA_PATH = "chroma_db"
+# 初始化失敗後，至少隔這麼久才重試
+RAG_INIT_RETRY_SECONDS = float(os.getenv("RAG_INIT_RETRY_SECONDS", 30))
+# RAG_LLM=stub 時改用本地假模型，方便在沒有 API 金鑰的環境測試併發與逾時
+RAG_LLM = os.getenv("RAG_LLM", "openai")
+LLM_STUB_DELAY = float(os.getenv("LLM_STUB_DELAY", 1.0))
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 60))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 1))
+# auto：有與目前索引版本相同的 mmap 快照就用快照，否則用 Chroma；也可固定為 snapshot 或 chroma
+RAG_VECTOR_STORE = os.getenv("RAG_VECTOR_STORE", "auto")
+# 背景檢查向量資料庫是否重建的間隔（秒）
+RAG_INDEX_CHECK_SECONDS = float(os.getenv("RAG_INDEX_CHECK_SECONDS", 5))
+
+qa_system_prompt ="""
+    你是一位服務於 iGrow & iCare 系統的專業 AI 助理，名叫小黑 🐾。
+    你的核心人格是一位「善於傾聽且值得信賴的團隊夥伴」，個性積極、溫暖、從不帶有批判色彩。你的主要任務是協助員工處理職涯發展與身心健康相關的問題。
+    **黃金準則：永遠要讓使用者感覺被傾聽、被理解、被支持 (๑•̀ㅂ•́)و✧**
+    
+    **開場互動指南：**
+    你的第一句回應是建立信任的關鍵。當使用者在對話開始時選擇了心情，你的開場白「必須」將對心情的關懷與問候無縫地結合在一起，展現出你真誠的同理心。
+    
+    * 如果心情是 **Very Happy (😀) 或 Pretty Good (🙂)**：用陽光、肯定的語氣分享他們的好心情。
+      * **範例**："哇 (≧▽≦)✨ 看到您今天活力滿滿，真為您開心！希望這份好心情能持續一整天 🌞💪。請問今天有什麼我可以為您服務的嗎？"
+    
+    * 如果心情是 **Okay (😐)**：用平穩、溫和的語氣表示理解，並提供一個開放的空間。
+      * **範例**："了解了 (・ω・) 感覺今天心情平平。如果需要什麼，或只是想找人聊聊，我隨時都在哦 (｡･∀･)ﾉﾞ。請問有什麼我可以協助您的嗎？"
+    
+    * 如果心情是 **Not So Good (🙁) 或 Very Sad (😢)**：用非常溫柔、支持的語氣，優先表達關懷，讓他們感覺這裡是個安全的空間。
+      * **範例**："感覺您今天的心情似乎不太好 (つ﹏⊂)💦 希望您還好。如果您想抒發一下，我會在這裡好好聽您說 ( ´•̥̥̥ω•̥̥̥` )。請問有什麼我可以為您分擔的嗎？"
+    
+    **核心對話準則：**
+    1. **語氣與風格**：在整個對話中，請保持你口語化、親切且直接的夥伴風格 (ฅ´ω`ฅ)。避免使用過於正式或冗長的句子，盡量將每個回答控制在三句話以內。
+    2. 如果問題是你不確定，直接回覆「不知道 (；´･ω･)」，並且建議使用者至社群提問。
+    
+    上下文資訊:
+    {context}
+    """
+qa_prompt = PromptTemplate(
+    input_variables=["context", "question", "chat_history"],
+    template=qa_system_prompt + "\n\n對話歷史:\n{chat_history}\n\n問題: {question}"
+)
+# 滑出視窗的舊對話用較便宜的模型壓縮成摘要
+summary_prompt = PromptTemplate.from_template(
+    "請將以下對話濃縮成一段不超過 {max_tokens} 個 token 的繁體中文摘要，"
+    "保留使用者的需求、已提供的資訊與情緒狀態。\n\n"
+    "既有摘要:\n{summary}\n\n新增的對話:\n{conversation}\n\n更新後的摘要:"
+)
+
+
+def format_docs(docs):
+    return "\n\n".join(doc.page_content for doc in docs)
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """記錄每次 LLM 呼叫的耗時與 token 數；供應商沒回傳用量時以 count_tokens 估算"""
+
+    run_inline = True
+
+    def __init__(self, stage):
+        self.stage = stage
+        self._runs = {}  # run_id -> (開始時間, prompt token 數)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        prompt_tokens = sum(count_tokens(message.content if isinstance(message.content, str) else str(message.content))
+                            for batch in messages for message in batch)
+        self._runs[run_id] = (time.perf_counter(), prompt_tokens)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started, prompt_tokens = self._runs.pop(run_id, (None, 0))
+        if started is not None:
+            rag_stage_seconds.observe(time.perf_counter() - started, stage=self.stage)
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+        if usage:
+            prompt_tokens, completion_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+        else:
+            completion_tokens = count_tokens(generation.text) if generation is not None else 0
+        llm_tokens.observe(prompt_tokens, kind=f"{self.stage}_prompt")
+        llm_tokens.observe(completion_tokens, kind=f"{self.stage}_completion")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._runs.pop(run_id, None)
+
+
+def create_chat_model(model_name, temperature, callbacks=None):
+    if RAG_LLM == "stub":
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+        class StubChatModel(FakeListChatModel):
+            """固定回覆、固定延遲的假模型"""
+
+            async def _agenerate(self, *args, **kwargs):
+                await asyncio.sleep(LLM_STUB_DELAY)
+                return await super()._agenerate(*args, **kwargs)
+
+        return StubChatModel(responses=["（測試回覆）這是本地假模型的回答。"],
+                             sleep=LLM_STUB_DELAY / 20, callbacks=callbacks)
+
+    from langchain_openai import ChatOpenAI
+    # LLM_BASE_URL 可指向相容 OpenAI API 的本地服務
+    return ChatOpenAI(temperature=temperature, model_name=model_name, timeout=LLM_REQUEST_TIMEOUT,
+                      max_retries=LLM_MAX_RETRIES, base_url=os.getenv("LLM_BASE_URL") or None,
+                      callbacks=callbacks)
+
+
+def check_index_embedding(db_path, embeddings):
+    """向量資料庫若是用別的模型建立的，查詢向量無法比較，提早警告"""
+    try:
+        with open(os.path.join(db_path, "manifest.json"), encoding="utf-8") as f:
+            built_with = json.load(f).get("embedding") or {}
+    except (OSError, ValueError):
+        return
+    if built_with.get("model", EMBEDDING_MODEL) != embeddings.model_name:
+        log.warning("向量資料庫的 embedding 模型與伺服器不同，請重新執行 build_database.py --full",
+                    extra={"fields": {"index_model": built_with.get("model"), "model": embeddings.model_name}})
+    elif built_with.get("backend", "torch") != embeddings.backend:
+        log.info("向量資料庫與伺服器使用不同的 embedding 後端（同一模型，可以混用）",
+                 extra={"fields": {"index_backend": built_with.get("backend"), "backend": embeddings.backend}})
+
+
+class RagUnavailable(Exception):
+    """RAG 元件尚未初始化完成或初始化失敗"""
+
+
+class RagComponents:
+    """
+    初始化完成的 RAG 元件：embedding 模型、向量資料庫、LLM 與各條 chain
+    bench_retrieval.py 以暫存的 chroma_path 建立同一組元件，量測的就是伺服器實際的檢索路徑
+    """
+
+    def __init__(self, chroma_path=CHROMA_PATH, vector_store=RAG_VECTOR_STORE, embeddings=None):
+        self.chroma_path = chroma_path
+        self.vector_store = vector_store
+        # 查詢向量的批次合併與 LRU 都在 SentenceEmbeddings 中，回覆快取也共用同一個
+        self.embeddings = embeddings or SentenceEmbeddings()
+        check_index_embedding(chroma_path, self.embeddings)
+        self.db = None
+        self.snapshot = None
+        self.llm = create_chat_model("gpt-4o", temperature=0.7, callbacks=[LLMMetricsHandler("llm")])
+
+        # 關鍵字索引與 FAQ 問句索引與向量資料庫一起使用；資料庫重建後由 refresh_index 在背景重新建立
+        self._index_version = self._current_index_version()
+        self._open_vector_store(self._index_version[0])
+
+        self.rag_chain = (
+            RunnablePassthrough.assign(context=self.get_enhanced_context)
+            | qa_prompt
+            | self.llm
+            | StrOutputParser()
+        )
+
+        # 常見問題的回覆快取，命中時不需要檢索與呼叫 LLM
+        self.response_cache = SemanticCache(
+            self.embeddings.embed_query,
+            chroma_path,
+            threshold=float(os.getenv("CHAT_CACHE_THRESHOLD", 0.95)),
+            ttl=float(os.getenv("CHAT_CACHE_TTL", 3600)),
+            max_entries=int(os.getenv("CHAT_CACHE_SIZE", 512)),
+        )
+
+        summary_llm = create_chat_model(os.getenv("CHAT_SUMMARY_MODEL", "gpt-4o-mini"), temperature=0,
+                                        callbacks=[LLMMetricsHandler("summary")])
+        self.summary_chain = summary_prompt | summary_llm | StrOutputParser()
+
+    def hybrid_search(self, query):
+        """
+        向量檢索與 BM25 關鍵字檢索各取少量候選，以 reciprocal rank fusion 合併
+        回傳 (向量結果, 關鍵字結果, 融合結果)，各為 [(doc, score)]
+        """
+        # vector_search 含查詢向量的計算時間，純 embedding 時間另記在 stage="embedding"
+        with rag_stage_seconds.time(stage="vector_search"):
+            vector_results = self.vector_search(query, k=RAG_MAX_K)
+        with rag_stage_seconds.time(stage="lexical_search"):
+            lexical_results = self.lexical_index.search(query, k=RAG_LEXICAL_K)
+        return vector_results, lexical_results, reciprocal_rank_fusion([lexical_results, vector_results])
+
+    def enhanced_retrieval(self, query):
+        """混合檢索後依相關分數與 token 預算決定實際放入幾個，回傳 (docs, context token 數)"""
+        _, _, scored_docs = self.hybrid_search(query)
+        return select_context_docs(scored_docs)
+
+    def vector_search(self, query, k):
+        snapshot = self.snapshot
+        if snapshot is not None:
+            return snapshot.search(self.embeddings.embed_query(query), k)
+        return self.db.similarity_search_with_relevance_scores(query, k=k)
+
+    def _current_index_version(self):
+        # 快照可能在版本不變時另外匯出，因此兩者一起比對
+        return read_index_version(self.chroma_path), read_current(self.chroma_path)
+
+    def _open_vector_store(self, index_version):
+        """
+        優先以 mmap 開啟與目前索引版本相同的快照，多個 worker 共用頁快取且不必載入 Chroma
+        沒有快照或快照已過期時改用 Chroma，並依向量資料庫重建關鍵字與 FAQ 索引
+        使用快照時，向量矩陣與文件全文都留在 mmap 中共用；每個 worker 各自持有的只有
+        BM25 倒排索引、FAQ 問句 bigram 等衍生結構（開啟時掃過全文建立，約與詞彙量成正比）
+        """
+        snapshot = None
+        if self.vector_store != "chroma":
+            snapshot = VectorSnapshot.open_current(self.chroma_path)
+            if snapshot is not None and snapshot.info.get("index_version") != index_version:
+                snapshot.close()
+                snapshot = None
+            if snapshot is None and self.vector_store == "snapshot":
+                log.warning("找不到與目前索引版本相同的向量快照，改用 Chroma")
+
+        if snapshot is not None:
+            documents = snapshot.documents()
+            log.info("使用向量快照", extra={"fields": {"path": snapshot.path, "count": len(snapshot),
+                                                    "dtype": snapshot.info.get("dtype")}})
+        else:
+            if self.db is None:
+                # 載入很慢（chromadb），需要時才 import
+                from langchain_community.vectorstores import Chroma
+                self.db = Chroma(persist_directory=self.chroma_path, embedding_function=self.embeddings)
+            documents = LexicalIndex.from_chroma(self.db).documents
+
+        # 新索引全部建好才替換，進行中的請求繼續用舊的；舊快照交給 GC 關閉
+        lexical_index, faq_index = LexicalIndex(documents), FaqIndex(documents)
+        self.lexical_index, self.faq_index, self.snapshot = lexical_index, faq_index, snapshot
+
+    def vector_store_status(self):
+        if self.snapshot is None:
+            return {"vector_store": "chroma"}
+        return {"vector_store": "snapshot", "snapshot_count": len(self.snapshot),
+                "snapshot_dtype": self.snapshot.info.get("dtype")}
+
+    def match_faq(self, question):
+        """問題幾乎就是某個 FAQ 問句時，回傳套用樣板後的答案，否則回傳 None"""
+        answer, score = self.faq_index.match(question)
+        if answer is None:
+            return None
+        log.debug("FAQ 命中", extra={"fields": {"score": round(score, 3)}})
+        return self.faq_index.format_reply(answer)
+
+    def refresh_index(self):
+        """
+        向量資料庫重建後重新開啟向量庫並重建關鍵字與 FAQ 索引，回傳是否有更新
+        會讀檔與掃過全文，由 RagService 在背景執行緒呼叫，不放在請求路徑上
+        """
+        version = self._current_index_version()
+        if version == self._index_version:
+            return False
+        log.info("向量資料庫已重建，重新建立關鍵字索引")
+        self._open_vector_store(version[0])
+        self._index_version = version
+        return True
+
+    def get_enhanced_context(self, input_data):
+        question = input_data["question"]
+        with rag_stage_seconds.time(stage="retrieval"):
+            docs, context_tokens = self.enhanced_retrieval(question)
+        formatted_context = format_docs(docs)
+        rag_context_tokens.observe(context_tokens)
+
+        # 儲存是否使用了 RAG 的資訊
+        rag_used = len(formatted_context.strip()) > 0
+        input_data["_rag_used"] = rag_used
+
+        log.debug("檢索完成", extra={"fields": {
+            "question": question,
+            "docs": len(docs),
+            "context_tokens": context_tokens,
+            "context_chars": len(formatted_context.strip()),
+            "rag_used": rag_used,
+        }})
+
+        return formatted_context
+
+
+class RagService:
+    """
+    延遲初始化 RAG 元件，讓伺服器啟動時不必等模型載入
+    - 啟動時在背景暖機，失敗後每 RAG_INIT_RETRY_SECONDS 秒重試直到成功
+    - 聊天請求呼叫 get()：已暖機直接回傳，暖機中就等待，失敗且尚未到重試時間則丟出 RagUnavailable
+    """
+
+    def __init__(self):
+        self.components = None
+        self.state = "cold"  # cold / warming / warm / failed
+        self.error = None
+        self.init_seconds = None
+        self._failed_at = None
+        self._lock = None
+        self._refresh_task = None
+
+    async def get(self):
+        if self.components is not None:
+            return self.components
+        await self.warm_up()
+        if self.components is None:
+            raise RagUnavailable(f"AI 助理尚未就緒: {self.error or '初始化中'}")
+        return self.components
+
+    async def warm_up(self, force=False):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.components is not None:
+                return
+            if not force and self.state == "failed" and time.monotonic() - self._failed_at < RAG_INIT_RETRY_SECONDS:
+                return
+
+            log.info("正在初始化 RAG 鏈")
+            self.state = "warming"
+            start = time.perf_counter()
+            try:
+                components = await asyncio.get_running_loop().run_in_executor(None, RagComponents)
+            except Exception as e:
+                log.exception("初始化 RAG 鏈時發生錯誤")
+                self.state = "failed"
+                self.error = str(e)
+                self._failed_at = time.monotonic()
+                return
+
+            self.components = components
+            self.state = "warm"
+            self.error = None
+            self.init_seconds = round(time.perf_counter() - start, 3)
+            log.info("RAG 鏈已成功初始化", extra={"fields": {"seconds": self.init_seconds}})
+            self._refresh_task = asyncio.create_task(self._refresh_index_loop())
+
+    async def _refresh_index_loop(self):
+        """定期在執行緒中檢查索引版本，重建好的索引才換上，聊天請求不會被卡住"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(RAG_INDEX_CHECK_SECONDS)
+            try:
+                await loop.run_in_executor(None, self.components.refresh_index)
+            except Exception:
+                # 沒有更新版本號，下一輪會再試
+                log.exception("重新建立檢索索引時發生錯誤")
+
+    async def warm_up_in_background(self):
+        """啟動時呼叫：持續重試直到初始化成功"""
+        while self.components is None:
+            await self.warm_up(force=True)
+            if self.components is None:
+                await asyncio.sleep(RAG_INIT_RETRY_SECONDS)
+
+    async def summarize(self, summary, conversation, max_tokens):
+        """給 ChatHistoryManager 用的摘要函式"""
+        components = await self.get()
+        return await components.summary_chain.ainvoke({
+            "summary": summary or "（無）",
+            "conversation": conversation,
+            "max_tokens": max_tokens
+        })
+
+    def status(self):
+        return {
+            "state": self.state,
+            "ready": self.components is not None,
+            "error": self.error,
+            "init_seconds": self.init_seconds,
+        }
+
+
+rag_service = RagService()
@@ -0,0 +1,145 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from logs import get_logger
+
+# build_database.py 每次重建向量資料庫後會改寫這個檔案，快取看到它變動就整個清空
+INDEX_VERSION_FILE = "index_version"
+
+log = get_logger("rag_cache")
+
+
+def new_index_version():
+    return uuid.uuid4().hex
+
+
+def bump_index_version(db_path, version=None):
+    """標記向量資料庫已重建，讓所有伺服器上的回覆快取失效"""
+    os.makedirs(db_path, exist_ok=True)
+    version = version or new_index_version()
+    with open(os.path.join(db_path, INDEX_VERSION_FILE), "w", encoding="utf-8") as f:
+        f.write(version)
+    return version
+
+
+def read_index_version(db_path):
+    try:
+        with open(os.path.join(db_path, INDEX_VERSION_FILE), encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def normalize_question(text):
+    return " ".join(text.split()).lower()
+
+
+class SemanticCache:
+    """
+    以問題的 embedding 為 key 的回覆快取
+    - 文字完全相同（忽略空白與大小寫）的問題不需要算 embedding 就能命中
+    - 否則與快取中的問題做 cosine similarity，超過 threshold 視為同一題
+    - 每筆資料有 TTL，超過 max_entries 時淘汰最久沒用到的 (LRU)
+    - 向量資料庫重建（index_version 改變）時整個清空
+    """
+
+    def __init__(self, embed_query, db_path, threshold=0.95, ttl=3600, max_entries=512,
+                 version_check_interval=5):
+        self._embed_query = embed_query
+        self._db_path = db_path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._version_check_interval = version_check_interval
+        self._entries = OrderedDict()  # normalized question -> (unit vector, value, stored_at)
+        self._lock = threading.Lock()
+        self._version = read_index_version(db_path)
+        self._version_checked_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def lookup(self, question):
+        """回傳 (快取的值或 None, 問題向量)；向量可以交給 store() 重複使用"""
+        self._check_index_version()
+        key = normalize_question(question)
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict_expired(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[0]
+
+        vector = self._unit_vector(self._embed_query(question))
+
+        with self._lock:
+            if self._entries:
+                keys = list(self._entries.keys())
+                matrix = np.stack([self._entries[k][0] for k in keys])
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.hits += 1
+                    return self._entries[keys[best]][1], vector
+            self.misses += 1
+        return None, vector
+
+    def store(self, question, value, vector=None):
+        if vector is None:
+            vector = self._unit_vector(self._embed_query(question))
+        with self._lock:
+            self._entries[normalize_question(question)] = (vector, value, time.monotonic())
+            self._entries.move_to_end(normalize_question(question))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "invalidations": self.invalidations,
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+            }
+
+    def _evict_expired(self, now):
+        # OrderedDict 依最近使用排序，不保證依寫入時間排序，所以完整掃一遍
+        expired = [k for k, (_, _, stored_at) in self._entries.items() if now - stored_at > self.ttl]
+        for k in expired:
+            del self._entries[k]
+
+    def _check_index_version(self):
+        now = time.monotonic()
+        if now - self._version_checked_at < self._version_check_interval:
+            return
+        self._version_checked_at = now
+        version = read_index_version(self._db_path)
+        if version != self._version:
+            log.info("向量資料庫已重建，清空回覆快取")
+            self._version = version
+            self.clear()
+
+    @staticmethod
+    def _unit_vector(values):
+        vector = np.asarray(values, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
@@ -0,0 +1,202 @@
+import os
+import re
+import math
+import heapq
+import unicodedata
+from collections import Counter, defaultdict
+
+try:
+    import tiktoken
+    _encoding = tiktoken.encoding_for_model("gpt-4o")
+except Exception:  # 沒有安裝 tiktoken 或離線無法下載編碼表
+    _encoding = None
+
+# 向量檢索與關鍵字檢索各取的候選數，融合後再交給 select_context_docs 篩選
+RAG_MAX_K = int(os.getenv("RAG_MAX_K", 8))
+RAG_LEXICAL_K = int(os.getenv("RAG_LEXICAL_K", 8))
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", 60))
+RAG_MIN_K = int(os.getenv("RAG_MIN_K", 1))
+RAG_SCORE_THRESHOLD = float(os.getenv("RAG_SCORE_THRESHOLD", 0.3))
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", 1200))
+RAG_DEDUP_SIMILARITY = float(os.getenv("RAG_DEDUP_SIMILARITY", 0.9))
+
+# format_docs 用 "\n\n" 串接各區塊
+SEPARATOR_TOKENS = 1
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # 粗估：中文約一字一 token，英文約四個字元一 token
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+def _shingles(text, n=3):
+    text = "".join(text.split())
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _is_near_duplicate(shingles, kept):
+    for other in kept:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union >= RAG_DEDUP_SIMILARITY:
+            return True
+    return False
+
+
+def select_context_docs(scored_docs, score_threshold=RAG_SCORE_THRESHOLD, min_k=RAG_MIN_K,
+                        token_budget=RAG_CONTEXT_TOKENS):
+    """
+    從已排序的 (document, relevance score) 清單中依序挑出要放進 {context} 的文件
+    - 分數低於 score_threshold 的捨棄，但至少保留前 min_k 個
+    - 與已選文件幾乎相同（字元 trigram Jaccard >= RAG_DEDUP_SIMILARITY）的捨棄
+    - 累積 token 數超過 token_budget 就停止（第一個文件一定保留）
+    回傳 (選中的文件, context token 數)
+    """
+    selected = []
+    kept_shingles = []
+    used_tokens = 0
+
+    for doc, score in scored_docs:
+        if score < score_threshold and len(selected) >= min_k:
+            continue
+
+        shingles = _shingles(doc.page_content)
+        if _is_near_duplicate(shingles, kept_shingles):
+            continue
+
+        tokens = count_tokens(doc.page_content) + (SEPARATOR_TOKENS if selected else 0)
+        if selected and used_tokens + tokens > token_budget:
+            break
+
+        selected.append(doc)
+        kept_shingles.append(shingles)
+        used_tokens += tokens
+
+    return selected, used_tokens
+
+
+# 課程代碼，例如 NEO-101、PRC-201
+# 不用 \b：中文字也算 word 字元，「請問NEO-101」的「問」與「N」之間不會有邊界，改用前後不接英數判斷
+COURSE_CODE_RE = re.compile(r"(?<![A-Za-z0-9])[A-Z]{2,5}-\d{2,4}(?![0-9])")
+# 斷詞在小寫後的文字上進行，課程代碼的規則與 COURSE_CODE_RE 相同
+_TOKEN_RE = re.compile(r"(?<![a-z0-9])[a-z]{2,5}-\d{2,4}(?![0-9])|[a-z]+|\d+(?:\.\d+)?%?|[\u3400-\u9fff\uf900-\ufaff]+")
+
+
+def _is_cjk(token):
+    return "\u3400" <= token[0] <= "\u9fff" or "\uf900" <= token[0] <= "\ufaff"
+
+
+def normalize_text(text):
+    # NFKC 會把全形英數與標點轉成半形
+    return unicodedata.normalize("NFKC", text)
+
+
+def tokenize(text):
+    """
+    中英混合斷詞：中文取單字與相鄰兩字 (bigram)，英文與數字取整個詞，
+    課程代碼 neo-101 同時保留完整代碼與 neo、101
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(normalize_text(text).lower()):
+        token = match.group()
+        if _is_cjk(token):
+            tokens.extend(token)
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            tokens.append(token)
+            if "-" in token:
+                tokens.extend(token.split("-"))
+    return tokens
+
+
+class LexicalIndex:
+    """
+    Q&A 區塊的記憶體內倒排索引 (BM25)
+    另外維護課程代碼對照表，問題中出現代碼時直接查表命中
+    documents 可以是 list 或快照的 SnapshotDocuments，搜尋結果才以編號取出文件
+    """
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)  # term -> [(doc index, term frequency)]
+        self.doc_lengths = []
+        self.codes = defaultdict(list)  # 課程代碼 -> [doc index]
+
+        for index, doc in enumerate(documents):
+            counts = Counter(tokenize(doc.page_content))
+            for term, tf in counts.items():
+                self.postings[term].append((index, tf))
+            self.doc_lengths.append(sum(counts.values()))
+            for code in set(COURSE_CODE_RE.findall(normalize_text(doc.page_content).upper())):
+                self.codes[code].append(index)
+
+        total = len(documents)
+        self.avg_length = (sum(self.doc_lengths) / total) if total else 0.0
+        self.idf = {
+            term: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    @classmethod
+    def from_chroma(cls, db):
+        from langchain.schema import Document
+
+        data = db.get(include=["documents", "metadatas"])
+        documents = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(data["documents"], data["metadatas"])
+        ]
+        return cls(documents)
+
+    def search(self, query, k=RAG_LEXICAL_K):
+        """
+        回傳 [(document, relevance)]，relevance 為命中的查詢詞 idf 佔全部查詢詞 idf 的比例 (0~1)，
+        課程代碼完全命中時為 1.0 並排在最前面
+        """
+        code_hits = []
+        for code in dict.fromkeys(COURSE_CODE_RE.findall(normalize_text(query).upper())):
+            code_hits.extend(self.codes.get(code, []))
+        code_hits = list(dict.fromkeys(code_hits))
+
+        terms = Counter(tokenize(query))
+        query_weight = sum(self.idf.get(term, 0.0) * qtf for term, qtf in terms.items())
+        scores = defaultdict(float)
+        matched_weight = defaultdict(float)
+        for term, qtf in terms.items():
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for index, tf in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[index] / (self.avg_length or 1))
+                scores[index] += idf * tf * (self.k1 + 1) / (tf + norm)
+                matched_weight[index] += idf * qtf
+
+        results = [(self.documents[index], 1.0) for index in code_hits[:k]]
+        if len(results) < k:
+            top = heapq.nlargest(k, (i for i in scores if i not in code_hits), key=scores.__getitem__)
+            results.extend(
+                (self.documents[index], matched_weight[index] / query_weight if query_weight else 0.0)
+                for index in top[:k - len(results)]
+            )
+        return results
+
+
+def reciprocal_rank_fusion(result_lists, rrf_k=RAG_RRF_K):
+    """
+    以 reciprocal rank fusion 合併多個 [(document, relevance)] 排名
+    同一份文件（內容相同）只保留一次，relevance 取各來源中最高者
+    """
+    fused = {}
+    for results in result_lists:
+        for rank, (doc, relevance) in enumerate(results):
+            key = doc.page_content
+            score, best_relevance, _ = fused.get(key, (0.0, 0.0, doc))
+            fused[key] = (score + 1 / (rrf_k + rank + 1), max(best_relevance, relevance), doc)
+    ranked = sorted(fused.values(), key=lambda item: item[0], reverse=True)
+    return [(doc, relevance) for _, relevance, doc in ranked]
@@ -0,0 +1,156 @@
+import os
+import math
+import time
+import asyncio
+import bisect
+
+import mysql.connector
+
+from db import PoolTimeout, DatabaseUnavailable
+from logs import get_logger
+
+TRENDING_HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", 24))
+TRENDING_WINDOW_DAYS = int(os.getenv("TRENDING_WINDOW_DAYS", 14))
+TRENDING_REFRESH_INTERVAL = float(os.getenv("TRENDING_REFRESH_INTERVAL", 300))
+TRENDING_SIZE = int(os.getenv("TRENDING_SIZE", 50))
+TRENDING_LIKE_WEIGHT = 1.0
+TRENDING_COMMENT_WEIGHT = 2.0
+
+log = get_logger("trending")
+
+
+def load_trending_scores(conn, epoch, half_life, window_days, like_weight, comment_weight):
+    """
+    以資料庫中 window_days 天內的點讚與留言重新計算每篇貼文的分數
+    每筆互動的權重為 weight * 2^((互動時間 - epoch) / half_life)
+    """
+    cursor = conn.cursor()
+    try:
+        scores = {}
+        for table, weight in (("post_likes", like_weight), ("post_comments", comment_weight)):
+            cursor.execute(f"""
+                SELECT post_id, SUM(POW(2, (UNIX_TIMESTAMP(created_at) - %s) / %s))
+                FROM {table}
+                WHERE created_at >= NOW() - INTERVAL %s DAY
+                GROUP BY post_id
+            """, (epoch, half_life, window_days))
+            for post_id, score in cursor.fetchall():
+                scores[post_id] = scores.get(post_id, 0.0) + weight * float(score)
+        return scores
+    finally:
+        cursor.close()
+
+
+def load_post_summaries(conn, post_ids):
+    cursor = conn.cursor(dictionary=True)
+    try:
+        placeholders = ", ".join(["%s"] * len(post_ids))
+        cursor.execute(f"""
+            SELECT p.id, p.content, u.name as user
+            FROM posts p
+            LEFT JOIN users u ON p.author_id = u.id
+            WHERE p.id IN ({placeholders})
+        """, list(post_ids))
+        return {row['id']: row for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+class TrendingPosts:
+    """
+    記憶體中的熱門貼文排行，分數隨時間衰減（半衰期 TRENDING_HALF_LIFE_HOURS）
+    每筆互動加上 weight * 2^((t - epoch) / half_life)：所有貼文的分數以相同比例衰減，
+    排名不隨時間改變，因此點讚/留言時只需更新一篇貼文，讀取前 limit 名不必排序
+    背景工作每 TRENDING_REFRESH_INTERVAL 秒從資料庫重算一次並重設 epoch，修正取消點讚等近似誤差
+    """
+
+    def __init__(self, db, size=TRENDING_SIZE, half_life_hours=TRENDING_HALF_LIFE_HOURS,
+                 window_days=TRENDING_WINDOW_DAYS, refresh_interval=TRENDING_REFRESH_INTERVAL):
+        self.db = db
+        self.size = size
+        self.half_life = half_life_hours * 3600
+        self.window_days = window_days
+        self.refresh_interval = refresh_interval
+        self.epoch = time.time() - window_days * 86400
+        self._scores = {}  # post_id -> 分數
+        self._top = []  # 前 size 名，依 (-分數, -post_id) 排序
+        self._summaries = {}  # 前幾名貼文的內容與作者
+        self._loaded = False
+        self._refresh_lock = asyncio.Lock()
+        self._task = None
+        self.stats = {"refreshes": 0, "updates": 0, "errors": 0, "last_refresh_ms": None}
+
+    def start(self):
+        if self._task is None and self.refresh_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def record(self, post_id, kind):
+        """點讚 (like)、取消點讚 (unlike) 或留言 (comment) 後呼叫"""
+        if not self._loaded:
+            return
+        weight = {"like": TRENDING_LIKE_WEIGHT, "unlike": -TRENDING_LIKE_WEIGHT,
+                  "comment": TRENDING_COMMENT_WEIGHT}[kind]
+        delta = weight * math.pow(2, (time.time() - self.epoch) / self.half_life)
+        old = self._scores.get(post_id, 0.0)
+        new = max(old + delta, 0.0)
+        self._scores[post_id] = new
+        self._reposition(post_id, old, new)
+        self.stats["updates"] += 1
+
+    async def top(self, limit):
+        """回傳前 limit 名貼文 [{id, content, user}]"""
+        if not self._loaded:
+            await self.refresh()
+        post_ids = [-neg_id for _, neg_id in self._top[:limit]]
+        missing = [post_id for post_id in post_ids if post_id not in self._summaries]
+        if missing:
+            self._summaries.update(await self.db.run(load_post_summaries, missing))
+        return [self._summaries[post_id] for post_id in post_ids if post_id in self._summaries]
+
+    async def refresh(self):
+        async with self._refresh_lock:
+            started = time.perf_counter()
+            epoch = time.time() - self.window_days * 86400
+            scores = await self.db.run(load_trending_scores, epoch, self.half_life, self.window_days,
+                                       TRENDING_LIKE_WEIGHT, TRENDING_COMMENT_WEIGHT)
+            self.epoch = epoch
+            self._scores = scores
+            self._top = sorted((-score, -post_id) for post_id, score in scores.items() if score > 0)[: self.size]
+            top_ids = {-neg_id for _, neg_id in self._top}
+            self._summaries = {post_id: row for post_id, row in self._summaries.items() if post_id in top_ids}
+            self._loaded = True
+            self.stats["refreshes"] += 1
+            self.stats["last_refresh_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    def status(self):
+        return {**self.stats, "loaded": self._loaded, "tracked_posts": len(self._scores),
+                "size": self.size, "half_life_hours": self.half_life / 3600}
+
+    def _reposition(self, post_id, old, new):
+        old_key = (-old, -post_id)
+        index = bisect.bisect_left(self._top, old_key)
+        if index < len(self._top) and self._top[index] == old_key:
+            del self._top[index]
+        if new > 0:
+            bisect.insort(self._top, (-new, -post_id))
+            if len(self._top) > self.size:
+                dropped = -self._top.pop()[1]
+                self._summaries.pop(dropped, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except (PoolTimeout, DatabaseUnavailable, mysql.connector.Error) as e:
+                self.stats["errors"] += 1
+                log.warning("重新計算熱門貼文失敗，下次再試", extra={"fields": {"error": str(e)}})
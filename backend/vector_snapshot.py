@@ -0,0 +1,161 @@
+import os
+import json
+import mmap
+import shutil
+import uuid
+from collections.abc import Sequence
+
+import numpy as np
+
+SNAPSHOT_DIR = "snapshot"  # 放在向量資料庫資料夾底下
+CURRENT_FILE = "CURRENT"
+SNAPSHOT_SEARCH_CHUNK = int(os.getenv("SNAPSHOT_SEARCH_CHUNK", 65536))
+SQRT2 = float(np.sqrt(2))
+
+
+def export_snapshot(db_path, ids, vectors, documents, metadatas, dtype="float16", info=None):
+    """
+    把向量與文件匯出成唯讀快照，供多個 worker 以 mmap 共用
+    - vectors.npy：正規化後的 (筆數, 維度) 矩陣
+    - records.bin + offsets.npy：每筆 {"id", "page_content", "metadata"} 的 UTF-8 JSON 串接，
+      第 i 筆位於 offsets[i]:offsets[i + 1]
+    寫到新的子資料夾後才更新 CURRENT，正在讀舊快照的 worker 不受影響
+    """
+    root = os.path.join(db_path, SNAPSHOT_DIR)
+    name = uuid.uuid4().hex
+    target = os.path.join(root, name)
+    os.makedirs(target)
+
+    if len(ids):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+    else:
+        # 資料庫沒有任何區塊：存成 (0, 0) 的空矩陣，search 直接回傳 []
+        matrix = np.empty((0, 0), dtype=np.float32)
+    np.save(os.path.join(target, "vectors.npy"), matrix.astype(dtype))
+
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    with open(os.path.join(target, "records.bin"), "wb") as f:
+        for i, (doc_id, text, metadata) in enumerate(zip(ids, documents, metadatas)):
+            record = json.dumps({"id": doc_id, "page_content": text, "metadata": metadata or {}},
+                                ensure_ascii=False).encode("utf-8")
+            f.write(record)
+            offsets[i + 1] = offsets[i] + len(record)
+    np.save(os.path.join(target, "offsets.npy"), offsets)
+
+    with open(os.path.join(target, "info.json"), "w", encoding="utf-8") as f:
+        json.dump({**(info or {}), "count": len(ids), "dim": int(matrix.shape[1]),
+                   "dtype": dtype}, f, ensure_ascii=False)
+
+    previous = read_current(db_path)
+    tmp_path = os.path.join(root, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(name)
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+
+    # 保留上一份給還沒切換的 worker，更舊的刪掉
+    for entry in os.listdir(root):
+        if entry not in (name, previous, CURRENT_FILE) and os.path.isdir(os.path.join(root, entry)):
+            shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+    return target
+
+
+def read_current(db_path):
+    try:
+        with open(os.path.join(db_path, SNAPSHOT_DIR, CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+class VectorSnapshot:
+    """
+    唯讀的向量快照：矩陣與文件內容都以 mmap 開啟，多個 worker 透過作業系統的頁快取共用記憶體
+    以分塊的矩陣乘法做精確的餘弦相似度搜尋，語料量在數十萬筆以內都很快
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "info.json"), encoding="utf-8") as f:
+            self.info = json.load(f)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self._records_file = open(os.path.join(path, "records.bin"), "rb")
+        size = os.fstat(self._records_file.fileno()).st_size
+        self._records = mmap.mmap(self._records_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @classmethod
+    def open_current(cls, db_path):
+        """開啟目前的快照；沒有快照時回傳 None"""
+        name = read_current(db_path)
+        if name is None:
+            return None
+        return cls(os.path.join(db_path, SNAPSHOT_DIR, name))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def record(self, index):
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return json.loads(self._records[start:end].decode("utf-8"))
+
+    def document(self, index):
+        from langchain_core.documents import Document
+
+        record = self.record(index)
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def documents(self):
+        """所有文件的唯讀序列，取用時才從 mmap 解碼"""
+        return SnapshotDocuments(self)
+
+    def search(self, query_vector, k):
+        """
+        回傳 [(Document, 相關分數)]，依分數由高到低
+        分數與 Chroma 預設 (l2 空間，平方距離) 經 LangChain 換算的結果一致：1 - (2 - 2cos) / √2，
+        RAG_SCORE_THRESHOLD 的意義不變
+        """
+        total = len(self)
+        if total == 0 or k <= 0:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+
+        scores = np.empty(total, dtype=np.float32)
+        for start in range(0, total, SNAPSHOT_SEARCH_CHUNK):
+            block = np.asarray(self.vectors[start:start + SNAPSHOT_SEARCH_CHUNK], dtype=np.float32)
+            scores[start:start + len(block)] = block @ query
+
+        k = min(k, total)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(self.document(int(index)), 1.0 - (2.0 - 2.0 * float(scores[index])) / SQRT2) for index in top]
+
+    def close(self):
+        if isinstance(self._records, mmap.mmap):
+            self._records.close()
+        self._records_file.close()
+
+
+class SnapshotDocuments(Sequence):
+    """
+    快照文件的序列介面，給關鍵字與 FAQ 索引使用
+    全文留在 mmap 的 records.bin（各 worker 共用頁快取），只有搜尋結果用到的那幾筆才解碼成 Document
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.snapshot.document(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.snapshot.document(index)